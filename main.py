@@ -7,6 +7,7 @@ import argparse
 import subprocess
 
 from source.prepare_dataset import get_images_from_storage, prepare_images, operate_ptz
+from source.collection_service import operate_ptz_cluster
 from source.run_jepa import run as run_jepa
 from source.run_rl import run as run_rl
 from source.env_interaction import run as env_inter
@@ -54,6 +55,11 @@ def environment_interaction(arguments):
     logger.info("interaction_complete: %s", interaction_complete)
 
 
+def cluster_collection(arguments):
+    stats = operate_ptz_cluster(arguments)
+    logger.info("collection stats: %s", stats)
+
+
 def lifelong_learning(arguments):
 
     operate_ptz(arguments)
@@ -95,6 +101,13 @@ def get_argparser():
         action="store_true",
         help="Gather images from determined storage location",
     )
+    parser.add_argument(
+        "-mi",
+        "--maximages",
+        help="Train on at most this many of the most recent stored images, 0 for all (default=0).",
+        type=int,
+        default=0,
+    )
     parser.add_argument(
         "-cb",
         "--camerabrand",
@@ -133,6 +146,27 @@ def get_argparser():
     parser.add_argument(
         "-ip", "--cameraip", help="The ip of the PTZ camera.", type=str, default=""
     )
+    parser.add_argument(
+        "-ps",
+        "--positionstaleness",
+        help="Seconds a cached camera position is used without querying the camera again (default=1.0).",
+        type=float,
+        default=1.0,
+    )
+    parser.add_argument(
+        "-cams",
+        "--cameras",
+        help="YAML file listing the cameras (name, brand, ip, username, password) to collect from concurrently in the collect run mode.",
+        type=str,
+        default="",
+    )
+    parser.add_argument(
+        "-ec",
+        "--encodercheckpoint",
+        help="World model checkpoint whose target encoder embeds the images collected in the collect run mode.",
+        type=str,
+        default="",
+    )
     parser.add_argument(
         "-rm",
         "--run_mode",
@@ -144,6 +178,7 @@ def get_argparser():
             "agent_train",
             "env_interaction",
             "lifelong",
+            "collect",
         ],
         type=str,
         default="train",
@@ -236,6 +271,8 @@ def main():
         environment_interaction(args)
     elif args.run_mode == "lifelong":
         lifelong_learning(args)
+    elif args.run_mode == "collect":
+        cluster_collection(args)
  
     logger.info("DONE!")
     if args.distributed:
@@ -10,7 +10,7 @@ import numpy as np
 import h5py
 import torch
 
-from source.datasets.ptz_dataset import get_position_datetime_from_labels
+from source.datasets.ptz_dataset import get_position_datetime_from_labels, get_labels_from_directory
 from source.track_progress import timefmt
 
 import logging
@@ -29,8 +29,8 @@ class ModelInfo:
         with open(model_info_path, "r") as f:
             self.info_dict = yaml.safe_load(f)
         self.ori_info_dict = copy.deepcopy(self.info_dict)
-        imgnames = np.array(os.listdir(img_dir))
-        imgposs, imgtimes = get_position_datetime_from_labels([iname.strip(".jpg") for iname in imgnames])
+        labels, imgposs, imgtimes = get_labels_from_directory(img_dir)
+        imgnames = np.array([f"{label}.jpg" for label in labels])
         # imgtimes = pd.to_datetime(imgtimes, format=timefmt)
         # figure out images that are used in the trainings
         for k in self.info_dict.keys():
@@ -0,0 +1,411 @@
+"""
+Micro-benchmarks for the training / inference hot paths.
+
+Usage:
+    python -m source.benchmark ema --model vit_tiny --iters 200
+    python -m source.benchmark replay --capacity 5000 --batch_size 64
+    python -m source.benchmark camera_http --requests 200 --latency 0.002
+    python -m source.benchmark labels --num_labels 1000000
+    python -m source.benchmark attention --model vit_tiny --batch_size 32
+    python -m source.benchmark predictor --fname configs/Config_file.yaml --pred_depth 6 12
+    python -m source.benchmark precision --steps 50
+"""
+
+import time
+import copy
+import logging
+import argparse
+
+import torch
+
+import source.models.vision_transformer as vit
+from source.utils.ema import ModelEMA
+from source.utils.precision import PrecisionPolicy
+from source.utils.reward_signal import GradientRewardSignal
+from source.rl_helper import ReplayMemory, TensorReplayMemory, Transition
+
+
+logger = logging.getLogger(__name__)
+
+
+def _sync(device):
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+
+
+def time_fn(fn, device, iters=100, warmup=10):
+    """ :returns: mean wall time of fn() in milliseconds """
+    for _ in range(warmup):
+        fn()
+    _sync(device)
+    start = time.perf_counter()
+    for _ in range(iters):
+        fn()
+    _sync(device)
+    return (time.perf_counter() - start) * 1000. / iters
+
+
+def benchmark_ema(arguments):
+    device = torch.device(arguments.device)
+    source = vit.__dict__[arguments.model](img_size=[arguments.crop_size]).to(device)
+    target = copy.deepcopy(source)
+    m = 0.996
+
+    def loop_update():
+        with torch.no_grad():
+            for param_q, param_k in zip(source.parameters(), target.parameters()):
+                param_k.data.mul_(m).add_((1.-m) * param_q.detach().data)
+
+    def state_dict_update():
+        target_state_dict = target.state_dict()
+        source_state_dict = source.state_dict()
+        with torch.no_grad():
+            for key in source_state_dict:
+                target_state_dict[key] = source_state_dict[key]*(1-m) + target_state_dict[key]*m
+        target.load_state_dict(target_state_dict)
+
+    target_ema = ModelEMA(source, target)
+
+    def foreach_update():
+        target_ema.update(m)
+
+    num_params = sum(p.numel() for p in source.parameters())
+    logger.info('EMA of %s (%d tensors, %.1fM params) on %s' % (
+        arguments.model, len(target_ema.target_params), num_params / 1e6, device))
+    for name, fn in [('python loop', loop_update),
+                     ('state_dict blend', state_dict_update),
+                     ('ModelEMA', foreach_update)]:
+        ms = time_fn(fn, device, iters=arguments.iters)
+        logger.info('%-18s %8.3f ms/step' % (name, ms))
+
+
+def benchmark_replay(arguments):
+    device = torch.device(arguments.device)
+    n, N, D = arguments.capacity, arguments.num_tokens, arguments.embed_dim
+    states = torch.randn(n + 1, N, D, device=device)
+    positions = torch.randn(n + 1, 3, device=device)
+    actions = torch.randint(21, (n,), device=device).float()
+    rewards = torch.randn(n, device=device)
+
+    memory = ReplayMemory(n)
+    for i in range(n):
+        memory.push(states[i], positions[i], actions[i], states[i+1], positions[i+1], rewards[i])
+
+    tensor_memory = TensorReplayMemory(n, device=device)
+    tensor_memory.push_batch(states[:-1], positions[:-1], actions, states[1:], positions[1:], rewards)
+
+    def deque_sample():
+        batch = Transition(*zip(*memory.sample(arguments.batch_size)))
+        return [torch.stack(list(b), dim=0) for b in batch]
+
+    def tensor_sample():
+        return tensor_memory.sample(arguments.batch_size)
+
+    logger.info('Replay sampling of %d transitions [%d, %d] on %s' % (n, N, D, device))
+    for name, fn in [('deque + stack', deque_sample),
+                     ('TensorReplayMemory', tensor_sample)]:
+        ms = time_fn(fn, device, iters=arguments.iters)
+        logger.info('%-18s %8.3f ms/batch (%.0f batches/s)' % (name, ms, 1000. / ms))
+
+
+def benchmark_camera_http(arguments):
+    import requests
+    from requests.auth import HTTPDigestAuth
+    from source.camera_http import CameraSession
+    from source.fake_camera import FakeCamera
+
+    with FakeCamera(latency=arguments.latency) as camera:
+        url = f'http://{camera.address}/stw-cgi/ptzcontrol.cgi'
+        payload = {'msubmenu': 'query', 'action': 'view', 'Query': 'Pan,Tilt,Zoom'}
+        session = CameraSession('admin', 'admin')
+
+        def bare_get():
+            return requests.get(url, auth=HTTPDigestAuth('admin', 'admin'), params=payload)
+
+        def session_get():
+            return session.get(url, params=payload)
+
+        logger.info('PTZ queries against a fake camera (%.1f ms server latency)' % (arguments.latency * 1000.))
+        for name, fn in [('requests.get', bare_get),
+                         ('CameraSession', session_get)]:
+            served, challenges = camera.state.requests, camera.state.challenges
+            start = time.perf_counter()
+            for _ in range(arguments.requests):
+                assert fn().status_code == 200
+            ms = (time.perf_counter() - start) * 1000. / arguments.requests
+            logger.info('%-18s %8.3f ms/request (%.2f HTTP round trips/request)' % (
+                name, ms, (camera.state.requests - served) / arguments.requests))
+        session.close()
+
+
+def benchmark_labels(arguments):
+    import datetime
+    import numpy as np
+    from source.datasets.ptz_dataset import (
+        _parse_labels_per_label,
+        _parse_labels_vectorized)
+
+    n = arguments.num_labels
+    rng = np.random.default_rng(0)
+    start = datetime.datetime(2024, 6, 21)
+    offsets = rng.integers(0, 10**12, n)
+    labels = [
+        f"{pan:.2f},{tilt:.2f},{zoom:.1f}_{(start + datetime.timedelta(microseconds=int(us))).strftime('%Y-%m-%d_%H:%M:%S.%f')}"
+        for pan, tilt, zoom, us in zip(rng.uniform(0, 360, n), rng.uniform(-20, 90, n), rng.uniform(1, 2, n), offsets)]
+
+    logger.info('Parsing %d labels' % n)
+    results = []
+    for name, fn in [('per label', _parse_labels_per_label),
+                     ('vectorized', _parse_labels_vectorized)]:
+        t0 = time.perf_counter()
+        results.append(fn(labels))
+        logger.info('%-18s %8.3f s' % (name, time.perf_counter() - t0))
+    assert np.allclose(results[0][0], results[1][0]) and (results[0][1] == results[1][1]).all()
+
+
+def benchmark_attention(arguments):
+    device = torch.device(arguments.device)
+    torch.manual_seed(0)
+    model = vit.__dict__[arguments.model](img_size=[arguments.crop_size]).to(device).eval()
+    fused_model = vit.__dict__[arguments.model](img_size=[arguments.crop_size], fused_attention=True).to(device).eval()
+    fused_model.load_state_dict(model.state_dict())
+    x = torch.randn(arguments.batch_size, 3, arguments.crop_size, arguments.crop_size, device=device)
+
+    # -- numerical equivalence of the fused and materialized paths, forward and backward
+    outputs, grads = [], []
+    for m in (model, fused_model):
+        m.zero_grad()
+        out = m(x)
+        out.float().pow(2).mean().backward()
+        outputs.append(out.detach())
+        grads.append(m.blocks[0].attn.qkv.weight.grad.clone())
+    assert torch.allclose(outputs[0], outputs[1], atol=arguments.atol, rtol=1e-4), \
+        (outputs[0] - outputs[1]).abs().max().item()
+    assert torch.allclose(grads[0], grads[1], atol=arguments.atol, rtol=1e-4), \
+        (grads[0] - grads[1]).abs().max().item()
+
+    # -- a custom qk_scale and the attention weights (materialized on request)
+    attn = vit.Attention(model.embed_dim, num_heads=model.num_heads, qk_scale=0.1).to(device).eval()
+    fused_attn = vit.Attention(model.embed_dim, num_heads=model.num_heads, qk_scale=0.1, fused=True).to(device).eval()
+    fused_attn.load_state_dict(attn.state_dict())
+    tokens = torch.randn(arguments.batch_size, model.patch_embed.num_patches, model.embed_dim, device=device)
+    with torch.no_grad():
+        y, weights = attn(tokens)
+        fused_y, no_weights = fused_attn(tokens)
+        _, fused_weights = fused_attn(tokens, return_attention=True)
+    assert no_weights is None and torch.allclose(weights, fused_weights)
+    assert torch.allclose(y, fused_y, atol=arguments.atol, rtol=1e-4), (y - fused_y).abs().max().item()
+    logger.info('fused attention matches (max abs diff %.2e)' % (outputs[0] - outputs[1]).abs().max().item())
+
+    logger.info('%s forward, batch %d on %s' % (arguments.model, arguments.batch_size, device))
+    for name, m in [('materialized', model), ('fused', fused_model)]:
+        def forward():
+            with torch.no_grad():
+                return m(x)
+        if device.type == 'cuda':
+            torch.cuda.reset_peak_memory_stats(device)
+        ms = time_fn(forward, device, iters=arguments.iters)
+        peak = torch.cuda.max_memory_allocated(device) / 1024.**2 if device.type == 'cuda' else float('nan')
+        logger.info('%-18s %8.3f ms/batch (peak %.0f MB)' % (name, ms, peak))
+
+
+def _repeat_tokens(x, pos_embed, ptz_embed1, ptz_embed2):
+    # -- predictor input as assembled before predictor_tokens
+    B, N, _ = x.shape
+    x = x + ptz_embed1.repeat(N, 1, 1).permute(1, 0, 2)
+    x = x + pos_embed.repeat(B, 1, 1)
+    return torch.cat([x, ptz_embed2.repeat(N, 1, 1).permute(1, 0, 2)], dim=1)
+
+
+def benchmark_predictor(arguments):
+    import yaml
+
+    device = torch.device(arguments.device)
+    with open(arguments.fname, 'r') as y_file:
+        params = yaml.load(y_file, Loader=yaml.FullLoader)
+    encoder = vit.__dict__[params['meta']['model_arch']](
+        img_size=[params['data']['crop_size']],
+        patch_size=params['mask']['patch_size'])
+    num_patches, embed_dim = encoder.patch_embed.num_patches, encoder.embed_dim
+    # -- with encode_once the predictor sees every (context, target) pair
+    B = arguments.batch_size or params['data']['batch_size'] ** 2
+    depths = arguments.pred_depth or [params['meta']['pred_depth']]
+    dims = arguments.pred_emb_dim or [params['meta']['pred_emb_dim']]
+
+    def peak_mb(fn):
+        if device.type != 'cuda':
+            return float('nan')
+        torch.cuda.reset_peak_memory_stats(device)
+        base = torch.cuda.memory_allocated(device)
+        fn()
+        _sync(device)
+        return (torch.cuda.max_memory_allocated(device) - base) / 1024.**2
+
+    logger.info('%s for %s (%d patches), %d pairs on %s' % (
+        arguments.predictor, params['meta']['model_arch'], num_patches, B, device))
+    for pred_emb_dim in dims:
+        x = torch.randn(B, num_patches, pred_emb_dim, device=device)
+        pos_embed = torch.randn(1, num_patches, pred_emb_dim, device=device)
+        ptz1 = torch.randn(B, pred_emb_dim, device=device)
+        ptz2 = torch.randn(B, pred_emb_dim, device=device)
+        assert torch.allclose(_repeat_tokens(x, pos_embed, ptz1, ptz2), vit.predictor_tokens(x, pos_embed, ptz1, ptz2))
+        buffer = vit.TokenBuffer()
+        for name, fn in [('repeat + cat', lambda: _repeat_tokens(x, pos_embed, ptz1, ptz2)),
+                         ('predictor_tokens', lambda: vit.predictor_tokens(x, pos_embed, ptz1, ptz2, buffer))]:
+            with torch.no_grad():
+                ms = time_fn(fn, device, iters=arguments.iters)
+                mb = peak_mb(fn)
+            logger.info('[emb %4d] tokens %-17s %8.3f ms (peak +%.0f MB)' % (pred_emb_dim, name, ms, mb))
+
+        for pred_depth in depths:
+            predictor = vit.__dict__[arguments.predictor](
+                num_patches=num_patches,
+                embed_dim=embed_dim,
+                predictor_embed_dim=pred_emb_dim,
+                depth=pred_depth,
+                num_heads=encoder.num_heads).to(device)
+            z = torch.randn(B, num_patches, embed_dim, device=device)
+            poss1 = torch.randn(B, 3, device=device)
+            poss2 = torch.randn(B, 3, device=device)
+
+            def train_step():
+                pred_z = predictor(z, poss1, poss2)
+                if isinstance(pred_z, tuple):
+                    # -- vit_rssm also predicts the reward
+                    pred_z = pred_z[0]
+                pred_z.float().pow(2).mean().backward()
+
+            def inference_step():
+                with torch.no_grad():
+                    return predictor(z, poss1, poss2)
+
+            for name, fn in [('train step', train_step), ('no_grad step', inference_step)]:
+                ms = time_fn(fn, device, iters=arguments.iters, warmup=3)
+                mb = peak_mb(fn)
+                logger.info('[emb %4d, depth %2d] %-13s %8.3f ms (peak +%.0f MB)' % (
+                    pred_emb_dim, pred_depth, name, ms, mb))
+
+
+def benchmark_precision(arguments):
+    import torch.nn.functional as F
+
+    device = torch.device(arguments.device)
+    # -- small synthetic dataset: fixed images and ptz positions
+    generator = torch.Generator().manual_seed(0)
+    images = torch.rand(arguments.num_images, 3, arguments.crop_size, arguments.crop_size, generator=generator)
+    positions = torch.rand(arguments.num_images, 3, generator=generator) * 2. - 1.
+    batches = [torch.randint(arguments.num_images, (arguments.batch_size,), generator=generator)
+               for _ in range(arguments.steps)]
+
+    def train(precision_name):
+        torch.manual_seed(0)
+        precision = PrecisionPolicy(precision_name, device)
+        encoder = vit.__dict__[arguments.model](img_size=[arguments.crop_size], patch_size=arguments.patch_size).to(device)
+        predictor = vit.__dict__['vit_rssm'](
+            num_patches=encoder.patch_embed.num_patches,
+            embed_dim=encoder.embed_dim,
+            predictor_embed_dim=encoder.embed_dim,
+            depth=2,
+            num_heads=encoder.num_heads).to(device)
+        target_encoder = copy.deepcopy(encoder)
+        target_ema = ModelEMA(encoder, target_encoder)
+        reward_signal = GradientRewardSignal(target_encoder, mode='exact')
+        optimizer = torch.optim.AdamW(list(encoder.parameters()) + list(predictor.parameters()), lr=1e-4)
+        losses, rewards = [], []
+        for index in batches:
+            imgs = images[index].to(device)
+            poss = positions[index].to(device)
+            # -- context i predicts target (i + 1) of the batch
+            target_idx = torch.roll(torch.arange(len(index), device=device), 1)
+            # -- like run_jepa, the reward target is computed in fp32 outside autocast
+            h = target_encoder(imgs)
+            h = F.layer_norm(h, (h.size(-1),)).index_select(0, target_idx)
+            with precision.autocast():
+                z, r = predictor(encoder(imgs), poss, poss.index_select(0, target_idx))
+            g = reward_signal(F.smooth_l1_loss(z.detach().float(), h), h)
+            with precision.autocast():
+                loss = F.smooth_l1_loss(z, h.detach()) + F.smooth_l1_loss(r, g.repeat(r.shape))
+            precision.backward(loss)
+            precision.step(optimizer)
+            optimizer.zero_grad()
+            target_ema.update(0.996)
+            losses.append(float(loss))
+            rewards.append(float(g))
+        assert all(p.dtype == torch.float32 for p in target_encoder.parameters())
+        return precision, torch.tensor(losses), torch.tensor(rewards)
+
+    logger.info('%d steps of %s on %d synthetic images on %s' % (
+        arguments.steps, arguments.model, arguments.num_images, device))
+    _, reference, reference_rewards = train('fp32')
+    for name in arguments.precisions:
+        policy, losses, rewards = train(name)
+        rel = ((losses - reference).abs() / reference.abs().clamp_min(1e-8))
+        logger.info('%-5s (%s) loss %.4f -> %.4f vs fp32 %.4f -> %.4f, max rel. diff %.2e' % (
+            name, policy.precision, losses[0], losses[-1], reference[0], reference[-1], rel.max()))
+        assert rel.max() < arguments.rtol, f'{name} loss diverges from fp32 by {rel.max():.2e}'
+        rel = ((rewards - reference_rewards).abs() / reference_rewards.abs().clamp_min(1e-12))
+        logger.info('%-5s (%s) reward target %.3e -> %.3e vs fp32 %.3e -> %.3e, max rel. diff %.2e' % (
+            name, policy.precision, rewards[0], rewards[-1], reference_rewards[0], reference_rewards[-1], rel.max()))
+        assert rel.max() < arguments.rtol, f'{name} reward target diverges from fp32 by {rel.max():.2e}'
+
+
+def get_argparser():
+    parser = argparse.ArgumentParser("PTZ JEPA benchmarks")
+    parser.add_argument('--device', type=str, default='cuda:0' if torch.cuda.is_available() else 'cpu')
+    parser.add_argument('--iters', type=int, default=100)
+    subparsers = parser.add_subparsers(dest='benchmark', required=True)
+
+    ema_parser = subparsers.add_parser('ema', help='Target network EMA update')
+    ema_parser.add_argument('--model', type=str, default='vit_tiny')
+    ema_parser.add_argument('--crop_size', type=int, default=224)
+    ema_parser.set_defaults(func=benchmark_ema)
+
+    replay_parser = subparsers.add_parser('replay', help='Replay memory sampling and collation')
+    replay_parser.add_argument('--capacity', type=int, default=5000)
+    replay_parser.add_argument('--batch_size', type=int, default=64)
+    replay_parser.add_argument('--num_tokens', type=int, default=196)
+    replay_parser.add_argument('--embed_dim', type=int, default=192)
+    replay_parser.set_defaults(func=benchmark_replay)
+
+    http_parser = subparsers.add_parser('camera_http', help='Camera driver HTTP requests against a fake camera')
+    http_parser.add_argument('--requests', type=int, default=200)
+    http_parser.add_argument('--latency', type=float, default=0.002, help='Seconds the fake camera adds per request')
+    http_parser.set_defaults(func=benchmark_camera_http)
+
+    labels_parser = subparsers.add_parser('labels', help='Image label (position_datetime) parsing')
+    labels_parser.add_argument('--num_labels', type=int, default=1000000)
+    labels_parser.set_defaults(func=benchmark_labels)
+
+    attention_parser = subparsers.add_parser('attention', help='Fused vs materialized attention, with an equivalence check')
+    attention_parser.add_argument('--model', type=str, default='vit_tiny')
+    attention_parser.add_argument('--crop_size', type=int, default=224)
+    attention_parser.add_argument('--batch_size', type=int, default=32)
+    attention_parser.add_argument('--atol', type=float, default=1e-4)
+    attention_parser.set_defaults(func=benchmark_attention)
+
+    predictor_parser = subparsers.add_parser('predictor', help='Predictor token assembly and steps per pred_depth / pred_emb_dim')
+    predictor_parser.add_argument('--fname', type=str, default='configs/Config_file.yaml')
+    predictor_parser.add_argument('--predictor', type=str, default='vit_rssm', choices=['vit_rssm', 'vit_predictor'])
+    predictor_parser.add_argument('--batch_size', type=int, default=None, help='Pairs per step, default batch_size ** 2')
+    predictor_parser.add_argument('--pred_depth', type=int, nargs='+', default=None)
+    predictor_parser.add_argument('--pred_emb_dim', type=int, nargs='+', default=None)
+    predictor_parser.set_defaults(func=benchmark_predictor)
+
+    precision_parser = subparsers.add_parser('precision', help='Loss parity of mixed precision training against fp32')
+    precision_parser.add_argument('--model', type=str, default='vit_micro')
+    precision_parser.add_argument('--crop_size', type=int, default=64)
+    precision_parser.add_argument('--patch_size', type=int, default=16)
+    precision_parser.add_argument('--num_images', type=int, default=32)
+    precision_parser.add_argument('--batch_size', type=int, default=8)
+    precision_parser.add_argument('--steps', type=int, default=50)
+    precision_parser.add_argument('--precisions', type=str, nargs='+', default=['bf16', 'fp16'])
+    precision_parser.add_argument('--rtol', type=float, default=5e-2)
+    precision_parser.set_defaults(func=benchmark_precision)
+
+    return parser
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    args = get_argparser().parse_args()
+    args.func(args)
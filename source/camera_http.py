@@ -0,0 +1,64 @@
+"""
+Shared HTTP layer of the camera drivers
+"""
+import logging
+
+import requests
+from requests.adapters import HTTPAdapter
+from requests.auth import HTTPDigestAuth
+from urllib3.util.retry import Retry
+
+
+logger = logging.getLogger(__name__)
+
+# (connect, read) timeouts in seconds
+DEFAULT_TIMEOUT = (3.05, 10)
+
+
+def _make_retry(retries, backoff_factor):
+    if not retries:
+        # nothing is re-sent, not even on a read timeout or a 5xx
+        return Retry(total=0, connect=0, read=0, redirect=0, status_forcelist=(), raise_on_status=False)
+    kwargs = dict(total=retries,
+                  connect=retries,
+                  read=retries,
+                  backoff_factor=backoff_factor,
+                  status_forcelist=(500, 502, 503, 504),
+                  raise_on_status=False)
+    try:
+        return Retry(allowed_methods=frozenset(['GET']), **kwargs)
+    except TypeError:
+        # urllib3 < 1.26
+        return Retry(method_whitelist=frozenset(['GET']), **kwargs)
+
+
+class CameraSession(requests.Session):
+    """
+    Keep-alive session for one camera.
+
+    Connections are pooled and the digest auth object is kept for the life
+    of the session, so after the first 401 challenge later requests reuse
+    the cached nonce instead of paying a challenge round trip each. GETs
+    that fail to connect/read or return 5xx are retried with exponential
+    backoff, and every request gets DEFAULT_TIMEOUT unless one is given.
+
+    Only idempotent requests (position queries, snapshots) may go through a
+    retrying session: the PTZ control commands are GETs as well, and a
+    relative move that is re-sent after a read timeout moves the camera
+    twice. The drivers send those through a session with retries=0.
+    """
+
+    def __init__(self, user, password, timeout=DEFAULT_TIMEOUT, retries=3,
+                 backoff_factor=0.2, pool_maxsize=4):
+        super().__init__()
+        self.auth = HTTPDigestAuth(user, password)
+        self.timeout = timeout
+        adapter = HTTPAdapter(pool_connections=1,
+                              pool_maxsize=pool_maxsize,
+                              max_retries=_make_retry(retries, backoff_factor))
+        self.mount('http://', adapter)
+        self.mount('https://', adapter)
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault('timeout', self.timeout)
+        return super().request(method, url, **kwargs)
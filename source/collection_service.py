@@ -0,0 +1,403 @@
+"""
+Asyncio service collecting images from several PTZ cameras in one process
+"""
+import io
+import time
+import shutil
+import asyncio
+import datetime
+import functools
+import logging
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import torch
+import yaml
+from PIL import Image
+
+from source.helper import init_world_model, load_checkpoint
+from source.transforms import make_transforms
+from source.prepare_dataset import (
+    get_dirs,
+    get_camera_module,
+    random_position,
+    relative_move_values,
+    collect_images,
+    change_ownership,
+    validate_jpeg
+)
+
+
+logger = logging.getLogger(__name__)
+
+
+CameraSpec = namedtuple('CameraSpec', ('name', 'brand', 'ip', 'username', 'password'))
+
+Command = namedtuple('Command', ('kind', 'pan', 'tilt', 'zoom'))
+
+CapturedFrame = namedtuple('CapturedFrame', ('camera', 'label', 'jpeg'))
+
+
+class CameraFailed(RuntimeError):
+    pass
+
+
+def load_camera_specs(args):
+    """
+    Cameras to drive, from the YAML file given with --cameras: a list of
+    entries with name, brand, ip, username and password. Without it the
+    single camera of the command line is used.
+    """
+    if not getattr(args, 'cameras', None):
+        return [CameraSpec('camera0', args.camerabrand, args.cameraip, args.username, args.password)]
+    with open(args.cameras, 'r') as f:
+        entries = yaml.safe_load(f)
+    if isinstance(entries, dict):
+        entries = entries['cameras']
+    specs = []
+    for i, entry in enumerate(entries):
+        specs.append(CameraSpec(
+            name=str(entry.get('name', f'camera{i}')),
+            brand=int(entry.get('brand', args.camerabrand)),
+            ip=entry['ip'],
+            username=entry.get('username', args.username),
+            password=entry.get('password', args.password)))
+    names = [spec.name for spec in specs]
+    if len(set(names)) != len(names):
+        raise ValueError('Camera names must be unique: %s' % names)
+    return specs
+
+
+class SharedEncoder(object):
+    """
+    One encoder on one device shared by every camera.
+
+    Frames of all cameras are encoded together in batches from a single
+    thread, so the cameras never compete for the GPU.
+    """
+
+    def __init__(self, encoder, transform, device):
+        self.encoder = encoder.eval()
+        self.transform = transform
+        self.device = device
+        self.batches = 0
+
+    @torch.inference_mode()
+    def encode(self, jpegs):
+        """ :returns: [B, N, D] embeddings (on the cpu) of a list of JPEG images """
+        images = [self.transform(Image.open(io.BytesIO(jpeg)).convert('RGB')) for jpeg in jpegs]
+        batch = torch.stack(images).to(self.device, non_blocking=True)
+        self.batches += 1
+        return self.encoder(batch).cpu()
+
+
+def load_shared_encoder(fname, checkpoint):
+    """ Target encoder of a world model checkpoint, configured from `fname` """
+    with open(fname, 'r') as y_file:
+        params = yaml.load(y_file, Loader=yaml.FullLoader)
+    if not torch.cuda.is_available():
+        device = torch.device('cpu')
+    else:
+        device = torch.device('cuda:0')
+        torch.cuda.set_device(device)
+    target_encoder, _ = init_world_model(
+        device=device,
+        patch_size=params['mask']['patch_size'],
+        crop_size=params['data']['crop_size'],
+        pred_depth=params['meta']['pred_depth'],
+        pred_emb_dim=params['meta']['pred_emb_dim'],
+        model_arch=params['meta']['model_arch'],
+        fused_attention=params['meta'].get('fused_attention', False))
+    for p in target_encoder.parameters():
+        p.requires_grad = False
+    _, _, target_encoder, _, _, _ = load_checkpoint(
+        device=device,
+        r_path=checkpoint,
+        target_encoder=target_encoder)
+    transform = make_transforms(crop_size=params['data']['crop_size'],
+                                crop_scale=params['data']['crop_scale'])
+    return SharedEncoder(target_encoder, transform, device)
+
+
+class CameraWorker(object):
+    """
+    Drives one camera from its own command queue.
+
+    Driver calls are blocking, they run in a thread owned by the worker so
+    the commands of a camera stay in order while cameras run concurrently.
+    The queue is bounded: submit() waits while the camera is behind. After
+    `max_failures` consecutive failed commands the camera is marked failed,
+    its remaining commands are dropped and the other cameras carry on.
+    """
+
+    def __init__(self, spec, args, queue_size=8, max_failures=5):
+        self.spec = spec
+        self.name = spec.name
+        self.args = args
+        self.queue_size = queue_size
+        self.max_failures = max_failures
+        self.camera = None
+        self.queue = None
+        self.error = None
+        self.failures = 0
+        self.commands = 0
+        self.frames = 0
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix=f'ptz-{spec.name}')
+
+    @property
+    def failed(self):
+        return self.error is not None
+
+    async def _call(self, fn, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, functools.partial(fn, *args, **kwargs))
+
+    async def connect(self):
+        self.queue = asyncio.Queue(maxsize=self.queue_size)
+        try:
+            camera_control = get_camera_module(self.spec.brand)
+            self.camera = await self._call(
+                camera_control.CameraControl, self.spec.ip, self.spec.username, self.spec.password,
+                state_staleness=self.args.positionstaleness)
+        except Exception as e:
+            logger.error('Failed to connect to camera %s (%s): %s', self.name, self.spec.ip, e)
+            self.error = e
+
+    async def submit(self, command):
+        """ Queue a command, waits while the queue is full """
+        if self.failed:
+            raise CameraFailed(self.name)
+        await self.queue.put(command)
+
+    def _move(self, command):
+        if command.kind == 'reset':
+            pan, tilt, zoom = 1, 1, 1
+        else:
+            pan, tilt, zoom = command.pan, command.tilt, command.zoom
+        if command.kind == 'relative':
+            if self.spec.brand == 0:
+                self.camera.relative_control(pan=pan, tilt=tilt, zoom=zoom)
+            else:
+                self.camera.relative_move(rpan=pan, rtilt=tilt, rzoom=zoom)
+        elif self.spec.brand == 0:
+            self.camera.absolute_control(float(pan), float(tilt), float(zoom))
+        else:
+            self.camera.absolute_move(float(pan), float(tilt), int(zoom))
+
+    def _snapshot(self):
+        if self.spec.brand == 0:
+            position = self.camera.requesting_cameras_position_information()
+        else:
+            position = self.camera.get_ptz()
+        # ct stores current time
+        ct = datetime.datetime.now().strftime("%Y-%m-%d_%H:%M:%S.%f")
+        jpeg = validate_jpeg(self.camera.snap_shot_bytes())
+        if jpeg is None:
+            raise IOError('invalid JPEG from camera')
+        pos_str = ",".join([str(p) for p in position])
+        return CapturedFrame(self.name, f"{pos_str}_{ct}", jpeg)
+
+    def _execute(self, command):
+        if command.kind == 'snapshot':
+            return self._snapshot()
+        self._move(command)
+        return None
+
+    async def run(self, frames):
+        """ Executes queued commands until a None command, snapshots go to `frames` """
+        while True:
+            command = await self.queue.get()
+            try:
+                if command is None:
+                    return
+                if self.failed:
+                    continue
+                frame = await self._call(self._execute, command)
+                self.commands += 1
+                self.failures = 0
+                if frame is not None:
+                    self.frames += 1
+                    # -- waits while the writer/encoder is behind
+                    await frames.put(frame)
+            except Exception as e:
+                self.failures += 1
+                logger.error('Camera %s failed on %s: %s', self.name, command.kind, e)
+                if self.failures >= self.max_failures:
+                    self.error = e
+                    logger.error('Camera %s disabled after %d consecutive failures', self.name, self.failures)
+            finally:
+                self.queue.task_done()
+
+    def close(self):
+        self._executor.shutdown(wait=True)
+
+
+class CollectionService(object):
+    """
+    Collects images from N cameras concurrently.
+
+    Every camera has a producer generating its PTZ rounds (random position,
+    snapshot, then `movements` random relative moves each followed by a
+    snapshot) into the camera's bounded queue, and a CameraWorker
+    executing them. Snapshots go through one bounded frame queue to a
+    single sink writing the JPEGs to `tmp_dir/<camera name>/` and, with a
+    SharedEncoder, encoding them in batches across cameras.
+    """
+
+    def __init__(self, specs, args, encoder=None, queue_size=8, frame_queue_size=64,
+                 encode_batch_size=16, max_failures=5):
+        self.args = args
+        self.workers = [CameraWorker(spec, args, queue_size, max_failures) for spec in specs]
+        self.encoder = encoder
+        self.frame_queue_size = frame_queue_size
+        self.encode_batch_size = encode_batch_size
+        self.persis_dir, self.coll_dir, self.tmp_dir = get_dirs()
+        self.embeddings = {worker.name: ([], []) for worker in self.workers}
+        self._io_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix='ptz-writer')
+        self._gpu_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix='ptz-encoder')
+
+    def camera_dir(self, name):
+        return self.tmp_dir / name
+
+    async def _produce(self, worker, iterations, movements):
+        pan_values, tilt_values, zoom_values = relative_move_values(worker.spec.brand)
+        try:
+            await worker.submit(Command('reset', None, None, None))
+            for iteration in range(iterations):
+                await worker.submit(Command('absolute', *random_position(worker.spec.brand)))
+                await worker.submit(Command('snapshot', None, None, None))
+                PAN = np.random.choice(pan_values, movements)
+                TILT = np.random.choice(tilt_values, movements)
+                ZOOM = np.random.choice(zoom_values, movements)
+                for pan, tilt, zoom in zip(PAN, TILT, ZOOM):
+                    await worker.submit(Command('relative', pan, tilt, zoom))
+                    await worker.submit(Command('snapshot', None, None, None))
+            await worker.submit(Command('reset', None, None, None))
+        except CameraFailed:
+            logger.warning('Stopped producing commands for failed camera %s', worker.name)
+        finally:
+            await worker.queue.put(None)
+
+    def _write(self, frames):
+        for frame in frames:
+            with open(self.camera_dir(frame.camera) / f"{frame.label}.jpg", 'wb') as f:
+                f.write(frame.jpeg)
+
+    async def _flush(self, frames):
+        loop = asyncio.get_running_loop()
+        tasks = [loop.run_in_executor(self._io_pool, self._write, frames)]
+        if self.encoder is not None:
+            tasks.append(loop.run_in_executor(self._gpu_pool, self.encoder.encode, [f.jpeg for f in frames]))
+        results = await asyncio.gather(*tasks, return_exceptions=True)
+        for result in results:
+            if isinstance(result, Exception):
+                logger.error('Failed to store %d frames: %s', len(frames), result)
+        if self.encoder is not None and not isinstance(results[1], Exception):
+            for frame, embed in zip(frames, results[1]):
+                labels, embeds = self.embeddings[frame.camera]
+                labels.append(frame.label)
+                embeds.append(embed)
+
+    async def _sink(self, frames):
+        done = False
+        while not done:
+            batch = [await frames.get()]
+            # -- take what is already queued, up to a batch
+            while len(batch) < self.encode_batch_size and not frames.empty():
+                batch.append(frames.get_nowait())
+            if batch[-1] is None:
+                done = True
+                batch.pop()
+            if batch:
+                await self._flush(batch)
+
+    async def run(self, iterations, movements):
+        """ :returns: dict of camera name to number of commands, frames and error """
+        start = time.time()
+        for worker in self.workers:
+            self.camera_dir(worker.name).mkdir(exist_ok=True, mode=0o777, parents=True)
+        await asyncio.gather(*[worker.connect() for worker in self.workers])
+        frames = asyncio.Queue(maxsize=self.frame_queue_size)
+        sink = asyncio.ensure_future(self._sink(frames))
+        active = [worker for worker in self.workers if not worker.failed]
+        await asyncio.gather(*[self._produce(worker, iterations, movements) for worker in active],
+                             *[worker.run(frames) for worker in active])
+        await frames.put(None)
+        await sink
+        elapsed = time.time() - start
+        stats = {}
+        for worker in self.workers:
+            stats[worker.name] = dict(commands=worker.commands, frames=worker.frames,
+                                      error=None if worker.error is None else str(worker.error))
+            logger.info('camera %s: %d commands, %d frames in %.1f s%s', worker.name, worker.commands,
+                        worker.frames, elapsed, ' (failed: %s)' % worker.error if worker.failed else '')
+            waiter = getattr(worker.camera, 'waiter', None)
+            if waiter is not None:
+                logger.info('camera %s settle times %s', worker.name, waiter.settle_times.summary())
+        if self.encoder is not None:
+            logger.info('%d encoder batches', self.encoder.batches)
+        return stats
+
+    def save_embeddings(self):
+        cur_time = datetime.datetime.now().strftime("%Y-%m-%d_%H:%M:%S.%f")
+        for name, (labels, embeds) in self.embeddings.items():
+            if not embeds:
+                continue
+            directory = self.persis_dir / "collected_embeds" / name
+            directory.mkdir(exist_ok=True, mode=0o777, parents=True)
+            torch.save({'labels': labels, 'embeds': torch.stack(embeds)},
+                       directory / f"embeds_at_{cur_time}.pt")
+            change_ownership(directory)
+
+    def collect(self, keepimages):
+        """
+        Moves the images of each camera from its tmp_dir/<camera name> into
+        coll_dir (and persistence collected_imgs), flat like the single
+        camera collection, which is where the datasets and pack_images look
+        """
+        num_image = 0
+        for worker in self.workers:
+            num_image += collect_images(
+                keepimages,
+                src_dir=self.camera_dir(worker.name),
+                dst_dir=self.coll_dir,
+                keep_dir=self.persis_dir / "collected_imgs")
+            shutil.rmtree(self.camera_dir(worker.name), ignore_errors=True)
+        return num_image
+
+    def close(self):
+        for worker in self.workers:
+            worker.close()
+        self._io_pool.shutdown(wait=True)
+        self._gpu_pool.shutdown(wait=True)
+
+
+def operate_ptz_cluster(args):
+    """
+    Runs args.iterations rounds of args.movements random moves on every
+    camera of load_camera_specs(args) concurrently.
+    """
+    with open(args.fname, 'r') as y_file:
+        params = yaml.load(y_file, Loader=yaml.FullLoader)
+    collection = params.get('collection', {})
+    encoder = None
+    if getattr(args, 'encodercheckpoint', ''):
+        encoder = load_shared_encoder(args.fname, args.encodercheckpoint)
+    specs = load_camera_specs(args)
+    logger.info('Collecting from %d cameras: %s', len(specs), ', '.join(spec.name for spec in specs))
+    service = CollectionService(
+        specs, args, encoder=encoder,
+        queue_size=collection.get('queue_size', 8),
+        frame_queue_size=collection.get('frame_queue_size', 64),
+        encode_batch_size=collection.get('encode_batch_size', 16),
+        max_failures=collection.get('max_failures', 5))
+    try:
+        stats = asyncio.run(service.run(args.iterations, args.movements))
+        num_image = service.collect(args.keepimages)
+        if encoder is not None:
+            service.save_embeddings()
+    finally:
+        service.close()
+    logger.info('Collected %d images', num_image)
+    return stats
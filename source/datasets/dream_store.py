@@ -0,0 +1,213 @@
+import os
+import json
+import fcntl
+from contextlib import contextmanager
+from pathlib import Path
+
+import numpy as np
+
+
+INDEX_FILE = 'dream_index.json'
+LOCK_FILE = '.write.lock'
+
+
+class DreamStore(object):
+    """
+    Sharded on-disk storage of fixed-shape dreams.
+
+    Every field of a dream (state_sequence, position_sequence, ...) is kept in
+    .npy shards of `shard_size` dreams, shard k of field f being
+    `shard{k:04d}-{f}.npy`. Rows are only ever appended; a dream slot is
+    overwritten by appending the new dream and re-pointing the slot in the
+    index, which is rewritten atomically after the rows are flushed.
+    Readers memory-map the shards, so rows are served without copies.
+
+    Overwritten rows are garbage: once the store holds `compact_ratio` times
+    more rows than live slots (and more than a shard), the live rows are
+    copied into the shards of a new generation and the shards two
+    generations old are deleted (the previous generation is kept for
+    readers still holding the old index). Writers take an exclusive lock
+    on the directory and reload the index first, so processes sharing a
+    store append after each other instead of over each other.
+
+    dream_index.json:
+        fields:     {name: {shape: per-dream shape, dtype: numpy dtype}}
+        shard_size: dreams per shard
+        num_rows:   rows written so far (shard = row // shard_size)
+        slots:      {slot id: row}
+        generation: shard file generation (0 if missing)
+    """
+
+    index_file = INDEX_FILE
+    compact_ratio = 2.
+    reload_on_write = True
+
+    def __init__(self, root, index):
+        self.root = Path(root)
+        self.index = index
+        self._shards = {}
+
+    @classmethod
+    def exists(cls, root):
+        return (Path(root) / cls.index_file).is_file()
+
+    @classmethod
+    def open(cls, root):
+        with open(Path(root) / cls.index_file, 'r') as f:
+            index = json.load(f)
+        return cls(root, index)
+
+    @classmethod
+    def open_or_create(cls, root, shard_size=1024):
+        if cls.exists(root):
+            return cls.open(root)
+        Path(root).mkdir(parents=True, exist_ok=True)
+        index = {'fields': None, 'shard_size': int(shard_size), 'num_rows': 0, 'slots': {}}
+        return cls(root, index)
+
+    def __len__(self):
+        return len(self.index['slots'])
+
+    @property
+    def fields(self):
+        return list(self.index['fields'] or [])
+
+    def slots(self):
+        """ :returns: sorted slot ids with a dream """
+        return sorted(int(s) for s in self.index['slots'])
+
+    def _shard_path(self, shard, name, generation=None):
+        if generation is None:
+            generation = self.index.get('generation', 0)
+        if generation == 0:
+            return self.root / f'shard{shard:04d}-{name}.npy'
+        return self.root / f'g{generation}-shard{shard:04d}-{name}.npy'
+
+    def _shard(self, shard, name, mode):
+        key = (self.index.get('generation', 0), shard, name, 'r+' if mode == 'w+' else mode)
+        if key not in self._shards:
+            path = self._shard_path(shard, name)
+            if mode == 'w+':
+                field = self.index['fields'][name]
+                shape = (self.index['shard_size'],) + tuple(field['shape'])
+                array = np.lib.format.open_memmap(path, mode='w+', dtype=np.dtype(field['dtype']), shape=shape)
+            else:
+                array = np.load(path, mmap_mode=mode)
+            self._shards[key] = array
+        return self._shards[key]
+
+    def _set_fields(self, dreams):
+        fields = {name: {'shape': list(array.shape[1:]), 'dtype': array.dtype.str}
+                  for name, array in dreams.items()}
+        if self.index['fields'] is None:
+            self.index['fields'] = fields
+        elif fields != self.index['fields']:
+            raise ValueError(f'Dream fields {fields} do not match the store {self.index["fields"]}')
+
+    @contextmanager
+    def writer_lock(self, reload=True):
+        """ Exclusive lock of the store directory, reloading the index by default """
+        self.root.mkdir(parents=True, exist_ok=True)
+        with open(self.root / LOCK_FILE, 'a') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                # -- another process may have written since this index was read
+                if reload and self.exists(self.root):
+                    with open(self.root / self.index_file, 'r') as index_file:
+                        self.index = json.load(index_file)
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def write(self, slot_ids, dreams):
+        """
+        Append a batch of dreams and point `slot_ids` at them.
+
+        :param slot_ids: sequence of B slot ids (later ids win on duplicates)
+        :param dreams: dict name -> array [B, ...] with the dreams along dim 0
+        """
+        dreams = {name: np.ascontiguousarray(array) for name, array in dreams.items()}
+        with self.writer_lock(reload=self.reload_on_write):
+            self._write(slot_ids, dreams)
+            if self._needs_compaction():
+                self.compact()
+
+    def _write(self, slot_ids, dreams):
+        self._set_fields(dreams)
+        shard_size = self.index['shard_size']
+        num_rows = self.index['num_rows']
+        B = len(slot_ids)
+
+        written = 0
+        while written < B:
+            shard, offset = divmod(num_rows + written, shard_size)
+            count = min(B - written, shard_size - offset)
+            mode = 'w+' if offset == 0 else 'r+'
+            for name, array in dreams.items():
+                out = self._shard(shard, name, mode)
+                out[offset:offset + count] = array[written:written + count]
+                out.flush()
+            written += count
+
+        for i, slot in enumerate(slot_ids):
+            self.index['slots'][str(int(slot))] = num_rows + i
+        self.index['num_rows'] = num_rows + B
+        self._write_index()
+
+    def _needs_compaction(self):
+        if not self.compact_ratio:
+            return False
+        live = max(len(self.index['slots']), self.index['shard_size'])
+        return self.index['num_rows'] >= self.compact_ratio * live
+
+    def compact(self):
+        """ Copies the live rows into new shards and drops old generations (call under the writer lock) """
+        shard_size = self.index['shard_size']
+        generation = self.index.get('generation', 0)
+        slots = sorted(self.index['slots'].items(), key=lambda item: item[1])
+        rows = np.array([row for _, row in slots], dtype=np.int64)
+        new_index = dict(self.index, generation=generation + 1, num_rows=len(rows),
+                         slots={slot: i for i, (slot, _) in enumerate(slots)})
+        for start in range(0, len(rows), shard_size):
+            chunk = rows[start:start + shard_size]
+            for name, field in self.index['fields'].items():
+                out = np.lib.format.open_memmap(
+                    self._shard_path(start // shard_size, name, generation + 1), mode='w+',
+                    dtype=np.dtype(field['dtype']), shape=(shard_size,) + tuple(field['shape']))
+                for i, row in enumerate(chunk):
+                    shard, offset = divmod(int(row), shard_size)
+                    out[i] = self._shard(shard, name, 'r')[offset]
+                out.flush()
+                del out
+        self._shards = {}
+        self.index = new_index
+        self._write_index()
+        # -- readers may still use the previous generation, drop the one before
+        if generation >= 1:
+            prefix = 'shard' if generation == 1 else f'g{generation - 1}-shard'
+            for path in self.root.glob(f'{prefix}*.npy'):
+                path.unlink()
+
+    def _write_index(self):
+        path = self.root / self.index_file
+        tmp_path = self.root / f'.{self.index_file}.{os.getpid()}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self.index, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+
+    def read(self, slot):
+        """ :returns: dict name -> memory-mapped array of one dream (copy-on-write) """
+        row = self.index['slots'][str(int(slot))]
+        shard, offset = divmod(row, self.index['shard_size'])
+        return {name: self._shard(shard, name, 'c')[offset] for name in self.fields}
+
+    def close(self):
+        self._shards = {}
+
+    def __getstate__(self):
+        # -- don't pickle the mapped shards into DataLoader workers
+        state = self.__dict__.copy()
+        state['_shards'] = {}
+        return state
@@ -5,6 +5,8 @@ from torchvision.io import read_image
 from PIL import Image 
 from torch.utils.data import Dataset
 
+from source.datasets.dream_store import DreamStore
+
 class DreamDataset(Dataset):
     def __init__(self, dream_dir):
         self.dream_dir = dream_dir
@@ -23,3 +25,26 @@ class DreamDataset(Dataset):
         return dream
 
 
+
+
+class DreamShardDataset(Dataset):
+    """ Dreams served zero-copy from the memory-mapped shards of a DreamStore """
+
+    def __init__(self, dream_dir):
+        self.dream_dir = dream_dir
+        self.store = DreamStore.open(dream_dir)
+        self.dream_slots = self.store.slots()
+
+    def __len__(self):
+        return len(self.dream_slots)
+
+    def __getitem__(self, idx):
+        dream = self.store.read(self.dream_slots[idx])
+        return {key: torch.from_numpy(value) for key, value in dream.items()}
+
+
+def make_dream_dataset(dream_dir):
+    """ Sharded dreams if the folder has a dream index, one file per dream otherwise """
+    if DreamStore.exists(dream_dir):
+        return DreamShardDataset(dream_dir)
+    return DreamDataset(dream_dir)
@@ -0,0 +1,176 @@
+import os
+import csv
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+from pathlib import Path
+
+import torch
+
+
+logger = logging.getLogger(__name__)
+
+
+MANIFEST_FILE = 'manifest.csv'
+
+
+def transform_fingerprint(transform):
+    """ :returns: short hash of the repr of a transform (its steps and their parameters) """
+    return hashlib.sha1(repr(transform).encode()).hexdigest()[:16]
+
+
+class FrameCache(object):
+    """
+    Content-addressed cache of transformed input tensors.
+
+    Entries are keyed by the SHA-1 of the image file and the fingerprint of
+    the transform, so a renamed image hits and a changed transform misses.
+    Checksums come from the ImageCatalog manifest of the image directory
+    when there is one, otherwise the file is hashed. Tensors are kept in an
+    in-process LRU under `max_ram_bytes` and in `cache_dir` (one .pt file
+    per entry, written atomically so DataLoader workers can share it) under
+    `max_disk_bytes`, least recently used entries are evicted first.
+
+    The disk usage is taken from the directory, which DataLoader workers
+    and other trainers write to as well: it is rescanned whenever this
+    process has written `rescan_bytes` (default 1/64 of the budget) since
+    the last scan, so N processes overrun the budget by at most about N
+    times `rescan_bytes`.
+
+    Random augmentations are frozen per cached entry, the cache is meant
+    for passes that only need one view of every image (dreams, embeddings).
+    """
+
+    def __init__(self, cache_dir, transform_key, max_ram_bytes=2 << 30, max_disk_bytes=20 << 30,
+                 rescan_bytes=None):
+        self.cache_dir = Path(cache_dir)
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.transform_key = transform_key
+        self.max_ram_bytes = max_ram_bytes
+        self.max_disk_bytes = max_disk_bytes
+        self.rescan_bytes = max_disk_bytes // 64 if rescan_bytes is None else rescan_bytes
+        self._written = 0
+        self.ram = OrderedDict()
+        self.ram_bytes = 0
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self._checksums = {}
+        self._disk = None
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        # -- DataLoader workers start with an empty RAM cache, they share the disk
+        state = self.__dict__.copy()
+        state['ram'] = OrderedDict()
+        state['ram_bytes'] = 0
+        state['_disk'] = None
+        state['_written'] = 0
+        state['_lock'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def _load_checksums(self, img_dir):
+        checksums = {}
+        manifest = Path(img_dir) / MANIFEST_FILE
+        if manifest.is_file():
+            with open(manifest, 'r', newline='') as f:
+                for row in csv.DictReader(f):
+                    checksums[row['label']] = row['checksum']
+        self._checksums[str(img_dir)] = checksums
+        return checksums
+
+    def checksum(self, img_path):
+        img_path = Path(img_path)
+        checksums = self._checksums.get(str(img_path.parent))
+        if checksums is None:
+            checksums = self._load_checksums(img_path.parent)
+        checksum = checksums.get(img_path.stem)
+        if checksum is None:
+            with open(img_path, 'rb') as f:
+                checksum = hashlib.sha1(f.read()).hexdigest()
+        return checksum
+
+    def _disk_entries(self):
+        # -- {file name: size}, oldest access first
+        if self._disk is None:
+            files = []
+            with os.scandir(self.cache_dir) as it:
+                for entry in it:
+                    if entry.name.endswith('.pt'):
+                        stat = entry.stat()
+                        files.append((stat.st_mtime, entry.name, stat.st_size))
+            self._disk = OrderedDict((name, size) for _, name, size in sorted(files))
+        return self._disk
+
+    def _evict_disk(self):
+        entries = self._disk_entries()
+        total = sum(entries.values())
+        while total > self.max_disk_bytes and entries:
+            name, size = entries.popitem(last=False)
+            try:
+                (self.cache_dir / name).unlink()
+            except FileNotFoundError:
+                pass
+            total -= size
+
+    def _put_ram(self, key, tensor):
+        nbytes = tensor.element_size() * tensor.nelement()
+        if nbytes > self.max_ram_bytes:
+            return
+        self.ram[key] = tensor
+        self.ram_bytes += nbytes
+        while self.ram_bytes > self.max_ram_bytes:
+            _, old = self.ram.popitem(last=False)
+            self.ram_bytes -= old.element_size() * old.nelement()
+
+    def get(self, img_path, compute):
+        """
+        :param img_path: image file the tensor is computed from
+        :param compute: callable returning the transformed tensor on a miss
+        :returns: the cached or computed tensor
+        """
+        key = f'{self.checksum(img_path)}-{self.transform_key}'
+        with self._lock:
+            tensor = self.ram.get(key)
+            if tensor is not None:
+                self.ram.move_to_end(key)
+                self.hits += 1
+                return tensor
+        path = self.cache_dir / f'{key}.pt'
+        try:
+            tensor = torch.load(path)
+            # -- mtime is the access time of the disk LRU
+            os.utime(path)
+            with self._lock:
+                self.disk_hits += 1
+                entries = self._disk_entries()
+                entries[path.name] = entries.pop(path.name, path.stat().st_size)
+                self._put_ram(key, tensor)
+            return tensor
+        except (FileNotFoundError, EOFError, RuntimeError):
+            pass
+        tensor = compute()
+        tmp_path = self.cache_dir / f'.{key}.{os.getpid()}.tmp'
+        torch.save(tensor.clone(), tmp_path)
+        os.replace(tmp_path, path)
+        size = path.stat().st_size
+        with self._lock:
+            self.misses += 1
+            self._written += size
+            if self._written >= self.rescan_bytes:
+                # -- pick up the entries other processes wrote (and evicted) meanwhile
+                self._disk = None
+                self._written = 0
+            self._disk_entries()[path.name] = size
+            self._evict_disk()
+            self._put_ram(key, tensor)
+        return tensor
+
+    def summary(self):
+        return '%d RAM hits, %d disk hits, %d misses, %.1f MB in RAM' % (
+            self.hits, self.disk_hits, self.misses, self.ram_bytes / 1024.**2)
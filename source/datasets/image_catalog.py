@@ -0,0 +1,276 @@
+import io
+import os
+import csv
+import errno
+import shutil
+import hashlib
+import logging
+from pathlib import Path
+
+from PIL import Image, ImageFile
+
+
+logger = logging.getLogger(__name__)
+
+
+MANIFEST_FILE = 'manifest.csv'
+MANIFEST_FIELDS = ('label', 'pan', 'tilt', 'zoom', 'timestamp', 'size', 'checksum')
+
+JPEG_SOI = b"\xff\xd8"
+JPEG_EOI = b"\xff\xd9"
+
+
+def validate_jpeg(data, try_fix=True):
+    """
+    Validates JPEG bytes in memory.
+
+    Args:
+        data (bytes): The JPEG image.
+        try_fix (bool): Whether to re-encode a truncated image. Default is True.
+
+    Returns:
+        bytes: `data` itself if it is a valid JPEG, a re-encoded copy if it was
+            truncated and could be fixed, None otherwise.
+    """
+    if not data or not data.startswith(JPEG_SOI):
+        return None
+    # -- a complete JPEG ends with the EOI marker (cameras may pad with zeros)
+    truncated = not data.rstrip(b"\x00").endswith(JPEG_EOI)
+    try:
+        if not truncated:
+            Image.open(io.BytesIO(data)).verify()
+            return data
+        if not try_fix:
+            return None
+        load_truncated = ImageFile.LOAD_TRUNCATED_IMAGES
+        ImageFile.LOAD_TRUNCATED_IMAGES = True
+        try:
+            image = Image.open(io.BytesIO(data))
+            image.load()
+        finally:
+            ImageFile.LOAD_TRUNCATED_IMAGES = load_truncated
+        buf = io.BytesIO()
+        image.save(buf, format="JPEG")
+        logger.warning("Re-encoded a truncated JPEG")
+        return buf.getvalue()
+    except (OSError, IOError, SyntaxError) as e:
+        logger.error("Invalid JPEG: %s", e)
+        return None
+
+
+def write_image(data, fpath):
+    """
+    Writes the image bytes to `fpath` as a new file, through a temporary
+    file in the same directory. The old file is replaced instead of
+    rewritten in place, so hard links to it (persistence copies) keep
+    their content and stay in line with their manifest.
+    """
+    fpath = Path(fpath)
+    tmp_path = fpath.with_name(f".{fpath.name}.{os.getpid()}.tmp")
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+    os.replace(tmp_path, fpath)
+
+
+def link_or_copy(fpath, directory):
+    """
+    Hard-links `fpath` into `directory`, copying it only when the directory
+    is on another filesystem.
+
+    Returns:
+        Path: The linked (or copied) file.
+    """
+    dest = Path(directory) / Path(fpath).name
+    try:
+        os.link(fpath, dest)
+    except FileExistsError:
+        pass
+    except OSError as e:
+        if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK):
+            raise
+        shutil.copy(fpath, dest)
+    return dest
+
+
+def _parse_label(label):
+    # 99.99,-92.39,232.0_2024-06-21_04:51:47.291323
+    position, _, timestamp = label.partition("_")
+    try:
+        pan, tilt, zoom = position.split(",")
+    except ValueError:
+        pan, tilt, zoom = "nan", "nan", "nan"
+    return pan, tilt, zoom, timestamp
+
+
+class ImageCatalog(object):
+    """
+    Incremental catalog of the JPEG images of a directory.
+
+    `manifest.csv` in the directory holds one row per image (label, pan,
+    tilt, zoom, timestamp, size and checksum). Images are validated once,
+    when they are added; rows are only appended, the manifest is rewritten
+    (atomically) only when images disappear. sync() catches up with the
+    directory by looking at file names only, so a catalog of N images with
+    k new ones costs a listing plus k reads.
+
+    Subsets are handed to training with link_into(), which mirrors them
+    into another directory with hard links instead of copies.
+    """
+
+    def __init__(self, root):
+        self.root = Path(root)
+        self.manifest_path = self.root / MANIFEST_FILE
+        self.entries = {}
+        self._load()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, label):
+        return label in self.entries
+
+    def _load(self):
+        if not self.manifest_path.is_file():
+            return
+        with open(self.manifest_path, "r", newline="") as f:
+            for row in csv.DictReader(f):
+                self.entries[row["label"]] = row
+
+    def _append(self, rows):
+        new_file = not self.manifest_path.is_file()
+        with open(self.manifest_path, "a", newline="") as f:
+            writer = csv.DictWriter(f, fieldnames=MANIFEST_FIELDS)
+            if new_file:
+                writer.writeheader()
+            writer.writerows(rows)
+
+    def _rewrite(self):
+        tmp_path = self.manifest_path.with_suffix(".tmp")
+        with open(tmp_path, "w", newline="") as f:
+            writer = csv.DictWriter(f, fieldnames=MANIFEST_FIELDS)
+            writer.writeheader()
+            writer.writerows(self.entries.values())
+        os.replace(tmp_path, self.manifest_path)
+
+    def _row(self, label, data):
+        pan, tilt, zoom, timestamp = _parse_label(label)
+        return {
+            "label": label,
+            "pan": pan,
+            "tilt": tilt,
+            "zoom": zoom,
+            "timestamp": timestamp,
+            "size": len(data),
+            "checksum": hashlib.sha1(data).hexdigest(),
+        }
+
+    def add(self, fpaths, verify=True):
+        """
+        Appends images of the catalog directory to the manifest.
+
+        Args:
+            fpaths: Image paths (or names) in the catalog directory.
+            verify (bool): Validate the images, invalid ones are deleted and
+                truncated ones re-encoded. Default is True.
+
+        Returns:
+            int: The number of images added.
+        """
+        rows = []
+        for fpath in fpaths:
+            fpath = self.root / Path(fpath).name
+            label = fpath.stem
+            if label in self.entries:
+                continue
+            try:
+                with open(fpath, "rb") as f:
+                    data = f.read()
+            except OSError as e:
+                logger.error("Error: %s : %s", fpath, e.strerror)
+                continue
+            if verify:
+                fixed = validate_jpeg(data)
+                if fixed is None:
+                    logger.error("Removing invalid image %s", fpath)
+                    fpath.unlink()
+                    continue
+                if fixed is not data:
+                    # only truncated images are re-encoded
+                    write_image(fixed, fpath)
+                    data = fixed
+            row = self._row(label, data)
+            self.entries[label] = row
+            rows.append(row)
+        if rows:
+            self._append(rows)
+        return len(rows)
+
+    def sync(self, verify=True):
+        """
+        Adds the images of the directory missing from the manifest and drops
+        the rows of deleted images.
+
+        Returns:
+            tuple: The number of images added and removed.
+        """
+        if not self.root.is_dir():
+            return 0, 0
+        with os.scandir(self.root) as it:
+            names = {entry.name[:-len(".jpg")] for entry in it if entry.name.endswith(".jpg")}
+        removed = [label for label in self.entries if label not in names]
+        for label in removed:
+            del self.entries[label]
+        if removed:
+            self._rewrite()
+        added = self.add([f"{label}.jpg" for label in sorted(names - self.entries.keys())], verify=verify)
+        logger.info("Image catalog %s: %d images (%d added, %d removed)",
+                    self.root, len(self), added, len(removed))
+        return added, len(removed)
+
+    def labels(self):
+        """ :returns: labels of the catalog sorted by timestamp """
+        return sorted(self.entries, key=lambda label: self.entries[label]["timestamp"])
+
+    def select(self, since=None, until=None, limit=None):
+        """
+        Args:
+            since (str): Oldest timestamp (same format as the labels) to keep.
+            until (str): Newest timestamp to keep.
+            limit (int): Keep only the most recent `limit` images.
+
+        Returns:
+            list: The selected labels sorted by timestamp.
+        """
+        labels = self.labels()
+        if since is not None:
+            labels = [label for label in labels if self.entries[label]["timestamp"] >= since]
+        if until is not None:
+            labels = [label for label in labels if self.entries[label]["timestamp"] <= until]
+        if limit:
+            labels = labels[-limit:]
+        return labels
+
+    def link_into(self, directory, labels=None):
+        """
+        Makes `directory` hold exactly the `labels` images (default all) as
+        hard links, and writes their rows as its manifest. Images already
+        linked are kept, images not selected are removed.
+
+        Returns:
+            int: The number of images in `directory`.
+        """
+        directory = Path(directory)
+        directory.mkdir(exist_ok=True, mode=0o777, parents=True)
+        labels = self.labels() if labels is None else labels
+        selected = set(labels)
+        with os.scandir(directory) as it:
+            present = {entry.name[:-len(".jpg")] for entry in it if entry.name.endswith(".jpg")}
+        for label in present - selected:
+            (directory / f"{label}.jpg").unlink()
+        for label in labels:
+            if label not in present:
+                link_or_copy(self.root / f"{label}.jpg", directory)
+        catalog = ImageCatalog(directory)
+        catalog.entries = {label: self.entries[label] for label in labels}
+        catalog._rewrite()
+        return len(labels)
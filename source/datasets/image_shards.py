@@ -0,0 +1,241 @@
+import io
+import logging
+import datetime
+
+import numpy as np
+import torch
+from PIL import Image
+from torch.utils.data import Dataset, DataLoader
+
+from source.datasets.dream_store import DreamStore
+from source.datasets.image_catalog import ImageCatalog
+from source.datasets.ptz_dataset import PTZImageDataset
+
+
+logger = logging.getLogger(__name__)
+
+
+IMAGE_INDEX_FILE = 'image_index.json'
+
+
+class ImageShardStore(DreamStore):
+    """
+    Packed PTZ images in memory-mapped .npy shards.
+
+    Same layout as a DreamStore, with one row per image and the fields
+        image:     uint8 [H, W, 3] pixels (decoded) or
+        jpeg:      uint8 [max_jpeg_bytes] JPEG bytes, jpeg_size: int32 length
+        position:  float32 [3] pan, tilt, zoom
+        timestamp: int64 microseconds since epoch (UTC)
+    and the index also maps each label to its row (`labels`) and records
+    the packed image size and whether pixels are decoded.
+    """
+
+    index_file = IMAGE_INDEX_FILE
+    # -- rows are never overwritten and `labels` points at them
+    compact_ratio = None
+    # -- pack_images sets the labels of the rows in the index before writing them
+    reload_on_write = False
+
+    @property
+    def labels(self):
+        return self.index.setdefault('labels', {})
+
+    def column(self, name):
+        """ :returns: array [num_rows, ...] of a field, row-ordered """
+        shard_size = self.index['shard_size']
+        num_rows = self.index['num_rows']
+        parts = []
+        for shard in range((num_rows + shard_size - 1) // shard_size):
+            count = min(shard_size, num_rows - shard * shard_size)
+            parts.append(np.asarray(self._shard(shard, name, 'r')[:count]))
+        return np.concatenate(parts)
+
+    def read_row(self, row, name):
+        shard, offset = divmod(row, self.index['shard_size'])
+        return self._shard(shard, name, 'r')[offset]
+
+
+def _parse_timestamp(timestamp):
+    date_time = datetime.datetime.strptime(timestamp, "%Y-%m-%d_%H:%M:%S.%f")
+    epoch = datetime.datetime(1970, 1, 1)
+    return (date_time - epoch) // datetime.timedelta(microseconds=1)
+
+
+def _packed_size(width, height, size):
+    # -- short side to `size`, keeping the aspect ratio so random resized
+    # -- crops cover the same field of view as on the original image
+    scale = size / min(width, height)
+    return max(size, round(width * scale)), max(size, round(height * scale))
+
+
+def _load_resized(fpath, size):
+    image = Image.open(fpath)
+    # -- let the JPEG decoder downscale while decoding
+    image.draft('RGB', (size[0], size[1]))
+    return image.convert('RGB').resize(size, Image.BICUBIC)
+
+
+def pack_images(img_dir, shard_dir, size=224, decoded=True, shard_size=1024,
+                max_jpeg_bytes=1 << 16, quality=90):
+    """
+    Appends the images of `img_dir` missing from the shards of `shard_dir`.
+
+    Images are resized to a short side of `size` and stored as uint8 pixels
+    (decoded) or re-encoded JPEG bytes of at most `max_jpeg_bytes` (the
+    quality is lowered down to 30 to fit, ValueError if it still does not);
+    positions and timestamps come from the labels. Packing is incremental,
+    images already packed are skipped.
+
+    The whole packing holds the writer lock of the store: processes packing
+    the same `shard_dir` (e.g. several trainers sharing persistence) wait
+    for each other and then find the images already packed.
+
+    Returns:
+        ImageShardStore: The store of `shard_dir`.
+    """
+    store = ImageShardStore.open_or_create(shard_dir, shard_size)
+    catalog = ImageCatalog(img_dir)
+    catalog.sync()
+    with store.writer_lock():
+        _pack(store, catalog, size, decoded, shard_size, max_jpeg_bytes, quality)
+    return store
+
+
+def _encode_jpeg(image, label, max_jpeg_bytes, quality):
+    q = quality
+    while True:
+        buf = io.BytesIO()
+        image.save(buf, format='JPEG', quality=q)
+        data = buf.getvalue()
+        if len(data) <= max_jpeg_bytes:
+            return data
+        if q <= 30:
+            raise ValueError(f'{label} takes {len(data)} JPEG bytes at quality {q}, '
+                             f'more than max_jpeg_bytes={max_jpeg_bytes}')
+        q -= 10
+
+
+def _pack(store, catalog, size, decoded, shard_size, max_jpeg_bytes, quality):
+    """ pack_images under the writer lock, rows are written with DreamStore._write """
+    shard_dir = store.root
+    if store.index['fields'] is not None and store.index.get('decoded') != decoded:
+        raise ValueError(f'{shard_dir} holds decoded={store.index.get("decoded")} images')
+    if not decoded and store.index['fields'] is not None:
+        # -- the row width of the existing shards
+        max_jpeg_bytes = store.index['fields']['jpeg']['shape'][0]
+    labels = [label for label in catalog.labels() if label not in store.labels]
+    if not labels:
+        return
+
+    packed_size = store.index.get('image_size')
+    for start in range(0, len(labels), shard_size):
+        chunk = labels[start:start + shard_size]
+        if packed_size is None:
+            with Image.open(catalog.root / f"{chunk[0]}.jpg") as first:
+                packed_size = _packed_size(first.width, first.height, size)
+            store.index['image_size'] = list(packed_size)
+            store.index['decoded'] = decoded
+        fields = {
+            'position': np.empty((len(chunk), 3), dtype=np.float32),
+            'timestamp': np.empty((len(chunk),), dtype=np.int64),
+        }
+        if decoded:
+            fields['image'] = np.empty((len(chunk), packed_size[1], packed_size[0], 3), dtype=np.uint8)
+        else:
+            fields['jpeg'] = np.zeros((len(chunk), max_jpeg_bytes), dtype=np.uint8)
+            fields['jpeg_size'] = np.empty((len(chunk),), dtype=np.int32)
+        for i, label in enumerate(chunk):
+            entry = catalog.entries[label]
+            fields['position'][i] = (float(entry['pan']), float(entry['tilt']), float(entry['zoom']))
+            fields['timestamp'][i] = _parse_timestamp(entry['timestamp'])
+            image = _load_resized(catalog.root / f"{label}.jpg", tuple(packed_size))
+            if decoded:
+                fields['image'][i] = np.asarray(image)
+                continue
+            data = _encode_jpeg(image, label, max_jpeg_bytes, quality)
+            fields['jpeg'][i, :len(data)] = np.frombuffer(data, dtype=np.uint8)
+            fields['jpeg_size'][i] = len(data)
+        first_row = store.index['num_rows']
+        for i, label in enumerate(chunk):
+            store.labels[label] = first_row + i
+        store._write(list(range(first_row, first_row + len(chunk))), fields)
+    logger.info('Packed %d images into %s (%d total)', len(labels), shard_dir, len(store.labels))
+
+
+class PTZShardDataset(Dataset):
+    """
+    PTZImageDataset served from an ImageShardStore.
+
+    Pixels (or small JPEGs) are read from the memory-mapped shards, so a
+    sample costs a slice (or the decode of a 224-pixel JPEG) instead of
+    opening and decoding the full camera image. Samples go through the same
+    transform as PTZImageDataset and are ordered the same way.
+    """
+
+    def __init__(self, shard_dir, labels=None, transform=None, return_label=False):
+        self.store = ImageShardStore.open(shard_dir)
+        index = self.store.labels
+        if labels is None:
+            labels = list(index)
+        else:
+            missing = [label for label in labels if label not in index]
+            if missing:
+                logger.warning('%d images are not packed in %s', len(missing), shard_dir)
+            labels = [label for label in labels if label in index]
+        self.img_labels = labels
+        self.rows = np.array([index[label] for label in labels], dtype=np.int64)
+        self.decoded = self.store.index.get('decoded', True)
+        self.transform = transform
+        self.return_label = return_label
+        # -- float64 like the positions parsed by PTZImageDataset
+        self.positions = self.store.column('position')[self.rows].astype(np.float64)
+        self.date_times = self.store.column('timestamp')[self.rows]
+        # sort the labels by datetime to ensure coherence
+        sorted_idx = self.date_times.argsort()
+        np.random.shuffle(sorted_idx)
+        self.img_labels[:] = [self.img_labels[i] for i in sorted_idx]
+        self.rows = self.rows[sorted_idx]
+        self.positions = self.positions[sorted_idx]
+        self.date_times = self.date_times[sorted_idx]
+
+    def __len__(self):
+        return len(self.img_labels)
+
+    def __getitem__(self, idx):
+        row = self.rows[idx]
+        if self.decoded:
+            image = Image.fromarray(np.asarray(self.store.read_row(row, 'image')))
+        else:
+            size = int(self.store.read_row(row, 'jpeg_size'))
+            data = self.store.read_row(row, 'jpeg')[:size].tobytes()
+            image = Image.open(io.BytesIO(data)).convert('RGB')
+        if self.transform:
+            image = self.transform(image)
+        if self.return_label:
+            return image, self.img_labels[idx]
+        return image, self.positions[idx]
+
+
+def make_ptz_dataset(img_dir, transform=None, shard_dir=None, size=224, decoded=True, shard_size=1024,
+                     frame_cache=None):
+    """
+    Images of `img_dir`, packed into (and served from) the shards of
+    `shard_dir` if given, read one file per image otherwise (through
+    `frame_cache` if given).
+    """
+    if shard_dir is None:
+        return PTZImageDataset(img_dir, transform=transform, frame_cache=frame_cache)
+    pack_images(img_dir, shard_dir, size=size, decoded=decoded, shard_size=shard_size)
+    labels = ImageCatalog(img_dir).labels()
+    return PTZShardDataset(shard_dir, labels=labels, transform=transform)
+
+
+def make_ptz_dataloader(data, batch_size, shuffle=False, num_workers=0, pin_mem=False, persistent_workers=True):
+    return DataLoader(
+        data,
+        batch_size=batch_size,
+        shuffle=shuffle,
+        num_workers=num_workers,
+        pin_memory=pin_mem and torch.cuda.is_available(),
+        persistent_workers=persistent_workers and num_workers > 0)
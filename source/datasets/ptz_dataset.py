@@ -16,19 +16,20 @@ class PTZImageDataset(Dataset):
         transform=None,
         target_transform=None,
         return_label=False,
+        frame_cache=None,
     ):
         if not os.path.isdir(img_dir):
             raise FileNotFoundError(f"{img_dir} is not a directory")
         self.img_dir = Path(img_dir)
         if annotations_file is None:
-            self.img_labels = [im.stem for im in self.img_dir.glob("*.jpg")]
+            self.img_labels, self.positions, self.date_times = get_labels_from_directory(self.img_dir)
         else:
             # the filename has only one column and should not have a header
             # the string should not have a suffix
             self.img_labels = list(pd.read_csv(annotations_file, header=None)[0])
+            self.positions, self.date_times = self._parse_labels()
         self.transform = transform
         # self.target_transform = target_transform
-        self.positions, self.date_times = self._parse_labels()
         # sort the labels by datetime to ensure coherence
         sorted_idx = self.date_times.argsort()
         np.random.shuffle(sorted_idx)
@@ -36,6 +37,8 @@ class PTZImageDataset(Dataset):
         self.positions = self.positions[sorted_idx]
         self.date_times = self.date_times[sorted_idx]
         self.return_label = return_label
+        # transformed images are served from a FrameCache if given
+        self.frame_cache = frame_cache
 
     def __len__(self):
         return len(self.img_labels)
@@ -43,13 +46,16 @@ class PTZImageDataset(Dataset):
     def __getitem__(self, idx):
         # img_path = os.path.join(self.img_dir, self.img_labels[idx,0] + '.jpg')
         img_path = self.img_dir / (self.img_labels[idx] + ".jpg")
-        image = Image.open(img_path)
-        # image = read_image(img_path)
         label = self.img_labels[idx]
-        # Adding a fourth channel as the depth
-        # image = torch.cat((image, torch.zeros_like(image[0])), dim=0) 
-        if self.transform:
-            image = self.transform(image)
+        if self.frame_cache is not None and self.transform:
+            image = self.frame_cache.get(img_path, lambda: self.transform(Image.open(img_path)))
+        else:
+            image = Image.open(img_path)
+            # image = read_image(img_path)
+            # Adding a fourth channel as the depth
+            # image = torch.cat((image, torch.zeros_like(image[0])), dim=0) 
+            if self.transform:
+                image = self.transform(image)
         # if self.target_transform:
         #     label = self.target_transform(label)
         if self.return_label:
@@ -63,13 +69,97 @@ class PTZImageDataset(Dataset):
         return get_position_datetime_from_labels(self.img_labels)
 
 
+# the datetime part of a label has a fixed width: %Y-%m-%d_%H:%M:%S.%f
+DATETIME_WIDTH = 26
+_LABEL_CACHE = {}
+
+
 def get_position_datetime_from_labels(labels: Union[List, str]):
+    """
+    Parses position_datetime labels (99.99,-92.39,232.0_2024-06-21_04:51:47.291323).
+
+    The labels are handled as one fixed-width character array: the datetime
+    is the last DATETIME_WIDTH characters of every label and is converted by
+    NumPy, the positions are the rest (three comma separated values per
+    label) and are split and converted from one joined string.
+    Labels that do not follow the format fall back to per-label parsing.
+
+    Returns:
+        positions (np.ndarray): [N, 3] pan, tilt, zoom
+        date_times (pd.DatetimeIndex): UTC capture times
+    """
     if isinstance(labels, str):
         # coerce to list
         labels = [labels]
+    if len(labels) == 0:
+        return np.empty((0, 3)), pd.DatetimeIndex([], tz="UTC")
+    try:
+        return _parse_labels_vectorized(labels)
+    except ValueError:
+        return _parse_labels_per_label(labels)
+
+
+def _parse_labels_vectorized(labels):
+    arr = np.asarray(labels, dtype=np.str_)
+    n, width = arr.shape[0], arr.dtype.itemsize // 4
+    lengths = np.char.str_len(arr)
+    if (lengths <= DATETIME_WIDTH + 1).any():
+        raise ValueError("label too short")
+    # -- unicode code points, one row per label
+    codes = arr.view(np.uint32).reshape(n, width)
+    rows = np.arange(n)[:, None]
+    start = lengths - DATETIME_WIDTH
+
+    if (codes[np.arange(n), start - 1] != ord("_")).any():
+        raise ValueError("no datetime separator")
+    date_codes = codes[rows, start[:, None] + np.arange(DATETIME_WIDTH)]
+    # -- ISO 8601 for numpy: date and time separated by T
+    date_codes[:, 10] = ord("T")
+    date_times = np.ascontiguousarray(date_codes).view(f"<U{DATETIME_WIDTH}").ravel()
+    date_times = date_times.astype("datetime64[ns]")
+
+    # -- blank everything from the separator on, numpy strips trailing nulls
+    pos_codes = codes.copy()
+    pos_codes[np.arange(width)[None, :] >= (start - 1)[:, None]] = 0
+    pos = pos_codes.view(arr.dtype).ravel()
+    # -- per row, so a label with 2 values cannot borrow one from the next
+    if (np.char.count(pos, ",") != 2).any():
+        raise ValueError("positions are not pan,tilt,zoom")
+    positions = np.array(",".join(pos.tolist()).split(",")).astype(np.float64)
+    return positions.reshape(n, 3), pd.to_datetime(date_times, utc=True)
+
+
+def _parse_labels_per_label(labels):
     pos, date_time = list(
         zip(*[label.split("_", maxsplit=1) for label in labels])
     )
     positions = np.array([tuple(map(float, p.split(","))) for p in pos])
     date_times = pd.to_datetime(date_time, format="%Y-%m-%d_%H:%M:%S.%f", utc=True)
     return positions, date_times
+
+
+def get_labels_from_directory(img_dir, suffix=".jpg"):
+    """
+    Labels, positions and datetimes of the images of a directory.
+
+    The result is cached per directory and reused while the directory mtime
+    (which changes when images are added or removed) is unchanged. Copies
+    are returned, so callers may modify them.
+
+    Returns:
+        labels (list): Image file names without the suffix
+        positions (np.ndarray): [N, 3] pan, tilt, zoom
+        date_times (pd.DatetimeIndex): UTC capture times
+    """
+    img_dir = os.path.abspath(img_dir)
+    mtime = os.stat(img_dir).st_mtime_ns
+    key = (img_dir, suffix)
+    cached = _LABEL_CACHE.get(key)
+    if cached is None or cached[0] != mtime:
+        with os.scandir(img_dir) as it:
+            labels = [entry.name[:-len(suffix)] for entry in it if entry.name.endswith(suffix)]
+        positions, date_times = get_position_datetime_from_labels(labels)
+        cached = (mtime, labels, positions, date_times)
+        _LABEL_CACHE[key] = cached
+    _, labels, positions, date_times = cached
+    return list(labels), positions.copy(), date_times.copy()
@@ -0,0 +1,116 @@
+import torch
+
+
+# Order of the discrete actions, index i of the action table is action i
+ACTION_KEYS = [
+    ('noop',),
+    ('short', 'left'),
+    ('short', 'right'),
+    ('short', 'left_up'),
+    ('short', 'right_up'),
+    ('short', 'left_down'),
+    ('short', 'right_down'),
+    ('short', 'up'),
+    ('short', 'down'),
+    ('short', 'zoom_in'),
+    ('short', 'zoom_out'),
+    ('long', 'left'),
+    ('long', 'right'),
+    ('long', 'up'),
+    ('long', 'down'),
+    ('long', 'zoom_in'),
+    ('long', 'zoom_out'),
+    ('jump', 'left'),
+    ('jump', 'right'),
+    ('jump', 'up'),
+    ('jump', 'down'),
+]
+
+
+def get_ptz_modulation(camera_brand):
+    """ :returns: (pan, tilt, zoom) multipliers applied to the raw action commands """
+    pan_modulation = 2
+    tilt_modulation = 2
+    if camera_brand == 0:
+        zoom_modulation = 1
+    elif camera_brand == 1:
+        zoom_modulation = 100
+    else:
+        raise ValueError(f'Unexpected camera brand {camera_brand}')
+    return pan_modulation, tilt_modulation, zoom_modulation
+
+
+def build_action_table(action_args, camera_brand=None, device=None):
+    """
+    :param action_args: 'action' section of the config file
+    :param camera_brand: if given, the commands are scaled by the brand's ptz modulation
+    :returns: float tensor [num_actions, 3] with the (pan, tilt, zoom) command of each action
+    """
+    commands = []
+    for keys in ACTION_KEYS:
+        command = action_args
+        for key in keys:
+            command = command[key]
+        commands.append([float(c) for c in command])
+    table = torch.tensor(commands, dtype=torch.float32)
+    if camera_brand is not None:
+        table *= torch.tensor(get_ptz_modulation(camera_brand), dtype=torch.float32)
+    return table.to(device)
+
+
+class DreamEngine(object):
+    """
+    Batched world model rollouts with random actions.
+
+    The whole horizon runs under torch.inference_mode(): actions for the
+    batch are drawn with one torch.randint per step and positions advance
+    with a single gather + add on the action table, so no host-device
+    copies happen inside the loop. Outputs are written into preallocated
+    sequence tensors.
+    """
+
+    def __init__(self, encoder, predictor, action_table):
+        self.encoder = encoder
+        self.predictor = predictor
+        self.action_table = action_table
+        self.num_actions = action_table.shape[0]
+
+    @torch.inference_mode()
+    def rollout(self, images, positions, dream_length, generator=None):
+        """
+        :param images: [B, C, H, W] starting images
+        :param positions: [B, 3] starting (pan, tilt, zoom) positions
+        :returns: dict of sequences with the dreams along dim 1
+            state_sequence [T+1, B, N, D], position_sequence [T+1, B, 3],
+            reward_sequence / delta_reward_sequence / action_sequence [T, B]
+        """
+        device = self.action_table.device
+        positions = positions.to(device, dtype=self.action_table.dtype)
+        state = self.encoder(images)
+        B = state.shape[0]
+
+        states = torch.empty((dream_length + 1,) + tuple(state.shape), dtype=state.dtype, device=device)
+        poss = torch.empty((dream_length + 1, B, positions.shape[-1]), dtype=positions.dtype, device=device)
+        rewards = torch.empty((dream_length, B), dtype=torch.float32, device=device)
+        delta_rewards = torch.empty_like(rewards)
+        actions = torch.randint(self.num_actions, (dream_length, B), device=device, generator=generator)
+
+        states[0] = state
+        poss[0] = positions
+        reward_memory = 0.0
+        for step in range(dream_length):
+            poss[step + 1] = poss[step] + self.action_table.index_select(0, actions[step])
+            state, reward = self.predictor(states[step], poss[step], poss[step + 1])
+            states[step + 1] = state
+            reward = reward.squeeze(-1).mean(-1)
+            rewards[step] = reward
+            delta_rewards[step] = reward - reward_memory
+            reward_memory = reward
+
+        return {
+            'state_sequence': states,
+            'position_sequence': poss,
+            'reward_sequence': rewards,
+            'delta_reward_sequence': delta_rewards,
+            'action_sequence': actions.float()
+        }
@@ -7,6 +7,7 @@ import shutil
 import random
 import logging
 from typing import Union
+from collections import namedtuple
 import yaml
 import pprint
 import torch
@@ -20,17 +21,14 @@ from waggle.plugin import Plugin
 
 import numpy as np
 
-from source.datasets.ptz_dataset import get_position_datetime_from_labels
+from source.datasets.ptz_dataset import get_position_datetime_from_labels, get_labels_from_directory
 from source.prepare_dataset import (
     collect_commands,
     collect_embeds_rewards,
     collect_images,
     collect_positions,
-    grab_image, grab_position,
     set_random_position,
-    set_relative_position,
-    get_dirs,
-    verify_image
+    get_dirs
 )
 
 
@@ -40,6 +38,9 @@ from source.helper import (
     init_agent_model
 )
 from source.track_progress import timefmt, update_progress
+from source.utils.logging import AverageMeter
+from source.dream_engine import get_ptz_modulation
+from source.interaction_pipeline import InteractionPipeline
 
 
 from source.transforms import make_transforms
@@ -68,6 +69,7 @@ def control_ptz(args, params, resume_preempt=False):
     r_file = params['meta']['read_checkpoint']
     pred_depth = params['meta']['pred_depth']
     pred_emb_dim = params['meta']['pred_emb_dim']
+    fused_attention = params['meta'].get('fused_attention', False)
     camerabrand = params['meta']['camera_brand']
     if not torch.cuda.is_available():
         device = torch.device('cpu')
@@ -216,7 +218,8 @@ def control_ptz(args, params, resume_preempt=False):
         crop_size=crop_size,
         pred_depth=pred_depth,
         pred_emb_dim=pred_emb_dim,
-        model_arch=wm_model_arch) # agent and world model are using the same encoder
+        model_arch=wm_model_arch,
+        fused_attention=fused_attention) # agent and world model are using the same encoder
 
     # -- make data transforms
     transform = make_transforms(
@@ -266,7 +269,8 @@ def control_ptz(args, params, resume_preempt=False):
         pred_depth=pred_depth,
         pred_emb_dim=pred_emb_dim,
         model_arch=agent_model_arch,
-        num_actions=num_actions)
+        num_actions=num_actions,
+        fused_attention=fused_attention)
 
     for p in target_predictor.parameters():
         p.requires_grad = False
@@ -296,8 +300,7 @@ def control_ptz(args, params, resume_preempt=False):
 
 def get_last_image(directory):
     directory = Path(directory)
-    all_files = [fp.stem for fp in directory.glob('*.jpg')]
-    arr_pos, arr_datetime = get_position_datetime_from_labels(all_files)
+    all_files, arr_pos, arr_datetime = get_labels_from_directory(directory)
     idx = np.argmax(arr_datetime)
     return Image.open(directory / f"{all_files[idx]}.jpg"), torch.tensor(arr_pos[idx])
 
@@ -309,6 +312,48 @@ def read_image_with_positon_from_path(impath: Union[Path, str]):
     return image, torch.tensor(position)
 
 
+Decision = namedtuple('Decision', ('greedy', 'sampled', 'values', 'probs', 'state', 'latency'))
+
+
+class AgentInferenceSession(object):
+    """
+    Runs the agent policy for camera decisions.
+
+    The image is encoded and the policy evaluated once per decision under
+    torch.inference_mode(); the greedy and the sampled action come from the
+    same action values. Per-decision latency (ms) is kept in latency_meter.
+    """
+
+    def __init__(self, target_encoder, target_predictor, transform, device):
+        self.target_encoder = target_encoder.eval()
+        self.target_predictor = target_predictor.eval()
+        self.transform = transform
+        self.device = device
+        self.latency_meter = AverageMeter()
+
+    @torch.inference_mode()
+    def decide(self, image, position):
+        """
+        :param image: PIL image from the camera
+        :param position: (pan, tilt, zoom) of the camera when the image was taken
+        :returns: Decision with greedy/sampled action indices, action values and probabilities
+        """
+        start = time.perf_counter()
+        image = self.transform(image).unsqueeze(0).to(self.device, non_blocking=True)
+        position_batch = torch.as_tensor(position).unsqueeze(0).to(self.device, dtype=torch.float32)
+        state_batch = self.target_encoder(image)
+        values = self.target_predictor(state_batch, position_batch)
+        # Apply softmax to convert to probabilities
+        probs = F.softmax(values, dim=1)
+        greedy = values.argmax(1)
+        # Sample indices based on the probability distribution
+        sampled = torch.multinomial(probs, 1, replacement=True).squeeze(1)
+        greedy, sampled = greedy.item(), sampled.item()
+        latency = (time.perf_counter() - start) * 1000.
+        self.latency_meter.update(latency)
+        return Decision(greedy, sampled, values, probs, state_batch, latency)
+
+
 def operate_ptz_with_agent(args, actions, target_encoder, transform, target_predictor, device):
     if args.camerabrand==0:
         print('Importing Hanwha')
@@ -324,7 +369,8 @@ def operate_ptz_with_agent(args, actions, target_encoder, transform, target_pred
     number_of_commands = args.movements
 
     try:
-        Camera1 = sunapi_control.CameraControl(args.cameraip, args.username, args.password)
+        Camera1 = sunapi_control.CameraControl(args.cameraip, args.username, args.password,
+                                               state_staleness=args.positionstaleness)
     except Exception as e:
         logger.error("Failed to connect to camera: %s", e)
         if args.publish_msgs:
@@ -334,12 +380,11 @@ def operate_ptz_with_agent(args, actions, target_encoder, transform, target_pred
                 plugin.publish('cannot.get.camera.from.pw', args.password, timestamp=datetime.datetime.now())
             
 
+    # absolute moves return once the camera has settled
     if args.camerabrand==0:
         Camera1.absolute_control(1, 1, 1)
-        time.sleep(1)
     elif args.camerabrand==1:
         Camera1.absolute_move(1, 1, 1)
-        time.sleep(1)
 
     pan_modulation = 2
     tilt_modulation = 2
@@ -360,7 +405,10 @@ def operate_ptz_with_agent(args, actions, target_encoder, transform, target_pred
             plugin.publish('starting.new.image.collection.the.number.of.iterations.is', iterations)
             plugin.publish('the.number.of.images.recorded.by.iteration.is', number_of_commands)
 
+    session = AgentInferenceSession(target_encoder, target_predictor, transform, device)
+
     persis_dir, coll_dir, tmp_dir = get_dirs()
+    pipeline = InteractionPipeline(Camera1, args, session, actions, get_ptz_modulation(args.camerabrand), tmp_dir)
     if coll_dir.exists():
         shutil.rmtree(coll_dir)
 
@@ -377,92 +425,20 @@ def operate_ptz_with_agent(args, actions, target_encoder, transform, target_pred
         # Get first random image as a starting point
         # this would cause the error if we failed to capture the first image
         set_random_position(camera=Camera1, args=args)
-        count = 0
-        while count < 10:
-            img_path = grab_image(camera=Camera1, args=args)
-            if img_path and verify_image(img_path):
-                break
-            count += 1
-            time.sleep(1) # to avoid jamming the network
-        if count == 10:
+        first_frame = pipeline.capture()
+        if first_frame is None:
             # it's unlikely to get the image at the last try
             raise RuntimeError("Failed to grab image after 10 attempts, agent has no starting image, has to stop!")
 
-        positions = [grab_position(camera=Camera1, args=args)]
-        cmds = []
-        embeds = []
-        rewards = []
+        result = pipeline.run(number_of_commands, first_frame)
+        positions = result['positions']
+        cmds = result['cmds']
+        embeds = result['embeds']
+        rewards = result['rewards']
         if first_image_path is None:
-            first_image_path = img_path
-        last_image_path = img_path
-        for command in range(number_of_commands):
-            # image, position = get_last_image(tmp_dir)
-            image, position = read_image_with_positon_from_path(last_image_path)
-            image = transform(image)
-            image = image.unsqueeze(0)
-            position_batch = position.unsqueeze(0).to(device, dtype=torch.float32)
-            state_batch = target_encoder(image.to(device))
-            with torch.no_grad():
-                #next_state_values = target_predictor(state_batch, position_batch)
-                # modified to find the minimum reward rather than maximum reward during inference phase
-                max_next_state_indices = target_predictor(state_batch, position_batch).max(1).indices.item()
-                #next_state_values = target_predictor(state_batch, position_batch).max(1).values
-                next_state_values = target_predictor(state_batch, position_batch)
-                # Apply softmax to convert to probabilities
-                probs = F.softmax(next_state_values, dim=1)
-                # Sample indices based on the probability distribution
-                num_samples = 1  # Adjust as needed
-                sampled_indices = torch.multinomial(probs.squeeze(), num_samples, replacement=True)
-
-            print('next_state_values: ', next_state_values)
-            print('probs: ', probs)
-            #print('max_next_state_indices: ', max_next_state_indices)
-            # if torch.rand([1]).item() > 0.9999:
-            if torch.rand([1]).item() > 0.2:
-                print('Sampled action')
-                print('sampled_indices: ', sampled_indices.item())
-                next_action = actions[sampled_indices.item()]
-            else:
-                print('Rewarded action')
-                print('max_next_state_indices: ', max_next_state_indices)
-                next_action = actions[max_next_state_indices]
-            print('next_action: ', next_action)
-
-            pan_modulation = 2
-            tilt_modulation = 2
-            if args.camerabrand==0:
-                zoom_modulation = 1
-            elif args.camerabrand==1:
-                zoom_modulation = 100
-
-            pan=next_action[0]*pan_modulation
-            tilt=next_action[1]*tilt_modulation
-            zoom=next_action[2]*zoom_modulation
-
-            #set_random_position(camera=Camera1, args=args) ## I have to simply replace it with the decisions taken by the agent
-            set_relative_position(camera=Camera1, args=args,
-                                  pan=pan,
-                                  tilt=tilt,
-                                  zoom=zoom)
-            # Make sure the image is captured before moving on
-            count = 0
-            while count < 10:
-                img_path = grab_image(camera=Camera1, args=args)
-                if img_path and verify_image(img_path):
-                    break
-                count += 1
-                # it's unlikely to get the image at the last try
-                time.sleep(1) # to avoid jamming the network
-            if count == 10:
-                logger.warning("Failed to grab image after 10 attempts, skip this command")
-                if os.path.exists(img_path):
-                    os.remove(img_path)
-                continue
-            positions.append(grab_position(camera=Camera1, args=args))
-            cmds.append(f"{pan:.2f},{tilt:.2f},{zoom:.2f}")
-            embeds.append(state_batch.detach().cpu())
-            rewards.append(next_state_values.detach().cpu())
-            last_image_path = img_path
+            first_image_path = result['image_paths'][0]
+        last_image_path = result['image_paths'][-1]
+        logger.info('decision latency: %.1f ms (avg over %d)', session.latency_meter.avg, session.latency_meter.count)
         #publish_images()
         num_image += collect_images(args.keepimages)
         
@@ -474,6 +450,7 @@ def operate_ptz_with_agent(args, actions, target_encoder, transform, target_pred
         
         if args.track_all:
             collect_embeds_rewards(embeds, rewards, cur_time)
+    pipeline.close()
     return [first_image_path, last_image_path], num_image
 
 def run(args, fname, mode):
@@ -0,0 +1,172 @@
+"""
+Local fake PTZ camera speaking the subset of Sunapi (Hanwha) and Vapix (Axis)
+used by the drivers, with HTTP digest authentication. Meant for benchmarking
+the camera drivers without hardware.
+
+Usage:
+    python -m source.fake_camera --port 8080 --latency 0.005
+"""
+import io
+import time
+import uuid
+import hashlib
+import logging
+import argparse
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+
+logger = logging.getLogger(__name__)
+
+REALM = 'fake-camera'
+
+
+def _make_jpeg(size=(64, 48)):
+    try:
+        from PIL import Image
+    except ImportError:
+        return b'\xff\xd8\xff\xd9'
+    buf = io.BytesIO()
+    Image.new('RGB', size, (80, 120, 160)).save(buf, format='JPEG')
+    return buf.getvalue()
+
+
+class FakeCameraState(object):
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.pan, self.tilt, self.zoom, self.zoom_pulse = 0., 0., 1., 0.
+        self.requests = 0
+        self.challenges = 0
+        self.jpeg = _make_jpeg()
+
+
+class FakeCameraHandler(BaseHTTPRequestHandler):
+    # -- HTTP/1.1 so clients can keep connections alive
+    protocol_version = 'HTTP/1.1'
+
+    state = None
+    user = 'admin'
+    password = 'admin'
+    latency = 0.
+    nonce = uuid.uuid4().hex
+
+    def log_message(self, format, *args):
+        logger.debug(format, *args)
+
+    def _send(self, code, body=b'', content_type='text/plain', headers=None):
+        self.send_response(code)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _authorized(self):
+        header = self.headers.get('Authorization', '')
+        if not header.startswith('Digest '):
+            return False
+        fields = {}
+        for item in header[len('Digest '):].split(','):
+            key, _, value = item.strip().partition('=')
+            fields[key] = value.strip('"')
+        if fields.get('nonce') != self.nonce or fields.get('username') != self.user:
+            return False
+        ha1 = hashlib.md5(f'{self.user}:{REALM}:{self.password}'.encode()).hexdigest()
+        ha2 = hashlib.md5(f'GET:{fields.get("uri")}'.encode()).hexdigest()
+        if fields.get('qop'):
+            expected = f'{ha1}:{self.nonce}:{fields.get("nc")}:{fields.get("cnonce")}:{fields.get("qop")}:{ha2}'
+        else:
+            expected = f'{ha1}:{self.nonce}:{ha2}'
+        return hashlib.md5(expected.encode()).hexdigest() == fields.get('response')
+
+    def do_GET(self):
+        if self.latency > 0:
+            time.sleep(self.latency)
+        with self.state.lock:
+            self.state.requests += 1
+        if not self._authorized():
+            with self.state.lock:
+                self.state.challenges += 1
+            challenge = f'Digest realm="{REALM}", nonce="{self.nonce}", qop="auth", algorithm=MD5'
+            self._send(401, b'Unauthorized', headers={'WWW-Authenticate': challenge})
+            return
+
+        url = urlparse(self.path)
+        query = {key: values[-1] for key, values in parse_qs(url.query).items()}
+        state = self.state
+        if url.path.endswith('/video.cgi') or url.path.endswith('/image.cgi'):
+            self._send(200, state.jpeg, content_type='image/jpeg')
+        elif url.path.endswith('/ptzcontrol.cgi'):
+            with state.lock:
+                if query.get('msubmenu') in ('relative', 'absolute'):
+                    self._move(query, relative=query['msubmenu'] == 'relative')
+                body = f'Pan={state.pan}\nTilt={state.tilt}\nZoom={state.zoom}\nZoomPulse={state.zoom_pulse}\n'
+            self._send(200, body.encode())
+        elif url.path.endswith('/ptz.cgi'):
+            with state.lock:
+                if 'rpan' in query or 'rtilt' in query or 'rzoom' in query:
+                    self._move({'Pan': query.get('rpan'), 'Tilt': query.get('rtilt'), 'Zoom': query.get('rzoom')}, relative=True)
+                elif 'pan' in query or 'tilt' in query or 'zoom' in query:
+                    self._move({'Pan': query.get('pan'), 'Tilt': query.get('tilt'), 'Zoom': query.get('zoom')}, relative=False)
+                body = f'pan={state.pan}\ntilt={state.tilt}\nzoom={state.zoom}\n'
+            self._send(200, body.encode())
+        else:
+            self._send(404, b'Not found')
+
+    def _move(self, query, relative):
+        state = self.state
+        for key, attr in (('Pan', 'pan'), ('Tilt', 'tilt'), ('Zoom', 'zoom')):
+            value = query.get(key)
+            if value in (None, '', 'None'):
+                continue
+            value = float(value)
+            setattr(state, attr, getattr(state, attr) + value if relative else value)
+        state.pan = state.pan % 360
+
+
+class FakeCamera(object):
+    """ Fake camera served from a background thread, usable as a context manager """
+
+    def __init__(self, host='127.0.0.1', port=0, user='admin', password='admin', latency=0.):
+        self.state = FakeCameraState()
+        handler = type('Handler', (FakeCameraHandler,), dict(
+            state=self.state, user=user, password=password, latency=latency))
+        self.server = ThreadingHTTPServer((host, port), handler)
+        self.server.daemon_threads = True
+        self._thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    @property
+    def address(self):
+        host, port = self.server.server_address[:2]
+        return f'{host}:{port}'
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser("Fake PTZ camera")
+    parser.add_argument('--host', type=str, default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--user', type=str, default='admin')
+    parser.add_argument('--password', type=str, default='admin')
+    parser.add_argument('--latency', type=float, default=0., help='Seconds added to every request')
+    args = parser.parse_args()
+    camera = FakeCamera(args.host, args.port, args.user, args.password, args.latency)
+    logger.info('Fake camera on http://%s', camera.address)
+    camera.server.serve_forever()
@@ -8,13 +8,11 @@ import yaml
 import numpy as np
 from argparse import ArgumentParser
 from helper import init_model, init_world_model
-from run_jepa import (
-    forward_context,
-    arrange_inputs,
-    forward_target,
-)
+from run_jepa import forward_target
 from transforms import make_transforms
+from utils.tensors import all_pairs_index
 from datasets.ptz_dataset import PTZImageDataset, get_position_datetime_from_labels
+from datasets.frame_cache import FrameCache, transform_fingerprint
 import h5py
 
 
@@ -69,6 +67,13 @@ def parse_args():
         action="store_true",
         help="Remove corrupt images from the directory",
     )
+    parser.add_argument(
+        "-fc",
+        "--frame_cache_dir",
+        type=str,
+        default=None,
+        help="Cache transformed images here to skip decoding them on later runs",
+    )
     return parser.parse_args()
 
 
@@ -115,6 +120,7 @@ def generate_embedding(
     output_dir: str,
     world_model=False,
     device=None,
+    frame_cache_dir=None,
 ):
     if device is None:
         device = "cuda" if torch.cuda.is_available() else "cpu"
@@ -134,6 +140,7 @@ def generate_embedding(
     crop_size = config["data"]["crop_size"]
     batch_size = config["data"]["batch_size"]
     camera_brand = config["meta"]["camera_brand"]
+    fused_attention = config["meta"].get("fused_attention", False)
 
     # load model
     logger.info("Loading model")
@@ -145,6 +152,7 @@ def generate_embedding(
             pred_depth=pred_depth,
             pred_emb_dim=pred_emb_dim,
             model_arch=model_arch,
+            fused_attention=fused_attention,
         )
     else:
         encoder, predictor = init_model(
@@ -154,6 +162,7 @@ def generate_embedding(
             pred_depth=pred_depth,
             pred_emb_dim=pred_emb_dim,
             model_arch=model_arch,
+            fused_attention=fused_attention,
         )
     target_encoder = copy.deepcopy(encoder)
     checkpoint = torch.load(checkpoint_fpath, map_location=torch.device("cpu"))
@@ -171,7 +180,12 @@ def generate_embedding(
     # load dataset
     logger.info("Loading dataset")
     # first need to sort data using timestamp
-    data = PTZImageDataset(img_dir, transform=make_transforms(), return_label=True)
+    transform = make_transforms()
+    frame_cache = None
+    if frame_cache_dir is not None:
+        # keyed like the dreamer's cache, shared when the transforms match
+        frame_cache = FrameCache(frame_cache_dir, transform_fingerprint(transform))
+    data = PTZImageDataset(img_dir, transform=transform, return_label=True, frame_cache=frame_cache)
     dataloader = DataLoader(data, batch_size=batch_size, shuffle=False)
     ipe = len(dataloader)
 
@@ -244,21 +258,17 @@ def generate_embedding(
         # this would duplicate each image in the batch with all
         # other images in the same batch.
         if world_model:
-            context_imgs, context_poss, target_imgs, target_poss = arrange_inputs(
-                img, pos, device
-            )
+            # encode each unique image once and expand the embeddings
+            # into the all-pairs layout used by arrange_inputs
+            context_idx, target_idx = all_pairs_index(img.shape[0], device=img.device)
+            context_poss = pos.index_select(0, context_idx)
+            target_poss = pos.index_select(0, target_idx)
             with torch.no_grad():
-                pred_embed, pred_reward = forward_context(
-                    context_imgs,
-                    context_poss,
-                    target_poss,
-                    encoder,
-                    predictor,
-                    camera_brand,
-                    return_rewards=True,
+                contx_enc_embed = encoder.forward(img).index_select(0, context_idx)
+                pred_embed, pred_reward = predictor(
+                    contx_enc_embed, context_poss, target_poss
                 )
-                contx_enc_embed = encoder.forward(context_imgs)
-                tar_embed = forward_target(target_imgs, target_encoder)
+                tar_embed = forward_target(img, target_encoder, index=target_idx)
             li_contx_pos.append(context_poss.cpu().numpy())
             li_target_pos.append(target_poss.cpu().numpy())
             li_pred_rewards.append(pred_reward.cpu().numpy())
@@ -293,4 +303,5 @@ if __name__ == "__main__":
         args.output_dir,
         args.world_model,
         args.device,
+        args.frame_cache_dir,
     )
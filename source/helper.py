@@ -20,6 +20,38 @@ from source.utils.tensors import trunc_normal_
 logger = logging.getLogger(__name__)
 
 
+def use_fused_attention(fused_attention, model):
+    """
+    :param fused_attention: bool for all models, or dict of model name
+        ('encoder', 'predictor', 'rssm', 'agent') to bool, as in meta
+    :returns: whether `model` runs its attention through the fused kernel
+    """
+    if isinstance(fused_attention, dict):
+        return bool(fused_attention.get(model, False))
+    return bool(fused_attention)
+
+
+def checkpoint_policy(activation_checkpointing, model):
+    """
+    :param activation_checkpointing: meta activation_checkpointing config,
+        dict with mode (none, block, every, budget), every, memory_budget_gb
+        and models (names among encoder, predictor, rssm, agent), or None
+    :returns: vit.CheckpointPolicy of `model`, None if it is not checkpointed
+    """
+    if not activation_checkpointing:
+        return None
+    mode = activation_checkpointing.get('mode', 'none')
+    models = activation_checkpointing.get('models', ['encoder', 'predictor', 'rssm', 'agent'])
+    if mode == 'none' or model not in models:
+        return None
+    policy = vit.CheckpointPolicy(
+        mode=mode,
+        every=activation_checkpointing.get('every', 1),
+        memory_budget=int(activation_checkpointing.get('memory_budget_gb', 0) * 1024**3))
+    logger.info('%s activation checkpointing: %s', model, policy)
+    return policy
+
+
 def load_checkpoint(
     device,
     r_path,
@@ -56,7 +88,7 @@ def load_checkpoint(
         if opt is not None:
             opt.load_state_dict(checkpoint['opt'])
             logger.info(f'loaded optimizers from epoch {epoch}')
-        if scaler is not None:
+        if scaler is not None and checkpoint.get('scaler') is not None:
             scaler.load_state_dict(checkpoint['scaler'])
         logger.info(f'read-path: {r_path}')
         del checkpoint
@@ -75,18 +107,24 @@ def init_model(
     model_arch='vit_base',
     crop_size=224,
     pred_depth=6,
-    pred_emb_dim=384
+    pred_emb_dim=384,
+    fused_attention=False,
+    activation_checkpointing=None
 ):
     encoder = vit.__dict__[model_arch](
         img_size=[crop_size],
-        patch_size=patch_size)
+        patch_size=patch_size,
+        fused_attention=use_fused_attention(fused_attention, 'encoder'),
+        checkpoint_policy=checkpoint_policy(activation_checkpointing, 'encoder'))
     predictor = vit.__dict__['vit_predictor'](
     #predictor = vit.__dict__['vit_micro_predictor'](
         num_patches=encoder.patch_embed.num_patches,
         embed_dim=encoder.embed_dim,
         predictor_embed_dim=pred_emb_dim,
         depth=pred_depth,
-        num_heads=encoder.num_heads)
+        num_heads=encoder.num_heads,
+        fused_attention=use_fused_attention(fused_attention, 'predictor'),
+        checkpoint_policy=checkpoint_policy(activation_checkpointing, 'predictor'))
 
     def init_weights(m):
         if isinstance(m, torch.nn.Linear):
@@ -172,17 +210,23 @@ def init_world_model(
     model_arch='vit_base',
     crop_size=224,
     pred_depth=6,
-    pred_emb_dim=384
+    pred_emb_dim=384,
+    fused_attention=False,
+    activation_checkpointing=None
 ):
     encoder = vit.__dict__[model_arch](
         img_size=[crop_size],
-        patch_size=patch_size)
+        patch_size=patch_size,
+        fused_attention=use_fused_attention(fused_attention, 'encoder'),
+        checkpoint_policy=checkpoint_policy(activation_checkpointing, 'encoder'))
     predictor = vit.__dict__['vit_rssm'](
         num_patches=encoder.patch_embed.num_patches,
         embed_dim=encoder.embed_dim,
         predictor_embed_dim=pred_emb_dim,
         depth=pred_depth,
-        num_heads=encoder.num_heads)
+        num_heads=encoder.num_heads,
+        fused_attention=use_fused_attention(fused_attention, 'rssm'),
+        checkpoint_policy=checkpoint_policy(activation_checkpointing, 'rssm'))
 
     def init_weights(m):
         if isinstance(m, torch.nn.Linear):
@@ -216,7 +260,7 @@ def init_opt(
     wd=1e-6,
     final_wd=1e-6,
     final_lr=0.0,
-    use_bfloat16=False,
+    precision=None,
     ipe_scale=1.25
 ):
     param_groups = [
@@ -255,7 +299,8 @@ def init_opt(
         ref_wd=wd,
         final_wd=final_wd,
         T_max=int(ipe_scale*num_epochs*iterations_per_epoch))
-    scaler = torch.cuda.amp.GradScaler() if use_bfloat16 else None
+    # -- only fp16 needs loss scaling, the scaler is owned by the precision policy
+    scaler = None if precision is None else precision.scaler
     return optimizer, scaler, scheduler, wd_scheduler
 
 
@@ -268,18 +313,24 @@ def init_agent_model(
     crop_size=224,
     pred_depth=6,
     pred_emb_dim=384,
-    num_actions=16
+    num_actions=16,
+    fused_attention=False,
+    activation_checkpointing=None
 ):
     encoder = vit.__dict__[model_arch](
         img_size=[crop_size],
-        patch_size=patch_size)
+        patch_size=patch_size,
+        fused_attention=use_fused_attention(fused_attention, 'encoder'),
+        checkpoint_policy=checkpoint_policy(activation_checkpointing, 'encoder'))
     predictor = vit.__dict__['vit_agent'](
         num_patches=encoder.patch_embed.num_patches,
         embed_dim=encoder.embed_dim,
         predictor_embed_dim=pred_emb_dim,
         depth=pred_depth,
         num_heads=encoder.num_heads,
-    num_actions=num_actions)
+        num_actions=num_actions,
+        fused_attention=use_fused_attention(fused_attention, 'agent'),
+        checkpoint_policy=checkpoint_policy(activation_checkpointing, 'agent'))
 
     def init_weights(m):
         if isinstance(m, torch.nn.Linear):
@@ -0,0 +1,179 @@
+import io
+import time
+import datetime
+import logging
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+import torch
+from PIL import Image
+
+from source.prepare_dataset import set_relative_position
+from source.utils.logging import AverageMeter
+
+
+logger = logging.getLogger(__name__)
+
+
+Frame = namedtuple('Frame', ('image', 'position', 'label', 'jpeg'))
+
+
+class StageTimer(object):
+    """ Wall time (ms) per pipeline stage """
+
+    def __init__(self):
+        self.meters = {}
+
+    @contextmanager
+    def time(self, stage):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.meters.setdefault(stage, AverageMeter()).update((time.perf_counter() - start) * 1000.)
+
+    def summary(self):
+        return ' '.join('[%s: %.1f ms]' % (stage, meter.avg) for stage, meter in self.meters.items())
+
+
+class InteractionPipeline(object):
+    """
+    Camera interaction loop.
+
+    camera:    PTZ moves, position queries and snapshots, the JPEG is decoded
+               in memory (a failed decode is a failed capture)
+    inference: transform, encoder and policy through an AgentInferenceSession
+    writer:    writes the JPEG bytes once to `tmp_dir`, labelled like grab_image
+
+    Every move needs the decision on the frame taken after the previous
+    move, so camera and inference run one after the other in the calling
+    thread. Only writes run in a background thread: writing a frame
+    overlaps with the decision on it and with the next move, and no frame
+    is read back from disk. Per-stage timings tell which stage bounds the
+    actions/min.
+    """
+
+    def __init__(self, camera, args, session, actions, modulation, tmp_dir, max_attempts=10):
+        self.camera = camera
+        self.args = args
+        self.session = session
+        self.actions = actions
+        self.modulation = modulation
+        self.tmp_dir = tmp_dir
+        self.max_attempts = max_attempts
+        self.timer = StageTimer()
+        self._writer_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix='ptz-writer')
+
+    def close(self):
+        self._writer_pool.shutdown(wait=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _get_position(self):
+        if self.args.camerabrand == 0:
+            return self.camera.requesting_cameras_position_information()
+        return self.camera.get_ptz()
+
+    def _capture_once(self):
+        with self.timer.time('position'):
+            position = self._get_position()
+        ct = datetime.datetime.now().strftime("%Y-%m-%d_%H:%M:%S.%f")
+        with self.timer.time('snapshot'):
+            jpeg = self.camera.snap_shot_bytes()
+        if not jpeg:
+            return None
+        with self.timer.time('decode'):
+            image = Image.open(io.BytesIO(jpeg))
+            image.load()
+            image = image.convert('RGB')
+        pos_str = ",".join([str(p) for p in position])
+        return Frame(image, [float(p) for p in position], f"{pos_str}_{ct}", jpeg)
+
+    def capture(self):
+        """ :returns: Frame of the current view, None after max_attempts failed captures """
+        for attempt in range(self.max_attempts):
+            try:
+                frame = self._capture_once()
+            except Exception as e:
+                logger.error("Error when taking snap shot: %s", e)
+                frame = None
+            if frame is not None:
+                return frame
+            # back off up to 1 second to avoid jamming the network
+            time.sleep(min(0.1 * 2 ** attempt, 1.))
+        return None
+
+    def move_and_capture(self, pan, tilt, zoom):
+        with self.timer.time('move'):
+            set_relative_position(camera=self.camera, args=self.args, pan=pan, tilt=tilt, zoom=zoom)
+        return self.capture()
+
+    def decide(self, frame):
+        with self.timer.time('inference'):
+            return self.session.decide(frame.image, frame.position)
+
+    def write(self, frame):
+        img_path = str(self.tmp_dir / f"{frame.label}.jpg")
+        with self.timer.time('write'):
+            with open(img_path, 'wb') as f:
+                f.write(frame.jpeg)
+        return img_path
+
+    def choose_action(self, decision):
+        # same exploration as before: sampled action 80% of the time, greedy otherwise
+        if torch.rand([1]).item() > 0.2:
+            return self.actions[decision.sampled]
+        return self.actions[decision.greedy]
+
+    def run(self, number_of_commands, first_frame):
+        """
+        Runs `number_of_commands` agent decisions starting from `first_frame`.
+
+        :returns: dict with positions, cmds, embeds, rewards (as collected by
+            operate_ptz_with_agent), the written image paths and actions/min
+        """
+        start = time.perf_counter()
+        frame = first_frame
+        writes = [self._writer_pool.submit(self.write, frame)]
+        positions = [",".join([str(p) for p in frame.position])]
+        cmds, embeds, rewards = [], [], []
+        num_actions = 0
+        for command in range(number_of_commands):
+            decision = self.decide(frame)
+            next_action = self.choose_action(decision)
+            pan = next_action[0] * self.modulation[0]
+            tilt = next_action[1] * self.modulation[1]
+            zoom = next_action[2] * self.modulation[2]
+            next_frame = self.move_and_capture(pan, tilt, zoom)
+            num_actions += 1
+            if next_frame is None:
+                logger.warning("Failed to grab image after %d attempts, skip this command", self.max_attempts)
+                continue
+            writes.append(self._writer_pool.submit(self.write, next_frame))
+            positions.append(",".join([str(p) for p in next_frame.position]))
+            cmds.append(f"{pan:.2f},{tilt:.2f},{zoom:.2f}")
+            embeds.append(decision.state.cpu())
+            rewards.append(decision.values.cpu())
+            frame = next_frame
+
+        image_paths = [w.result() for w in writes]
+        elapsed = time.perf_counter() - start
+        actions_per_minute = 60. * num_actions / max(elapsed, 1e-9)
+        logger.info('%d actions in %.1f s (%.1f actions/min) %s',
+                    num_actions, elapsed, actions_per_minute, self.timer.summary())
+        waiter = getattr(self.camera, 'waiter', None)
+        if waiter is not None:
+            logger.info('settle times %s', waiter.settle_times.summary())
+        return {
+            'positions': positions,
+            'cmds': cmds,
+            'embeds': embeds,
+            'rewards': rewards,
+            'image_paths': image_paths,
+            'actions_per_minute': actions_per_minute
+        }
@@ -11,6 +11,7 @@ import numpy as np
 
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 
 from torch.utils.checkpoint import checkpoint
 
@@ -125,22 +126,44 @@ class MLP(nn.Module):
 
 
 class Attention(nn.Module):
-    def __init__(self, dim, num_heads=8, qkv_bias=False, qk_scale=None, attn_drop=0., proj_drop=0.):
+    """
+    Multi-head self-attention.
+
+    With `fused=True` (and torch >= 2.0) the output is computed by
+    F.scaled_dot_product_attention, which picks a flash or memory-efficient
+    kernel when one is available and the math kernel otherwise (e.g. CPU),
+    without materializing the [B, heads, N, N] weights. The weights are
+    then only computed when `return_attention` is requested.
+    """
+    def __init__(self, dim, num_heads=8, qkv_bias=False, qk_scale=None, attn_drop=0., proj_drop=0., fused=False):
         super().__init__()
         self.num_heads = num_heads
         head_dim = dim // num_heads
         self.scale = qk_scale or head_dim ** -0.5
+        self.fused = fused and hasattr(F, 'scaled_dot_product_attention')
 
         self.qkv = nn.Linear(dim, dim * 3, bias=qkv_bias)
         self.attn_drop = nn.Dropout(attn_drop)
         self.proj = nn.Linear(dim, dim)
         self.proj_drop = nn.Dropout(proj_drop)
 
-    def forward(self, x):
+    def forward(self, x, return_attention=False):
         B, N, C = x.shape
         qkv = self.qkv(x).reshape(B, N, 3, self.num_heads, C // self.num_heads).permute(2, 0, 3, 1, 4)
         q, k, v = qkv[0], qkv[1], qkv[2]
 
+        if self.fused and not return_attention:
+            # -- SDPA scales by head_dim ** -0.5, fold a custom qk_scale into q
+            head_dim = C // self.num_heads
+            if self.scale != head_dim ** -0.5:
+                q = q * (self.scale * head_dim ** 0.5)
+            x = F.scaled_dot_product_attention(
+                q, k, v, dropout_p=self.attn_drop.p if self.training else 0.)
+            x = x.transpose(1, 2).reshape(B, N, C)
+            x = self.proj(x)
+            x = self.proj_drop(x)
+            return x, None
+
         attn = (q @ k.transpose(-2, -1)) * self.scale
         attn = attn.softmax(dim=-1)
         attn = self.attn_drop(attn)
@@ -153,18 +176,19 @@ class Attention(nn.Module):
 
 class Block(nn.Module):
     def __init__(self, dim, num_heads, mlp_ratio=4., qkv_bias=False, qk_scale=None, drop=0., attn_drop=0.,
-                 drop_path=0., act_layer=nn.GELU, norm_layer=nn.LayerNorm):
+                 drop_path=0., act_layer=nn.GELU, norm_layer=nn.LayerNorm, fused_attention=False):
         super().__init__()
         self.norm1 = norm_layer(dim)
         self.attn = Attention(
-            dim, num_heads=num_heads, qkv_bias=qkv_bias, qk_scale=qk_scale, attn_drop=attn_drop, proj_drop=drop)
+            dim, num_heads=num_heads, qkv_bias=qkv_bias, qk_scale=qk_scale, attn_drop=attn_drop, proj_drop=drop,
+            fused=fused_attention)
         self.drop_path = DropPath(drop_path) if drop_path > 0. else nn.Identity()
         self.norm2 = norm_layer(dim)
         mlp_hidden_dim = int(dim * mlp_ratio)
         self.mlp = MLP(in_features=dim, hidden_features=mlp_hidden_dim, act_layer=act_layer, drop=drop)
 
     def forward(self, x, return_attention=False):
-        y, attn = self.attn(self.norm1(x))
+        y, attn = self.attn(self.norm1(x), return_attention=return_attention)
         if return_attention:
             return attn
         x = x + self.drop_path(y)
@@ -172,6 +196,124 @@ class Block(nn.Module):
         return x
 
 
+class CheckpointPolicy(object):
+    """
+    Which transformer blocks recompute their activations in the backward
+    pass (torch.utils.checkpoint) instead of keeping them.
+
+    none:   no block
+    block:  every block
+    every:  one block out of `every`
+    budget: the fewest blocks that keep the estimated activations of the
+            network under `memory_budget` bytes for the current input
+
+    Only applies to training forwards with autograd enabled, frozen target
+    networks and inference never recompute.
+    """
+
+    modes = ('none', 'block', 'every', 'budget')
+
+    def __init__(self, mode='none', every=1, memory_budget=0):
+        if mode not in self.modes:
+            raise ValueError(f'Unknown activation checkpointing mode {mode}, expected one of {self.modes}')
+        if mode == 'budget' and memory_budget <= 0:
+            raise ValueError('Activation checkpointing mode budget needs a positive memory budget')
+        self.mode = mode
+        self.every = max(int(every), 1)
+        self.memory_budget = memory_budget
+
+    def __repr__(self):
+        return f'CheckpointPolicy(mode={self.mode}, every={self.every}, memory_budget={self.memory_budget})'
+
+    @staticmethod
+    def block_activations(blk, x):
+        """ :returns: estimated bytes a block keeps for backward on input x [B, N, D] """
+        B, N, D = x.shape
+        element_size = 2 if torch.is_autocast_enabled() or torch.is_autocast_cpu_enabled() else x.element_size()
+        hidden = blk.mlp.fc1.out_features
+        # -- norms, qkv, attention output, projection and residuals ~ 8 x D,
+        # -- MLP hidden and activation 2 x hidden, plus the attention weights
+        # -- (softmax and dropout) unless the fused kernel is used
+        elements = B * N * (8 * D + 2 * hidden)
+        if not blk.attn.fused:
+            elements += 2 * B * blk.attn.num_heads * N * N
+        return elements * element_size
+
+    def checkpointed(self, blocks, x):
+        """ :returns: list of bools, whether each block of `blocks` is checkpointed """
+        depth = len(blocks)
+        if self.mode == 'none' or depth == 0:
+            return [False] * depth
+        if self.mode == 'block':
+            return [True] * depth
+        if self.mode == 'every':
+            return [i % self.every == 0 for i in range(depth)]
+        per_block = self.block_activations(blocks[0], x)
+        kept_input = x.numel() * x.element_size()
+        # -- a checkpointed block keeps its input, and one block is
+        # -- recomputed at a time during backward
+        for num_checkpointed in range(depth + 1):
+            total = (depth - num_checkpointed) * per_block + num_checkpointed * kept_input
+            if num_checkpointed:
+                total += per_block
+            if total <= self.memory_budget:
+                break
+        return [i < num_checkpointed for i in range(depth)]
+
+
+def run_blocks(blocks, x, policy=None):
+    """ Forward through `blocks`, checkpointing the ones `policy` selects """
+    if policy is None or not (blocks.training and torch.is_grad_enabled()):
+        for blk in blocks:
+            x = blk(x)
+        return x
+    for blk, use_checkpoint in zip(blocks, policy.checkpointed(blocks, x)):
+        if use_checkpoint:
+            x = checkpoint(blk, x, use_reentrant=False)
+        else:
+            x = blk(x)
+    return x
+
+
+class TokenBuffer(object):
+    """
+    Predictor input buffer. Calls made without autograd (dreams, inference)
+    reuse one buffer per shape; with autograd the first block keeps its
+    input for the backward pass, so every call gets a fresh one. Not
+    thread-safe, a model is driven by one thread at a time.
+    """
+
+    def __init__(self):
+        self.tokens = None
+
+    def get(self, shape, like):
+        if torch.is_grad_enabled():
+            return like.new_empty(shape)
+        tokens = self.tokens
+        if (tokens is None or tokens.shape != shape or tokens.dtype != like.dtype or tokens.device != like.device
+                or tokens.is_inference() != torch.is_inference_mode_enabled()):
+            tokens = self.tokens = like.new_empty(shape)
+        return tokens
+
+
+def predictor_tokens(x, pos_embed, ptz_embed1, ptz_embed2, buffer=None):
+    """
+    Assembles the [B, 2N, D] predictor input: the context tokens x [B, N, D]
+    plus the positional embedding [1, N, D] and the first ptz position
+    embedding [B, D], followed by N copies of the second ptz position
+    embedding [B, D]. The embeddings are broadcast, not repeated, and both
+    halves are written straight into one token buffer (no concatenation).
+    """
+    B, N, D = x.shape
+    tokens = buffer.get((B, 2 * N, D), x) if buffer is not None else x.new_empty((B, 2 * N, D))
+    context = tokens[:, :N]
+    context.copy_(x)
+    context += ptz_embed1.unsqueeze(1)
+    context += pos_embed
+    tokens[:, N:] = ptz_embed2.unsqueeze(1)
+    return tokens
+
+
 class PatchEmbed(nn.Module):
     """ Image to Patch Embedding
     """
@@ -235,6 +377,8 @@ class VisionTransformerPredictor(nn.Module):
         drop_path_rate=0.0,
         norm_layer=nn.LayerNorm,
         init_std=0.02,
+        fused_attention=False,
+        checkpoint_policy=None,
         **kwargs
     ):
         super().__init__()
@@ -253,12 +397,15 @@ class VisionTransformerPredictor(nn.Module):
         self.predictor_blocks = nn.ModuleList([
             Block(
                 dim=predictor_embed_dim, num_heads=num_heads, mlp_ratio=mlp_ratio, qkv_bias=qkv_bias, qk_scale=qk_scale,
-                drop=drop_rate, attn_drop=attn_drop_rate, drop_path=dpr[i], norm_layer=norm_layer)
+                drop=drop_rate, attn_drop=attn_drop_rate, drop_path=dpr[i], norm_layer=norm_layer,
+                fused_attention=fused_attention)
             for i in range(depth)])
         self.predictor_norm = norm_layer(predictor_embed_dim)
         self.predictor_proj = nn.Linear(predictor_embed_dim, embed_dim, bias=True)
+        self.token_buffer = TokenBuffer()
         # ------
         self.init_std = init_std
+        self.checkpoint_policy = checkpoint_policy
         self.apply(self._init_weights)
         self.fix_init_weight()
 
@@ -292,30 +439,16 @@ class VisionTransformerPredictor(nn.Module):
 
         # -- add positional embedding to x tokens
         # -- affecting them by the first ptz position
-        x_pos_embed = self.predictor_pos_embed.repeat(B, 1, 1)
-
-        pred_ptz_poss1_embeds = self.ptz_poss1_embed(poss_x)
-        pred_ptz_poss1_tokens = pred_ptz_poss1_embeds.repeat(x_pos_embed.size(1), 1, 1)
-        pred_ptz_poss1_tokens = pred_ptz_poss1_tokens.permute(1, 0, 2)
-
-        x += pred_ptz_poss1_tokens
-        x += x_pos_embed
-
+        # -- and append the second ptz position tokens
         _, N_ctxt, D = x.shape
-
-        # -- concat second ptz position tokens to x
-        pos_embs = self.predictor_pos_embed.repeat(B, 1, 1)
-
-        pred_ptz_poss2_embeds = self.ptz_poss2_embed(poss)
-        pred_ptz_poss2_tokens = pred_ptz_poss2_embeds.repeat(pos_embs.size(1), 1, 1)
-        pred_ptz_poss2_tokens = pred_ptz_poss2_tokens.permute(1, 0, 2)
-        x = torch.cat([x, pred_ptz_poss2_tokens], dim=1)
+        x = predictor_tokens(
+            x, self.predictor_pos_embed,
+            self.ptz_poss1_embed(poss_x),
+            self.ptz_poss2_embed(poss),
+            buffer=self.token_buffer)
 
         # -- fwd prop
-        for blk in self.predictor_blocks:
-            #x = checkpoint(blk, x)
-            x = blk(x)
-        #x = checkpoint(self.predictor_norm, x)
+        x = run_blocks(self.predictor_blocks, x, self.checkpoint_policy)
         x = self.predictor_norm(x)
 
         # -- return preds for mask tokens
@@ -343,6 +476,8 @@ class VisionTransformerRSSM(nn.Module):
         drop_path_rate=0.0,
         norm_layer=nn.LayerNorm,
         init_std=0.02,
+        fused_attention=False,
+        checkpoint_policy=None,
         **kwargs
     ):
         super().__init__()
@@ -361,13 +496,16 @@ class VisionTransformerRSSM(nn.Module):
         self.predictor_blocks = nn.ModuleList([
             Block(
                 dim=predictor_embed_dim, num_heads=num_heads, mlp_ratio=mlp_ratio, qkv_bias=qkv_bias, qk_scale=qk_scale,
-                drop=drop_rate, attn_drop=attn_drop_rate, drop_path=dpr[i], norm_layer=norm_layer)
+                drop=drop_rate, attn_drop=attn_drop_rate, drop_path=dpr[i], norm_layer=norm_layer,
+                fused_attention=fused_attention)
             for i in range(depth)])
         self.predictor_norm = norm_layer(predictor_embed_dim)
         self.predictor_proj = nn.Linear(predictor_embed_dim, embed_dim, bias=True)
+        self.token_buffer = TokenBuffer()
         self.reward_predictor = nn.Linear(predictor_embed_dim, 1, bias=True)
         # ------
         self.init_std = init_std
+        self.checkpoint_policy = checkpoint_policy
         self.apply(self._init_weights)
         self.fix_init_weight()
 
@@ -401,28 +539,16 @@ class VisionTransformerRSSM(nn.Module):
 
         # -- add positional embedding to x tokens
         # -- affecting them by the first ptz position
-        x_pos_embed = self.predictor_pos_embed.repeat(B, 1, 1)
-
-        pred_ptz_poss1_embeds = self.ptz_poss1_embed(poss_x.float())
-        pred_ptz_poss1_tokens = pred_ptz_poss1_embeds.repeat(x_pos_embed.size(1), 1, 1)
-        pred_ptz_poss1_tokens = pred_ptz_poss1_tokens.permute(1, 0, 2)
-
-        x += pred_ptz_poss1_tokens
-        x += x_pos_embed
-
+        # -- and append the second ptz position tokens
         _, N_ctxt, D = x.shape
-
-        # -- concat second ptz position tokens to x
-        pos_embs = self.predictor_pos_embed.repeat(B, 1, 1)
-
-        pred_ptz_poss2_embeds = self.ptz_poss2_embed(poss.float())
-        pred_ptz_poss2_tokens = pred_ptz_poss2_embeds.repeat(pos_embs.size(1), 1, 1)
-        pred_ptz_poss2_tokens = pred_ptz_poss2_tokens.permute(1, 0, 2)
-        x = torch.cat([x, pred_ptz_poss2_tokens], dim=1)
+        x = predictor_tokens(
+            x, self.predictor_pos_embed,
+            self.ptz_poss1_embed(poss_x.float()),
+            self.ptz_poss2_embed(poss.float()),
+            buffer=self.token_buffer)
 
         # -- fwd prop
-        for blk in self.predictor_blocks:
-            x = blk(x)
+        x = run_blocks(self.predictor_blocks, x, self.checkpoint_policy)
         x = self.predictor_norm(x)
 
         # -- return preds for mask tokens
@@ -462,6 +588,8 @@ class VisionTransformerAgent(nn.Module):
         norm_layer=nn.LayerNorm,
         init_std=0.02,
         num_actions=21,
+        fused_attention=False,
+        checkpoint_policy=None,
         **kwargs
     ):
         super().__init__()
@@ -480,12 +608,14 @@ class VisionTransformerAgent(nn.Module):
         self.predictor_blocks = nn.ModuleList([
             Block(
                 dim=predictor_embed_dim, num_heads=num_heads, mlp_ratio=mlp_ratio, qkv_bias=qkv_bias, qk_scale=qk_scale,
-                drop=drop_rate, attn_drop=attn_drop_rate, drop_path=dpr[i], norm_layer=norm_layer)
+                drop=drop_rate, attn_drop=attn_drop_rate, drop_path=dpr[i], norm_layer=norm_layer,
+                fused_attention=fused_attention)
             for i in range(depth)])
         self.predictor_norm = norm_layer(predictor_embed_dim)
         self.predictor_proj = nn.Linear(predictor_embed_dim, num_actions, bias=True)
         # ------
         self.init_std = init_std
+        self.checkpoint_policy = checkpoint_policy
         self.apply(self._init_weights)
         self.fix_init_weight()
 
@@ -520,15 +650,9 @@ class VisionTransformerAgent(nn.Module):
         x = self.predictor_embed(x)
 
         # -- add positional embedding to x tokens
-        # -- affecting them by the first ptz position
-        x_pos_embed = self.predictor_pos_embed.repeat(B, 1, 1)
-
-        pred_ptz_poss1_embeds = self.ptz_poss1_embed(poss_x)
-        pred_ptz_poss1_tokens = pred_ptz_poss1_embeds.repeat(x_pos_embed.size(1), 1, 1)
-        pred_ptz_poss1_tokens = pred_ptz_poss1_tokens.permute(1, 0, 2)
-
-        x += pred_ptz_poss1_tokens
-        x += x_pos_embed
+        # -- affecting them by the first ptz position (broadcast over tokens)
+        x += self.ptz_poss1_embed(poss_x).unsqueeze(1)
+        x += self.predictor_pos_embed
 
         _, N_ctxt, D = x.shape
 
@@ -541,8 +665,7 @@ class VisionTransformerAgent(nn.Module):
         #x = torch.cat([x, pred_ptz_poss2_tokens], dim=1)
 
         # -- fwd prop
-        for blk in self.predictor_blocks:
-            x = blk(x)
+        x = run_blocks(self.predictor_blocks, x, self.checkpoint_policy)
         x = self.predictor_norm(x)
 
         # -- return preds for mask tokens
@@ -582,6 +705,8 @@ class VisionTransformer(nn.Module):
         drop_path_rate=0.0,
         norm_layer=nn.LayerNorm,
         init_std=0.02,
+        fused_attention=False,
+        checkpoint_policy=None,
         **kwargs
     ):
         super().__init__()
@@ -605,11 +730,13 @@ class VisionTransformer(nn.Module):
         self.blocks = nn.ModuleList([
             Block(
                 dim=embed_dim, num_heads=num_heads, mlp_ratio=mlp_ratio, qkv_bias=qkv_bias, qk_scale=qk_scale,
-                drop=drop_rate, attn_drop=attn_drop_rate, drop_path=dpr[i], norm_layer=norm_layer)
+                drop=drop_rate, attn_drop=attn_drop_rate, drop_path=dpr[i], norm_layer=norm_layer,
+                fused_attention=fused_attention)
             for i in range(depth)])
         self.norm = norm_layer(embed_dim)
         # ------
         self.init_std = init_std
+        self.checkpoint_policy = checkpoint_policy
         self.apply(self._init_weights)
         self.fix_init_weight()
 
@@ -644,12 +771,9 @@ class VisionTransformer(nn.Module):
         x = x + pos_embed
 
         # -- fwd prop
-        for i, blk in enumerate(self.blocks):
-            #x = checkpoint(blk, x)
-            x = blk(x)
+        x = run_blocks(self.blocks, x, self.checkpoint_policy)
 
         if self.norm is not None:
-            #x = checkpoint(self.norm, x)
             x = self.norm(x)
 
         return x
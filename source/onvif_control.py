@@ -4,6 +4,8 @@ Library for control AXIS PTZ cameras using Onvif
 import logging
 from onvif import ONVIFCamera
 
+from source.ptz_state import PTZStateCache, MoveWaiter
+
 logging.basicConfig(filename='teste-onvif.log', filemode='w', level=logging.DEBUG)
 logging.info('Started')
 
@@ -13,10 +15,13 @@ class CameraControl:
     Module for control cameras AXIS using Onvif
     """
 
-    def __init__(self, ip, user, password):
+    def __init__(self, ip, user, password, state_staleness=1.0):
         self.__cam_ip = ip
         self.__cam_user = user
         self.__cam_password = password
+        self.state = PTZStateCache(self._query_ptz, staleness=state_staleness)
+        self.waiter = MoveWaiter()
+        self._move_idle = None
 
     @staticmethod
     def _map_onvif_to_vapix(value, min_onvif, max_onvif, min_vapix, max_vapix):
@@ -61,10 +66,14 @@ class CameraControl:
         Returns:
             Return onvif's response
         """
+        # confirm the position before the move, wait_move() starts from it
+        self.state.get()
         request = self.camera_ptz.create_type('AbsoluteMove')
         request.ProfileToken = self.camera_media_profile.token
         request.Position = {'PanTilt': {'x': pan, 'y': tilt}, 'Zoom': zoom}
+        self.state.commanded((pan, tilt, zoom))
         resp = self.camera_ptz.AbsoluteMove(request)
+        self.wait_move()
         logging.info('camera_command( aboslute_move(%f, %f, %f) )', pan, tilt, zoom)
         return resp
 
@@ -83,6 +92,7 @@ class CameraControl:
         request = self.camera_ptz.create_type('ContinuousMove')
         request.ProfileToken = self.camera_media_profile.token
         request.Velocity = {'PanTilt': {'x': pan, 'y': tilt}, 'Zoom': zoom}
+        self.state.commanded()
         resp = self.camera_ptz.ContinuousMove(request)
         logging.info('camera_command( continuous_move(%f, %f, %f) )', pan, tilt, zoom)
         return resp
@@ -99,13 +109,28 @@ class CameraControl:
         Returns:
             Return onvif's response
         """
+        current_pan, current_tilt, current_zoom = self.state.get()
         request = self.camera_ptz.create_type('RelativeMove')
         request.ProfileToken = self.camera_media_profile.token
         request.Translation = {'PanTilt': {'x': pan, 'y': tilt}, 'Zoom': zoom}
+        self.state.commanded((current_pan + pan, current_tilt + tilt, current_zoom + zoom))
         resp = self.camera_ptz.RelativeMove(request)
+        self.wait_move()
         logging.info('camera_command( relative_move(%f, %f, %f) )', pan, tilt, zoom)
         return resp
 
+    def wait_move(self):
+        """
+        Polls GetStatus until the camera reports IDLE (or, if the camera does not
+        report its move status, until the position stops changing), after it has
+        been seen moving: IDLE is also reported before the move starts.
+
+        Returns:
+            Returns the settled (pan, tilt, zoom)
+        """
+        return self.waiter.wait(self.state.refresh, reached=lambda _: self._move_idle is not False,
+                                start=self.state.start_state, moving=lambda _: self._move_idle is False)
+
     def stop_move(self):
         """
         Operation to stop ongoing pan, tilt and zoom movements of absolute relative and continuous type.
@@ -115,6 +140,7 @@ class CameraControl:
         """
         request = self.camera_ptz.create_type('Stop')
         request.ProfileToken = self.camera_media_profile.token
+        self.state.commanded()
         resp = self.camera_ptz.Stop(request)
         logging.info('camera_command( stop_move() )')
         return resp
@@ -142,13 +168,23 @@ class CameraControl:
         """
         request = self.camera_ptz.create_type('GotoHomePosition')
         request.ProfileToken = self.camera_media_profile.token
+        self.state.commanded()
         resp = self.camera_ptz.GotoHomePosition(request)
         logging.info('camera_command( go_home_position() )')
         return resp
 
     def get_ptz(self):
         """
-        Operation to request PTZ status.
+        Operation to request PTZ status, served from the state cache while it is not stale.
+
+        Returns:
+            Returns a list with the values ​​of Pan, Tilt and Zoom
+        """
+        return self.state.get()
+
+    def _query_ptz(self):
+        """
+        Requests the PTZ status (GetStatus) from the camera.
 
         Returns:
             Returns a list with the values ​​of Pan, Tilt and Zoom
@@ -156,6 +192,12 @@ class CameraControl:
         request = self.camera_ptz.create_type('GetStatus')
         request.ProfileToken = self.camera_media_profile.token
         ptz_status = self.camera_ptz.GetStatus(request)
+        move_status = getattr(ptz_status, 'MoveStatus', None)
+        if move_status is not None and move_status.PanTilt is not None:
+            self._move_idle = str(move_status.PanTilt).upper() == 'IDLE' and \
+                (move_status.Zoom is None or str(move_status.Zoom).upper() == 'IDLE')
+        else:
+            self._move_idle = None
         pan = ptz_status.Position.PanTilt.x
         tilt = ptz_status.Position.PanTilt.y
         zoom = ptz_status.Position.Zoom.x
@@ -256,6 +298,7 @@ class CameraControl:
             str1 = str(presets[i].Name)
             if str1 == preset_position:
                 request.PresetToken = presets[i].token
+                self.state.commanded()
                 resp = self.camera_ptz.GotoPreset(request)
                 logging.info("Goes to (\'%s\')", preset_position)
                 return resp
@@ -8,12 +8,13 @@ import subprocess
 import os
 import shutil
 import pandas as pd
-from PIL import Image
 from torch import Tensor
 import torch
 
 from waggle.plugin import Plugin
 
+from source.datasets.image_catalog import ImageCatalog, validate_jpeg, write_image, link_or_copy
+
 logger = logging.getLogger(__name__)
 
 try:
@@ -56,7 +57,11 @@ def grab_image(camera, args):
     ct = datetime.datetime.now().strftime("%Y-%m-%d_%H:%M:%S.%f")
     img_path = str(tmp_dir / f"{pos_str}_{ct}.jpg")
     try:
-        camera.snap_shot(img_path)
+        # -- validated in memory and written once, collect_images only links it
+        data = validate_jpeg(camera.snap_shot_bytes())
+        if data is None:
+            raise IOError("invalid JPEG from camera")
+        write_image(data, img_path)
     # TODO: need to check what kind of exception is raised
     except Exception as e:
         logger.error("Error when taking snap shot: %s : %s", img_path, e)
@@ -102,41 +107,58 @@ def verify_image(fpath, try_fix=True):
         bool: True if the image file is valid or successfully fixed, False otherwise.
     """
     try:
-        image = Image.open(fpath)
-        image.verify()
-        if try_fix:
-            # to fix corrupted images
-            image = Image.open(fpath)
-            image.save(fpath)
-        return True
-    except (OSError, IOError, SyntaxError) as e:
+        with open(fpath, "rb") as f:
+            data = f.read()
+    except OSError as e:
         logger.exception("Error: %s : %s", fpath, e.strerror)
         return False
+    fixed = validate_jpeg(data, try_fix=try_fix)
+    if fixed is None:
+        logger.error("Error: %s : invalid image", fpath)
+        return False
+    if fixed is not data:
+        # only truncated images are re-encoded
+        write_image(fixed, fpath)
+    return True
 
 
-def collect_images(keepimages):
-    coll_dir.mkdir(exist_ok=True, mode=0o777)
-    # files = glob.glob("/imgs/*.jpg", recursive=True)
-    num_image = 0
-    for fp in tmp_dir.glob("*.jpg"):
-        if verify_image(fp):
-            try:
-                shutil.copy(fp, coll_dir)
-                num_image += 1
-            except OSError as e:
-                logger.error("Error: %s : %s", fp, e.strerror)
+def collect_images(keepimages, src_dir=None, dst_dir=None, keep_dir=None):
+    """
+    Links the images of `src_dir` (default tmp_dir) into `dst_dir` (default
+    coll_dir) and, with `keepimages`, into `keep_dir` (default persistence
+    collected_imgs). Images are validated when they are captured, so they
+    are neither re-read nor copied here unless the directories are on
+    different filesystems.
+
+    Returns:
+        int: The number of images collected.
+    """
+    src_dir = tmp_dir if src_dir is None else Path(src_dir)
+    dst_dir = coll_dir if dst_dir is None else Path(dst_dir)
+    dst_dir.mkdir(exist_ok=True, mode=0o777, parents=True)
+    dest = None
     if keepimages:
-        dest = persis_dir / "collected_imgs"
-        dest.mkdir(exist_ok=True, mode=0o777)
+        dest = persis_dir / "collected_imgs" if keep_dir is None else Path(keep_dir)
+        dest.mkdir(exist_ok=True, mode=0o777, parents=True)
         # check mode of the directory, enforce it to be accessible by everyone
         if dest.stat().st_mode != 0o777:
             os.chmod(dest, 0o777)
-        for fp in coll_dir.glob("*.jpg"):
-            try:
-                dest_fp = shutil.copy(fp, dest)
+    # files = glob.glob("/imgs/*.jpg", recursive=True)
+    num_image = 0
+    kept = []
+    for fp in src_dir.glob("*.jpg"):
+        try:
+            coll_fp = link_or_copy(fp, dst_dir)
+            num_image += 1
+            if dest is not None:
+                dest_fp = link_or_copy(coll_fp, dest)
                 os.chmod(dest_fp, 0o666)  # RW for all
-            except OSError as e:
-                logger.error("Error: %s : %s", fp, e.strerror)
+                kept.append(dest_fp)
+        except OSError as e:
+            logger.error("Error: %s : %s", fp, e.strerror)
+    if kept:
+        # -- already validated at capture, only checksummed into the manifest
+        ImageCatalog(dest).add(kept, verify=False)
     return num_image
 
 
@@ -145,30 +167,23 @@ def get_images_from_storage(args):
         operate_ptz(args)
     else:
         logger.info("Getting images from storage")
-        if coll_dir.exists():
-            # remove the directory and its contents
-            # this ensure only images from persistence are used
-            shutil.rmtree(coll_dir)
-        coll_dir.mkdir(mode=0o777)
-        img_dir = persis_dir / "collected_imgs"
-        for fp in img_dir.glob("*.jpg"):
-            try:
-                shutil.copy(fp, coll_dir)
-            except OSError as e:
-                logger.error("Error: %s : %s", fp, e.strerror)
+        # only images from persistence are used: coll_dir is made to mirror
+        # the selection with hard links, unchanged images stay in place
+        catalog = ImageCatalog(persis_dir / "collected_imgs")
+        catalog.sync()
+        labels = catalog.select(limit=getattr(args, "maximages", 0))
+        num_image = catalog.link_into(coll_dir, labels)
+        logger.info("Selected %d of %d stored images", num_image, len(catalog))
 
 
 def prepare_images(label_dir="./"):
     """Prepare images for training.
     Check if all images are valid and remove invalid ones.
     """
-    labels = []
-    for fp in coll_dir.glob("*.jpg"):
-        if verify_image(fp):
-            labels.append(fp.stem)
-        else:
-            fp.unlink()
-    df = pd.DataFrame(labels)
+    # only images missing from the manifest are verified (invalid ones removed)
+    catalog = ImageCatalog(coll_dir)
+    catalog.sync()
+    df = pd.DataFrame(catalog.labels())
     label_path = Path(label_dir, "labels.txt")
     df.to_csv(label_path, header=False, index=False)
     os.chmod(label_path, 0o666)  # RW for all
@@ -211,15 +226,23 @@ def set_relative_position(camera, args, pan, tilt, zoom):
                 )
 
 
-def set_random_position(camera, args):
-    if args.camerabrand == 0:
+def random_position(camerabrand):
+    """ :returns: a random absolute (pan, tilt, zoom) for the camera brand """
+    if camerabrand == 0:
         pan_pos = np.random.randint(0, 360)
         tilt_pos = np.random.randint(-20, 90)
         zoom_pos = np.random.randint(1, 2)
-    elif args.camerabrand == 1:
+    elif camerabrand == 1:
         pan_pos = np.random.randint(-180, 180)
         tilt_pos = np.random.randint(-180, 180)
         zoom_pos = np.random.randint(100, 200)
+    else:
+        raise ValueError("Not known camera brand number: ", camerabrand)
+    return pan_pos, tilt_pos, zoom_pos
+
+
+def set_random_position(camera, args):
+    pan_pos, tilt_pos, zoom_pos = random_position(args.camerabrand)
     try:
         if args.camerabrand == 0:
             camera.absolute_control(float(pan_pos), float(tilt_pos), float(zoom_pos))
@@ -233,8 +256,6 @@ def set_random_position(camera, args):
                     "cannot.set.camera.random.position", str(datetime.datetime.now())
                 )
 
-    time.sleep(1)
-
 
 def collect_positions(positions: List[str], current_time: None):
     directory = persis_dir / "collected_positions"
@@ -271,24 +292,50 @@ def collect_embeds_rewards(embeds: List[Tensor], rewards: List[Tensor], current_
     change_ownership(directory)
 
 
-def operate_ptz(args):
-    if args.camerabrand == 0:
+def relative_move_values(camerabrand):
+    """ :returns: the pan, tilt and zoom steps random relative moves are drawn from """
+    pan_modulation = 2
+    tilt_modulation = 2
+    zoom_modulation = 1 if camerabrand == 0 else 1000
+    # if args.camerabrand==0:
+    #     zoom_modulation = 1
+    # elif args.camerabrand==1:
+    #     zoom_modulation = 1000
+
+    pan_values = np.array([-5, -1, -0.1, 0, 0.1, 1, 5])
+    pan_values *= pan_modulation
+    tilt_values = np.array([-5, -1, -0.1, 0, 0.1, 1, 5])
+    tilt_values *= tilt_modulation
+    zoom_values = np.array([-0.2, -0.1, 0, 0.1, 0.2])
+    zoom_values *= zoom_modulation
+    return pan_values, tilt_values, zoom_values
+
+
+def get_camera_module(camerabrand):
+    """ :returns: the driver module of the camera brand """
+    if camerabrand == 0:
         logger.info("Importing Hanwha")
         from source import sunapi_control as camera_control
-    elif args.camerabrand == 1:
+    elif camerabrand == 1:
         logger.info("Importing Axis")
         from source import vapix_control as camera_control
 
         # from source import onvif_control as camera_control
     else:
-        raise ValueError("Not known camera brand number: ", args.camerabrand)
+        raise ValueError("Not known camera brand number: ", camerabrand)
+    return camera_control
+
+
+def operate_ptz(args):
+    camera_control = get_camera_module(args.camerabrand)
 
     iterations = args.iterations
     number_of_commands = args.movements
 
     try:
         Camera1 = camera_control.CameraControl(
-            args.cameraip, args.username, args.password
+            args.cameraip, args.username, args.password,
+            state_staleness=args.positionstaleness
         )
     except Exception as e:
         logger.error("Error when getting camera: %s", e)
@@ -310,27 +357,13 @@ def operate_ptz(args):
                     timestamp=datetime.datetime.now(),
                 )
     # reset the camera to its original position
+    # absolute moves return once the camera has settled
     if args.camerabrand == 0:
         Camera1.absolute_control(1, 1, 1)
-        time.sleep(1)
     elif args.camerabrand == 1:
         Camera1.absolute_move(1, 1, 1)
-        time.sleep(1)
-
-    pan_modulation = 2
-    tilt_modulation = 2
-    zoom_modulation = 1 if args.camerabrand == 0 else 1000
-    # if args.camerabrand==0:
-    #     zoom_modulation = 1
-    # elif args.camerabrand==1:
-    #     zoom_modulation = 1000
 
-    pan_values = np.array([-5, -1, -0.1, 0, 0.1, 1, 5])
-    pan_values *= pan_modulation
-    tilt_values = np.array([-5, -1, -0.1, 0, 0.1, 1, 5])
-    tilt_values *= tilt_modulation
-    zoom_values = np.array([-0.2, -0.1, 0, 0.1, 0.2])
-    zoom_values *= zoom_modulation
+    pan_values, tilt_values, zoom_values = relative_move_values(args.camerabrand)
     if args.publish_msgs:
         with Plugin() as plugin:
             plugin.publish(
@@ -348,6 +381,7 @@ def operate_ptz(args):
                 plugin.publish("iteration.number", iteration)
 
         tmp_dir.mkdir(exist_ok=True, mode=0o777)
+        round_start = time.time()
         PAN = np.random.choice(pan_values, number_of_commands)
         TILT = np.random.choice(tilt_values, number_of_commands)
         ZOOM = np.random.choice(zoom_values, number_of_commands)
@@ -371,16 +405,18 @@ def operate_ptz(args):
 
             grab_image(camera=Camera1, args=args)
 
+        logger.info("round %d: %d movements in %.1f s, settle times %s",
+                    iteration, number_of_commands, time.time() - round_start,
+                    Camera1.waiter.settle_times.summary())
         # publish_images()
         collect_images(args.keepimages)
         shutil.rmtree(tmp_dir, ignore_errors=True)
 
+    # absolute moves return once the camera has settled
     if args.camerabrand == 0:
         Camera1.absolute_control(1, 1, 1)
-        time.sleep(1)
     elif args.camerabrand == 1:
         Camera1.absolute_move(1, 1, 1)
-        time.sleep(1)
     if args.publish_msgs:
         with Plugin() as plugin:
             plugin.publish("finishing.image.collection", str(datetime.datetime.now()))
@@ -0,0 +1,176 @@
+"""
+Cached PTZ state shared by the camera drivers
+"""
+import time
+import logging
+import threading
+
+
+logger = logging.getLogger(__name__)
+
+
+class PTZStateCache(object):
+    """
+    Last commanded and last confirmed state of a PTZ camera.
+
+    `query` is the driver's status request. get() returns the confirmed
+    state while it is younger than `staleness` seconds and only queries the
+    camera otherwise. Drivers call commanded() when they send a move, with
+    the (pan, tilt, zoom) target of absolute and relative moves (None for
+    continuous moves, presets and stops), which drops the confirmed state
+    until the move is confirmed with confirm() (or a refresh()), so a
+    position is never served from before a move. The confirmed state at
+    the time of the command is kept in start_state.
+    """
+
+    def __init__(self, query, staleness=1.0):
+        self.query = query
+        self.staleness = staleness
+        self.commanded_state = None
+        self.start_state = None
+        self.confirmed_state = None
+        self.confirmed_at = None
+        self.queries = 0
+        self.hits = 0
+        self._lock = threading.Lock()
+
+    def refresh(self):
+        """ Query the camera and confirm its state """
+        state = self.query()
+        with self._lock:
+            self.queries += 1
+        self.confirm(state)
+        return state
+
+    def get(self, max_age=None):
+        """ :returns: the confirmed state if younger than max_age (default staleness), else a fresh one """
+        max_age = self.staleness if max_age is None else max_age
+        with self._lock:
+            fresh = (self.confirmed_state is not None
+                     and time.monotonic() - self.confirmed_at <= max_age)
+            if fresh:
+                self.hits += 1
+                return self.confirmed_state
+        return self.refresh()
+
+    def confirm(self, state):
+        with self._lock:
+            self.confirmed_state = state
+            self.confirmed_at = time.monotonic()
+
+    def commanded(self, target=None):
+        """ Record a move command, `target` is the expected final state if known """
+        with self._lock:
+            self.commanded_state = target
+            self.start_state = self.confirmed_state
+            self.confirmed_state = None
+            self.confirmed_at = None
+
+    def settled(self):
+        """ The camera finished a move and its last confirmed state still holds """
+        with self._lock:
+            if self.confirmed_state is not None:
+                self.confirmed_at = time.monotonic()
+
+    def invalidate(self):
+        with self._lock:
+            self.confirmed_state = None
+            self.confirmed_at = None
+
+
+class SettleHistogram(object):
+    """ Counts of move settle times (seconds) per bucket """
+
+    def __init__(self, edges=(0.1, 0.25, 0.5, 1., 2., 5., 10.)):
+        self.edges = list(edges)
+        self.counts = [0] * (len(self.edges) + 1)
+        self.total = 0.
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def update(self, seconds):
+        bucket = next((i for i, edge in enumerate(self.edges) if seconds <= edge), len(self.edges))
+        with self._lock:
+            self.counts[bucket] += 1
+            self.total += seconds
+            self.count += 1
+
+    @property
+    def avg(self):
+        return self.total / max(self.count, 1)
+
+    def summary(self):
+        labels = [f'<={edge:g}s' for edge in self.edges] + [f'>{self.edges[-1]:g}s']
+        buckets = ' '.join(f'{label}:{count}' for label, count in zip(labels, self.counts) if count)
+        return f'{self.count} moves, avg {self.avg:.2f}s [{buckets}]'
+
+
+class MoveWaiter(object):
+    """
+    Waits for a PTZ move to complete by polling the camera status.
+
+    Polls start `min_interval` apart and back off by `backoff` up to
+    `max_interval`. A move is settled once `reached(state)` holds (if
+    given) and `stable_reads` consecutive reads agree within `tolerance`,
+    or when the state has not changed for `max_stable_reads` reads (the
+    camera stopped short, e.g. at a limit), or after `timeout` seconds.
+    Settle times are recorded in `settle_times`.
+
+    The first polls may still see the camera before it starts moving,
+    where it is idle and possibly already within the margins of the
+    target. So a settle is only accepted once the camera has been seen
+    moving: a state that differs from `start` (the state before the
+    command, else the first poll), or `moving(state)` reported by the
+    camera, or else once `min_settle` seconds have passed (a move to
+    where the camera already is).
+    """
+
+    def __init__(self, min_interval=0.05, max_interval=0.5, backoff=1.5, timeout=10.,
+                 stable_reads=2, max_stable_reads=8, tolerance=1e-3, min_settle=0.5):
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.backoff = backoff
+        self.timeout = timeout
+        self.stable_reads = stable_reads
+        self.max_stable_reads = max_stable_reads
+        self.tolerance = tolerance
+        self.min_settle = min_settle
+        self.settle_times = SettleHistogram()
+
+    def _same(self, a, b):
+        return all(abs(x - y) <= self.tolerance for x, y in zip(a, b))
+
+    def wait(self, poll, reached=None, start=None, moving=None):
+        """
+        :param poll: callable returning the current (pan, tilt, zoom, ...) state
+        :param reached: optional predicate on the state, True once at the target
+        :param start: optional state before the move command
+        :param moving: optional predicate on the state, True while the camera reports a move
+        :returns: the last polled state
+        """
+        start_time = time.monotonic()
+        interval = self.min_interval
+        last, stable = None, 1
+        departed = False
+        while True:
+            state = poll()
+            if start is None:
+                start = state
+            departed = departed or not self._same(state, start) or (moving is not None and moving(state))
+            stable = stable + 1 if last is not None and self._same(state, last) else 1
+            last = state
+            started = departed or time.monotonic() - start_time >= self.min_settle
+            at_target = reached is None or reached(state)
+            if started and at_target and stable >= self.stable_reads:
+                break
+            if stable >= self.max_stable_reads:
+                if not at_target:
+                    logger.warning('Camera stopped before reaching the target: %s', state)
+                break
+            if time.monotonic() - start_time > self.timeout:
+                logger.warning('Camera did not settle in %.1f s', self.timeout)
+                break
+            time.sleep(interval)
+            interval = min(interval * self.backoff, self.max_interval)
+        self.settle_times.update(time.monotonic() - start_time)
+        return state
@@ -1,7 +1,14 @@
 import random
+import logging
+import threading
 
 from collections import namedtuple, deque
 
+import torch
+
+
+logger = logging.getLogger(__name__)
+
 
 Transition = namedtuple('Transition',
                         ('state', 'position', 'action', 'next_state', 'next_position', 'reward'))
@@ -19,3 +26,311 @@ class ReplayMemory(object):
 
     def __len__(self):
         return len(self.memory)
+
+
+class TensorReplayMemory(object):
+    """
+    Ring-buffer replay memory over preallocated contiguous tensors.
+
+    Storage is allocated on the first push from the shapes of the
+    transition. With a CUDA `device` the buffers live on the GPU; on the
+    CPU they can be pinned, and batches are then gathered into pinned
+    staging buffers and copied with non_blocking=True; a staging buffer is
+    only refilled once the CUDA event recorded after its last copy is done.
+
+    sample() returns (Transition of batch tensors, indices, weights).
+    Indices are drawn with replacement, in O(batch_size): uniformly, or in
+    prioritized mode proportionally to priority**alpha, with weights the
+    normalized importance-sampling weights (otherwise weights is None).
+    """
+
+    def __init__(
+        self,
+        capacity,
+        device=None,
+        storage_device=None,
+        pin_memory=False,
+        prioritized=False,
+        alpha=0.6,
+        beta=0.4,
+        eps=1e-6
+    ):
+        self.capacity = int(capacity)
+        self.device = torch.device('cpu') if device is None else torch.device(device)
+        self.storage_device = self.device if storage_device is None else torch.device(storage_device)
+        self.pin_memory = pin_memory and self.storage_device.type == 'cpu' and torch.cuda.is_available()
+        self.prioritized = prioritized
+        self.alpha = alpha
+        self.beta = beta
+        self.eps = eps
+        self.buffers = None
+        self.priorities = None
+        self._staging = {}
+        self._staging_events = {}
+        self.ptr = 0
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def _allocate(self, transition):
+        self.buffers = {}
+        for name, value in transition._asdict().items():
+            dtype = torch.int64 if name == 'action' else torch.float32
+            self.buffers[name] = torch.empty(
+                (self.capacity,) + tuple(value.shape[1:]),
+                dtype=dtype,
+                device=self.storage_device,
+                pin_memory=self.pin_memory)
+        if self.prioritized:
+            self.priorities = torch.zeros(self.capacity, dtype=torch.float32, device=self.storage_device)
+
+    def push(self, *args):
+        """Save a transition"""
+        self.push_batch(*[torch.as_tensor(a).unsqueeze(0) for a in args])
+
+    def push_batch(self, *args):
+        """ Save n transitions, every argument has the transitions along dim 0 """
+        transition = Transition(*args)
+        if self.buffers is None:
+            self._allocate(transition)
+        n = transition.state.shape[0]
+        if n > self.capacity:
+            transition = Transition(*[a[-self.capacity:] for a in transition])
+            n = self.capacity
+        idx = (self.ptr + torch.arange(n, device=self.storage_device)) % self.capacity
+        for name, value in transition._asdict().items():
+            buffer = self.buffers[name]
+            if name == 'action':
+                value = value.round()
+            buffer.index_copy_(0, idx, value.to(buffer.device, dtype=buffer.dtype).reshape((n,) + buffer.shape[1:]))
+        if self.prioritized:
+            # -- new transitions get the current max priority so they are seen at least once
+            max_priority = self.priorities[:self.size].max() if self.size > 0 else torch.tensor(1.)
+            self.priorities.index_fill_(0, idx, float(max_priority))
+        self.ptr = (self.ptr + n) % self.capacity
+        self.size = min(self.size + n, self.capacity)
+
+    def _gather(self, name, indices, staging_key=None):
+        buffer = self.buffers[name]
+        if not self.pin_memory:
+            return buffer.index_select(0, indices).to(self.device, non_blocking=True)
+        B = indices.shape[0]
+        staging_key = name if staging_key is None else staging_key
+        staging = self._staging.get(staging_key)
+        if staging is None or staging.shape[0] != B:
+            staging = torch.empty((B,) + buffer.shape[1:], dtype=buffer.dtype, pin_memory=True)
+            self._staging[staging_key] = staging
+            self._staging_events.pop(staging_key, None)
+        event = self._staging_events.get(staging_key)
+        if event is not None:
+            # -- the previous copy out of this staging buffer may still be in flight
+            event.synchronize()
+        torch.index_select(buffer, 0, indices, out=staging)
+        batch = staging.to(self.device, non_blocking=True)
+        if self.device.type == 'cuda':
+            event = torch.cuda.Event()
+            event.record()
+            self._staging_events[staging_key] = event
+        return batch
+
+    def _batch(self, indices):
+        return Transition(*[self._gather(name, indices) for name in Transition._fields])
+
+    def sample(self, batch_size):
+        indices, weights = self.draw(len(self), batch_size)
+        return self._batch(indices), indices, weights
+
+    def draw(self, size, batch_size):
+        """ :returns: indices among the first `size` transitions and their weights (or None) """
+        if batch_size > size:
+            raise ValueError(f'Sample larger than population ({batch_size} > {size})')
+        weights = None
+        if self.prioritized:
+            probs = self.priorities[:size].pow(self.alpha)
+            probs /= probs.sum()
+            indices = torch.multinomial(probs, batch_size, replacement=True)
+            weights = (size * probs[indices]).pow(-self.beta)
+            weights = (weights / weights.max()).to(self.device, non_blocking=True)
+        else:
+            indices = torch.randint(size, (batch_size,), device=self.storage_device)
+        return indices, weights
+
+    def update_priorities(self, indices, errors):
+        """ :param errors: absolute TD errors of the sampled transitions """
+        if not self.prioritized:
+            return
+        errors = errors.detach().to(self.priorities.device, dtype=torch.float32)
+        self.priorities.index_copy_(0, indices.to(self.priorities.device), errors.abs() + self.eps)
+
+
+class EpisodeReplayMemory(object):
+    """
+    Episode-major replay memory for dream rollouts.
+
+    Every state of a dream is stored once: the buffers hold whole episodes,
+    states/positions as [episodes * (T+1), ...] and actions/rewards as
+    [episodes * T]. Transition i is step t = i % T of episode e = i // T,
+    its next state is the following state row. The number of episodes kept
+    is bounded by `max_bytes`, older episodes are overwritten first.
+
+    Storage, device placement, pinned staging and (prioritized) sampling are
+    those of a TensorReplayMemory (`storage`) holding the episode buffers.
+    Episodes can be pushed from a background thread while sampling: writes
+    and the gathers of sample() hold the same lock, so a batch never mixes
+    rows of an episode being overwritten.
+    """
+
+    def __init__(self, max_episodes, steps, max_bytes=None, **kwargs):
+        self.storage = TensorReplayMemory(max_episodes * steps, **kwargs)
+        self.max_episodes = int(max_episodes)
+        self.steps = int(steps)
+        self.max_bytes = max_bytes
+        self.num_episodes = 0
+        self.ptr = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        with self._lock:
+            return self.num_episodes * self.steps
+
+    @property
+    def device(self):
+        return self.storage.device
+
+    def _allocate_episodes(self, states, positions):
+        T = self.steps
+        storage = self.storage
+        state_shape = tuple(states.shape[2:])
+        position_shape = tuple(positions.shape[2:])
+        # -- float32 states/positions/rewards, int64 actions
+        episode_bytes = 4 * (T + 1) * (_numel(state_shape) + _numel(position_shape)) + 12 * T
+        if self.max_bytes is not None:
+            self.max_episodes = max(1, min(self.max_episodes, int(self.max_bytes // episode_bytes)))
+        storage.capacity = self.max_episodes * T
+        logger.info('Replay memory: %d episodes (%.2f GB) on %s' % (
+            self.max_episodes, self.max_episodes * episode_bytes / 1024.**3, storage.storage_device))
+
+        def empty(shape, dtype=torch.float32):
+            return torch.empty(shape, dtype=dtype, device=storage.storage_device, pin_memory=storage.pin_memory)
+        storage.buffers = {
+            'state': empty((self.max_episodes * (T + 1),) + state_shape),
+            'position': empty((self.max_episodes * (T + 1),) + position_shape),
+            'action': empty((storage.capacity,), dtype=torch.int64),
+            'reward': empty((storage.capacity,)),
+        }
+        if storage.prioritized:
+            storage.priorities = torch.zeros(storage.capacity, dtype=torch.float32, device=storage.storage_device)
+
+    def push_episodes(self, states, positions, actions, rewards):
+        """
+        :param states: [B, T+1, ...] state sequences
+        :param positions: [B, T+1, 3] position sequences
+        :param actions: [B, T] actions
+        :param rewards: [B, T] rewards
+        """
+        storage = self.storage
+        with self._lock:
+            if storage.buffers is None:
+                self._allocate_episodes(states, positions)
+            T = self.steps
+            B = min(states.shape[0], self.max_episodes)
+            states, positions, actions, rewards = states[-B:], positions[-B:], actions[-B:], rewards[-B:]
+            episodes = (self.ptr + torch.arange(B, device=storage.storage_device)) % self.max_episodes
+            state_rows = (episodes.unsqueeze(1) * (T + 1) + torch.arange(T + 1, device=storage.storage_device)).flatten()
+            step_rows = (episodes.unsqueeze(1) * T + torch.arange(T, device=storage.storage_device)).flatten()
+
+            def copy(name, rows, value):
+                buffer = storage.buffers[name]
+                value = value[:, :rows.shape[0] // B].to(buffer.device, dtype=buffer.dtype)
+                buffer.index_copy_(0, rows, value.reshape((rows.shape[0],) + buffer.shape[1:]))
+
+            copy('state', state_rows, states)
+            copy('position', state_rows, positions)
+            copy('action', step_rows, actions.round())
+            copy('reward', step_rows, rewards)
+            if storage.prioritized:
+                max_priority = storage.priorities[:self.num_episodes * T].max() if self.num_episodes > 0 else torch.tensor(1.)
+                storage.priorities.index_fill_(0, step_rows, float(max_priority))
+            self.ptr = (self.ptr + B) % self.max_episodes
+            self.num_episodes = min(self.num_episodes + B, self.max_episodes)
+            storage.size = self.num_episodes * T
+
+    def _batch(self, indices):
+        T = self.steps
+        gather = self.storage._gather
+        state_rows = indices // T * (T + 1) + indices % T
+        return Transition(
+            state=gather('state', state_rows),
+            position=gather('position', state_rows),
+            action=gather('action', indices),
+            next_state=gather('state', state_rows + 1, staging_key='next_state'),
+            next_position=gather('position', state_rows + 1, staging_key='next_position'),
+            reward=gather('reward', indices))
+
+    def sample(self, batch_size):
+        with self._lock:
+            indices, weights = self.storage.draw(self.num_episodes * self.steps, batch_size)
+            return self._batch(indices), indices, weights
+
+    def update_priorities(self, indices, errors):
+        with self._lock:
+            self.storage.update_priorities(indices, errors)
+
+
+def _numel(shape):
+    n = 1
+    for d in shape:
+        n *= d
+    return n
+
+
+class ReplayIngestion(object):
+    """ Fills an EpisodeReplayMemory from a dream DataLoader in a background thread """
+
+    def __init__(self, memory, dataloader):
+        self.memory = memory
+        self.dataloader = dataloader
+        self.error = None
+        self._done = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='replay-ingestion', daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def _run(self):
+        try:
+            for episodes in self.dataloader:
+                self.memory.push_episodes(
+                    episodes['state_sequence'],
+                    episodes['position_sequence'],
+                    episodes['action_sequence'],
+                    episodes['delta_reward_sequence'])
+        except Exception as e:
+            self.error = e
+        finally:
+            self._done.set()
+
+    @property
+    def done(self):
+        return self._done.is_set()
+
+    def _raise_error(self):
+        if self.error is not None:
+            raise RuntimeError('Replay ingestion failed') from self.error
+
+    def wait(self, min_size, poll=0.1):
+        """
+        Block until the memory holds `min_size` transitions or ingestion ended.
+        :returns: whether the memory holds `min_size` transitions
+        """
+        while len(self.memory) < min_size and not self._done.wait(poll):
+            pass
+        self._raise_error()
+        return len(self.memory) >= min_size
+
+    def sample(self, batch_size):
+        """ memory.sample(), raising the error of the ingestion thread if it failed """
+        self._raise_error()
+        return self.memory.sample(batch_size)
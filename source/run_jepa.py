@@ -35,7 +35,15 @@ from source.helper import (
     init_opt)
 from source.transforms import make_transforms
 
-from source.datasets.ptz_dataset import PTZImageDataset
+from source.datasets.image_shards import make_ptz_dataset, make_ptz_dataloader
+from source.datasets.frame_cache import FrameCache, transform_fingerprint
+from source.utils.tensors import all_pairs_index
+from source.utils.reward_signal import GradientRewardSignal
+from source.utils.ema import ModelEMA
+from source.utils.precision import PrecisionPolicy
+from source.utils.accumulation import GradientAccumulator
+from source.dream_engine import DreamEngine, build_action_table
+from source.datasets.dream_store import DreamStore
 
 from source.utils.redis_cli import MultiLockerSystem
 # --
@@ -67,60 +75,70 @@ def change_allocentric_position(position1, position2, camera_brand):
     position2[:,0] -= pan
     #position2[:,1] -= tilt
 
-def forward_target(images, target_encoder):
+def forward_target(images, target_encoder, index=None):
     h = target_encoder(images)
     h = F.layer_norm(h, (h.size(-1),))  # normalize over feature-dim
+    if index is not None:
+        # -- images are unique, expand the embeddings into pairs
+        h = h.index_select(0, index)
     return h
 
 def forward_context(images, position1, position2, encoder, predictor,
-                    camera_brand, return_rewards=False, change_position=True):
+                    camera_brand, return_rewards=False, change_position=True,
+                    index=None):
     #if change_position:
         #change_allocentric_position(position1, position2, camera_brand)
     encoder_z = encoder(images)
+    if index is not None:
+        # -- images are unique, expand the embeddings into pairs
+        encoder_z = encoder_z.index_select(0, index)
     pred_z, pred_r = predictor(encoder_z, position1, position2)
     if return_rewards:
         return pred_z, pred_r
     return pred_z
 
 def arrange_inputs(images, positions, device):
-    context_imgs = []
-    target_imgs = []
-    context_poss = []
-    target_poss = []
-    for context_idx in range(positions.shape[0]):
-        for target_idx in range(positions.shape[0]):
-            context_imgs.append(images[context_idx].unsqueeze(0))
-            context_poss.append(positions[context_idx].unsqueeze(0))
-            target_imgs.append(images[target_idx].unsqueeze(0))
-            target_poss.append(positions[target_idx].unsqueeze(0))
-
-
-    auxiliary = torch.Tensor(len(context_imgs), context_imgs[0].shape[1],
-                                                context_imgs[0].shape[2],
-                                                context_imgs[0].shape[3]).to(device, non_blocking=True)
-    torch.cat(context_imgs, out=auxiliary)
-    auxiliary = auxiliary.squeeze(1)
-    context_imgs = auxiliary.detach().clone()
-
-    auxiliary = torch.Tensor(len(context_poss), context_poss[0].shape[1]).to(device, non_blocking=True)
-    torch.cat(context_poss, out=auxiliary)
-    auxiliary = auxiliary.squeeze(1)
-    context_poss = auxiliary.detach().clone()
-
-
-    auxiliary = torch.Tensor(len(target_imgs), target_imgs[0].shape[1],
-                                                target_imgs[0].shape[2],
-                                                target_imgs[0].shape[3]).to(device, non_blocking=True)
-    torch.cat(target_imgs, out=auxiliary)
-    auxiliary = auxiliary.squeeze(1)
-    target_imgs = auxiliary.detach().clone()
-
-    auxiliary = torch.Tensor(len(target_poss), target_poss[0].shape[1]).to(device, non_blocking=True)
-    torch.cat(target_poss, out=auxiliary)
-    auxiliary = auxiliary.squeeze(1)
-    target_poss = auxiliary.detach().clone()
-
-    return context_imgs.to(device), context_poss.to(device), target_imgs.to(device), target_poss.to(device)
+    """
+    Build every (context, target) pair of a batch of B images.
+
+    Row i*B + j of the outputs pairs context image i with target image j.
+    Each output is produced by a single gather over the batch, so no
+    per-pair tensors are created. To encode each image only once, pass the
+    indices from all_pairs_index as ``index`` to forward_target /
+    forward_context instead, which expands the embeddings rather than the
+    pixels.
+    """
+    images = images.to(device, non_blocking=True)
+    positions = positions.to(device, dtype=torch.float32, non_blocking=True)
+    context_idx, target_idx = all_pairs_index(images.shape[0], device=device)
+
+    context_imgs = images.index_select(0, context_idx)
+    context_poss = positions.index_select(0, context_idx)
+    target_imgs = images.index_select(0, target_idx)
+    target_poss = positions.index_select(0, target_idx)
+
+    return context_imgs, context_poss, target_imgs, target_poss
+
+
+def arrange_step_inputs(images, positions, device, encode_once=False):
+    """
+    Inputs of a training step:
+    [context_imgs, context_poss, target_imgs, target_poss, context_idx, target_idx]
+
+    Without encode_once the images are expanded into B*B pairs and the
+    indices are None. With encode_once the B unique images are passed
+    through unchanged and the pair indices are returned instead, so the
+    encoders run once per image and only the predictor sees B*B inputs.
+    """
+    if not encode_once:
+        return [*arrange_inputs(images, positions, device), None, None]
+
+    images = images.to(device, non_blocking=True)
+    positions = positions.to(device, dtype=torch.float32, non_blocking=True)
+    context_idx, target_idx = all_pairs_index(images.shape[0], device=device)
+    return [images, positions.index_select(0, context_idx),
+            images, positions.index_select(0, target_idx),
+            context_idx, target_idx]
 
 
 def ijepa_train(args, resume_preempt=False):
@@ -136,12 +154,16 @@ def ijepa_train(args, resume_preempt=False):
     copy_data = args['meta']['copy_data']
     pred_depth = args['meta']['pred_depth']
     pred_emb_dim = args['meta']['pred_emb_dim']
+    encode_once = args['meta'].get('encode_once', False)
+    fused_attention = args['meta'].get('fused_attention', False)
+    activation_checkpointing = args['meta'].get('activation_checkpointing', None)
     camera_brand = args['meta']['camera_brand'] #TODO I have to fix it!!!!!!!!!! I have to include the arguments of main together with the arguments from the yalm file
     if not torch.cuda.is_available():
         device = torch.device('cpu')
     else:
         device = torch.device('cuda:0')
         torch.cuda.set_device(device)
+    precision = PrecisionPolicy.from_config(args['meta'], device)
 
     # -- DATA
     use_gaussian_blur = args['data']['use_gaussian_blur']
@@ -151,13 +173,17 @@ def ijepa_train(args, resume_preempt=False):
     # --
     global_batch_size = args['data']['global_batch_size']
     batch_size = args['data']['batch_size']
-    accumulation_steps = int(global_batch_size / batch_size)
+    accumulation_steps = max(global_batch_size // batch_size, 1)
     pin_mem = args['data']['pin_mem']
     num_workers = args['data']['num_workers']
     root_path = args['data']['root_path']
     image_folder = args['data']['image_folder']
     crop_size = args['data']['crop_size']
     crop_scale = args['data']['crop_scale']
+    persistent_workers = args['data'].get('persistent_workers', True)
+    image_shard_dir = args['data'].get('image_shard_dir', None)
+    image_shard_decoded = args['data'].get('image_shard_decoded', True)
+    augmentation_placement = args['data'].get('augmentation_placement', 'dataloader')
     # --
 
     # -- MASK
@@ -243,7 +269,9 @@ def ijepa_train(args, resume_preempt=False):
         crop_size=crop_size,
         pred_depth=pred_depth,
         pred_emb_dim=pred_emb_dim,
-        model_arch=model_arch)
+        model_arch=model_arch,
+        fused_attention=fused_attention,
+        activation_checkpointing=activation_checkpointing)
     target_encoder = copy.deepcopy(encoder)
 
 
@@ -255,14 +283,20 @@ def ijepa_train(args, resume_preempt=False):
         gaussian_blur=use_gaussian_blur,
         horizontal_flip=use_horizontal_flip,
         color_distortion=use_color_distortion,
-        color_jitter=color_jitter)
+        color_jitter=color_jitter,
+        placement=augmentation_placement)
+    batch_transform = getattr(transform, 'batch_transform', None)
 
 
     # -- init data-loader
-    data = PTZImageDataset('/collected_imgs', transform=transform)
-    dataloader = DataLoader(data, batch_size=batch_size, shuffle=False)
-    ipe = len(dataloader)
-    logger.info('Dataset size: %d' % ipe)
+    data = make_ptz_dataset('/collected_imgs', transform=transform, shard_dir=image_shard_dir,
+                            size=crop_size, decoded=image_shard_decoded)
+    dataloader = make_ptz_dataloader(data, batch_size=batch_size, shuffle=False, num_workers=num_workers,
+                                     pin_mem=pin_mem, persistent_workers=persistent_workers)
+    # -- iterations per epoch are optimizer steps, one per global batch
+    accumulator = GradientAccumulator(accumulation_steps, len(dataloader))
+    ipe = accumulator.steps_per_epoch
+    logger.info('Dataset size: %d batches, %d steps of %d batches' % (len(dataloader), ipe, accumulation_steps))
 
 
     # -- init optimizer and scheduler
@@ -278,7 +312,7 @@ def ijepa_train(args, resume_preempt=False):
         warmup=warmup,
         num_epochs=num_epochs,
         ipe_scale=ipe_scale,
-        use_bfloat16=use_bfloat16)
+        precision=precision)
 
 
     for p in target_encoder.parameters():
@@ -306,6 +340,8 @@ def ijepa_train(args, resume_preempt=False):
             wd_scheduler.step()
             next(momentum_scheduler)
 
+    target_ema = ModelEMA(encoder, target_encoder)
+
 
     def save_checkpoint(epoch):
         save_dict = {
@@ -328,86 +364,57 @@ def ijepa_train(args, resume_preempt=False):
         return loss
 
 
-    def train_step(inputs):
-        _new_lr = scheduler.step()
-        _new_wd = wd_scheduler.step()
-        # --
+    def train_step(step_inputs):
+        inputs, itr, num_images = step_inputs
 
         # Step 1. Forward
-        with torch.no_grad():
-            h = forward_target(inputs[2], target_encoder)
-        z = forward_context(inputs[0], inputs[1], inputs[3], encoder, predictor, camera_brand)
-        loss = loss_fn(z, h)
-        # Divide loss by accumulation steps
-        loss = loss / accumulation_steps
-
-
-
-        # Step 2. Backward & step
-        loss.backward()
+        with precision.autocast():
+            with torch.no_grad():
+                h = forward_target(inputs[2], target_encoder, index=inputs[5])
+            z = forward_context(inputs[0], inputs[1], inputs[3], encoder, predictor, camera_brand,
+                                index=inputs[4])
+            loss = loss_fn(z, h)
+
+        # Step 2. Backward, accumulated over the micro-batches of a global batch
+        accumulator.backward(loss, itr, precision, num_samples=num_images)
+        if not accumulator.is_step(itr):
+            return float(loss), None
+
+        # Step 3. Step once per global batch
+        _new_lr = scheduler.step()
+        _new_wd = wd_scheduler.step()
         ## Gradient Value Clipping
+        #precision.unscale_(optimizer)
         #torch.nn.utils.clip_grad_norm_(encoder.parameters(), max_norm=0.1)
         #torch.nn.utils.clip_grad_norm_(predictor.parameters(), max_norm=0.1)
-        optimizer.step()
+        precision.step(optimizer)
         grad_stats = grad_logger(encoder.named_parameters())
         optimizer.zero_grad()
 
+        # Step 4. momentum update of target encoder
+        m = next(momentum_scheduler)
+        target_ema.update(m)
 
-        # Step 3. momentum update of target encoder
-        with torch.no_grad():
-            m = next(momentum_scheduler)
-            for param_q, param_k in zip(encoder.parameters(), target_encoder.parameters()):
-                param_k.data.mul_(m).add_((1.-m) * param_q.detach().data)
-
-        return (float(loss), _new_lr, _new_wd, grad_stats)
-
-
-
-    def acumulate_train_step(inputs):
-        _new_lr = scheduler.step()
-        _new_wd = wd_scheduler.step()
-        # --
-
-        # Step 1. Forward
-        with torch.no_grad():
-            h = forward_target(inputs[2], target_encoder)
-        z = forward_context(inputs[0], inputs[1], inputs[3], encoder, predictor, camera_brand)
-        loss = loss_fn(z, h)
-        # Divide loss by accumulation steps
-        loss = loss / accumulation_steps
-
-        # Step 2. Backward & step
-        loss.backward()
-        #optimizer.step()
-        grad_stats = grad_logger(encoder.named_parameters())
-        #optimizer.zero_grad()
-
-
-        # Step 3. momentum update of target encoder
-        with torch.no_grad():
-            m = next(momentum_scheduler)
-            for param_q, param_k in zip(encoder.parameters(), target_encoder.parameters()):
-                param_k.data.mul_(m).add_((1.-m) * param_q.detach().data)
-
-        return (float(loss), _new_lr, _new_wd, grad_stats)
+        return float(loss), (_new_lr, _new_wd, grad_stats)
 
 
     # -- Logging
     #def log_stats(itr, epoch, loss, etime):
-    def log_stats(itr, epoch, loss, lr, wd, etime):
+    def log_stats(itr, epoch, loss, lr, wd, etime, samples_per_sec):
         csv_logger.log(epoch + 1, itr, loss, lr, wd, etime)
         #csv_logger.log(epoch + 1, itr, loss, etime)
         if (itr % log_freq == 0) or np.isnan(loss) or np.isinf(loss):
             logger.info('[%d, %5d] loss: %.3f '
                         '[wd: %.2e] [lr: %.2e] '
                         '[mem: %.2e] '
-                        '(%.1f ms)'
+                        '(%.1f ms) [%.1f img/s]'
                         % (epoch + 1, itr,
                            loss_meter.avg,
                            _new_wd,
                            _new_lr,
                            torch.cuda.max_memory_allocated() / 1024.**2,
-                           time_meter.avg))
+                           time_meter.avg,
+                           samples_per_sec))
 
             if grad_stats is not None:
                 logger.info('[%d, %5d] grad_stats: [%.2e %.2e] (%.2e, %.2e)'
@@ -428,29 +435,38 @@ def ijepa_train(args, resume_preempt=False):
 
         loss_meter = AverageMeter()
         time_meter = AverageMeter()
+        step_loss_meter = AverageMeter()
+        step_time = 0.
+        accumulator.start_epoch()
 
         for itr, (imgs, poss) in enumerate(dataloader):
             # poss = get_position_from_label(labls)
             imgs = imgs.to(device, non_blocking=True)
             poss = poss.to(device, non_blocking=True)
+            if batch_transform is not None:
+                imgs = batch_transform(imgs)
             
-            context_imgs, context_poss, target_imgs, target_poss = arrange_inputs(imgs, poss, device)
-
-            if itr%int(global_batch_size/batch_size)==0:
-                (loss, _new_lr, _new_wd, grad_stats), etime = gpu_timer(train_step, arguments=[context_imgs, context_poss, target_imgs, target_poss])
-            else:
-                (loss, _new_lr, _new_wd, grad_stats), etime = gpu_timer(acumulate_train_step, arguments=[context_imgs, context_poss, target_imgs, target_poss])
+            inputs = arrange_step_inputs(imgs, poss, device, encode_once)
 
-            #(loss, _new_lr, _new_wd, grad_stats), etime = gpu_timer(train_step, arguments=[context_imgs, context_poss, target_imgs, target_poss])
+            (loss, step_stats), etime = gpu_timer(train_step, arguments=[inputs, itr, imgs.shape[0]])
             loss_meter.update(loss)
-            time_meter.update(etime)
-            log_stats(itr, epoch, loss, _new_lr, _new_wd, etime)
-            #log_stats(itr, epoch, loss, etime)
+            step_loss_meter.update(loss)
+            step_time += etime
 
             assert not np.isnan(loss), 'loss is nan'
 
+            # -- log once per global batch
+            if step_stats is not None:
+                _new_lr, _new_wd, grad_stats = step_stats
+                samples_per_sec = accumulator.step_done()
+                time_meter.update(step_time)
+                log_stats(accumulator.step_index(itr), epoch, step_loss_meter.avg, _new_lr, _new_wd, step_time,
+                          samples_per_sec)
+                step_loss_meter.reset()
+                step_time = 0.
+
         # -- Save Checkpoint after every epoch
-        logger.info('avg. loss %.3f' % loss_meter.avg)
+        logger.info('avg. loss %.3f [%.1f img/s per global batch]' % (loss_meter.avg, accumulator.throughput.avg))
         loss_values.append(loss_meter.avg)
         save_checkpoint(epoch+1)
         change_ownership(ownership_folder)
@@ -476,11 +492,15 @@ def world_model(args, resume_preempt=False):
     pred_emb_dim = args['meta']['pred_emb_dim']
     camera_brand = args['meta']['camera_brand']
     distributed = args['meta']['distributed']
+    encode_once = args['meta'].get('encode_once', False)
+    fused_attention = args['meta'].get('fused_attention', False)
+    activation_checkpointing = args['meta'].get('activation_checkpointing', None)
     if not torch.cuda.is_available():
         device = torch.device('cpu')
     else:
         device = torch.device('cuda:0')
         torch.cuda.set_device(device)
+    precision = PrecisionPolicy.from_config(args['meta'], device)
 
     # -- DATA
     use_gaussian_blur = args['data']['use_gaussian_blur']
@@ -490,12 +510,17 @@ def world_model(args, resume_preempt=False):
     # --
     global_batch_size = args['data']['global_batch_size']
     batch_size = args['data']['batch_size']
+    accumulation_steps = max(global_batch_size // batch_size, 1)
     pin_mem = args['data']['pin_mem']
     num_workers = args['data']['num_workers']
     root_path = args['data']['root_path']
     image_folder = args['data']['image_folder']
     crop_size = args['data']['crop_size']
     crop_scale = args['data']['crop_scale']
+    persistent_workers = args['data'].get('persistent_workers', True)
+    image_shard_dir = args['data'].get('image_shard_dir', None)
+    image_shard_decoded = args['data'].get('image_shard_decoded', True)
+    augmentation_placement = args['data'].get('augmentation_placement', 'dataloader')
     # --
 
     # -- MASK
@@ -532,6 +557,12 @@ def world_model(args, resume_preempt=False):
     # -- MEMORY
     memory_models = args['memory']['models']
 
+    # -- REWARD SIGNAL
+    reward_args = args.get('reward_signal', {})
+    reward_mode = reward_args.get('mode', 'two_pass')
+    reward_subset_blocks = reward_args.get('subset_blocks', 2)
+    reward_calibration_freq = reward_args.get('calibration_freq', 100)
+
     # -- REDIS
     redis_host = args['redis']['host']
     redis_port = args['redis']['port']
@@ -631,7 +662,9 @@ def world_model(args, resume_preempt=False):
         crop_size=crop_size,
         pred_depth=pred_depth,
         pred_emb_dim=pred_emb_dim,
-        model_arch=model_arch)
+        model_arch=model_arch,
+        fused_attention=fused_attention,
+        activation_checkpointing=activation_checkpointing)
     target_encoder = copy.deepcopy(encoder)
 
 
@@ -643,16 +676,21 @@ def world_model(args, resume_preempt=False):
         gaussian_blur=use_gaussian_blur,
         horizontal_flip=use_horizontal_flip,
         color_distortion=use_color_distortion,
-        color_jitter=color_jitter)
+        color_jitter=color_jitter,
+        placement=augmentation_placement)
+    batch_transform = getattr(transform, 'batch_transform', None)
 
 
 
 
     # -- init data-loader
-    data = PTZImageDataset(coll_dir, transform=transform)
-    dataloader = DataLoader(data, batch_size=batch_size, shuffle=False)
-    ipe = len(dataloader)
-    #ipe = int(len(dataloader)*(batch_size/global_batch_size))
+    data = make_ptz_dataset(coll_dir, transform=transform, shard_dir=image_shard_dir,
+                            size=crop_size, decoded=image_shard_decoded)
+    dataloader = make_ptz_dataloader(data, batch_size=batch_size, shuffle=False, num_workers=num_workers,
+                                     pin_mem=pin_mem, persistent_workers=persistent_workers)
+    # -- iterations per epoch are optimizer steps, one per global batch
+    accumulator = GradientAccumulator(accumulation_steps, len(dataloader))
+    ipe = accumulator.steps_per_epoch
 
 
 
@@ -672,13 +710,22 @@ def world_model(args, resume_preempt=False):
         warmup=warmup,
         num_epochs=num_epochs,
         ipe_scale=ipe_scale,
-        use_bfloat16=use_bfloat16)
+        precision=precision)
 
 
 
     #for p in target_encoder.parameters():
     #    p.requires_grad = False
 
+    # -- reward target engine
+    reward_signal = None
+    if reward_mode != 'two_pass':
+        reward_signal = GradientRewardSignal(
+            target_encoder,
+            mode=reward_mode,
+            subset_blocks=reward_subset_blocks,
+            calibration_freq=reward_calibration_freq)
+
 
     # -- momentum schedule
     momentum_scheduler = (ema[0] + i*(ema[1]-ema[0])/(ipe*num_epochs*ipe_scale)
@@ -702,6 +749,8 @@ def world_model(args, resume_preempt=False):
             wd_scheduler.step()
             next(momentum_scheduler)
 
+    target_ema = ModelEMA(encoder, target_encoder)
+
 
     def save_checkpoint(epoch):
         save_dict = {
@@ -720,18 +769,19 @@ def world_model(args, resume_preempt=False):
             torch.save(save_dict, save_path.format(epoch=f'{epoch + 1}'))
 
 
-    def train_step(inputs):
-        _new_lr = scheduler.step()
-        _new_wd = wd_scheduler.step()
-        # --
-
+    # The reward target g is a mean gradient magnitude, it underflows in
+    # fp16 and loses its low bits in bf16 (and gets no loss scaling), so the
+    # auxiliary forward, loss and gradient run in fp32 outside autocast.
+    # Only the forwards of the training loss are lowered.
+    def two_pass_loss(inputs):
         # Step 1. Auxiliary Forward
-        h = forward_target(inputs[2], target_encoder)
+        h = forward_target(inputs[2], target_encoder, index=inputs[5])
         # ! for pytorch<2, Needs all gradients for backpropagation 
-        with torch.no_grad():
+        with torch.no_grad(), precision.autocast():
             z, r = forward_context(inputs[0], inputs[1], inputs[3],
-                                   encoder, predictor, camera_brand, True)
-        auxiliary_loss = auxiliary_loss_fn(z, h)
+                                   encoder, predictor, camera_brand, True,
+                                   index=inputs[4])
+        auxiliary_loss = auxiliary_loss_fn(z.float(), h)
 
         # Step 2. Auxiliary Backward
         auxiliary_loss.backward()
@@ -749,80 +799,64 @@ def world_model(args, resume_preempt=False):
         # encoder.zero_grad()
 
         # Step 3. Forward
-        with torch.no_grad():
-            # EMA update for target encoder
-            h = forward_target(inputs[2], target_encoder)
-        # Need to update the gradient
-        z, r = forward_context(inputs[0], inputs[1], inputs[3],
-                               encoder, predictor, camera_brand, True)
-        loss = loss_fn(z, r, h, g)
-
-        # Step 4. Backward & step
-        loss.backward()
-        # do not update the gradient for target encoder
-        # update is done via EMA
-        # target_encoder.zero_grad()
+        with precision.autocast():
+            with torch.no_grad():
+                # EMA update for target encoder
+                h = forward_target(inputs[2], target_encoder, index=inputs[5])
+            # Need to update the gradient
+            z, r = forward_context(inputs[0], inputs[1], inputs[3],
+                                   encoder, predictor, camera_brand, True,
+                                   index=inputs[4])
+            return loss_fn(z, r, h, g)
+
+    def single_pass_loss(inputs):
+        # Step 1. Forward, the target branch keeps its graph (in fp32) only
+        # if the reward signal needs gradients w.r.t. the target encoder weights
+        if reward_signal.needs_target_graph():
+            h = forward_target(inputs[2], target_encoder, index=inputs[5])
+        else:
+            with torch.no_grad(), precision.autocast():
+                h = forward_target(inputs[2], target_encoder, index=inputs[5])
+            h = h.float().requires_grad_()
+        with precision.autocast():
+            z, r = forward_context(inputs[0], inputs[1], inputs[3],
+                                   encoder, predictor, camera_brand, True,
+                                   index=inputs[4])
 
-        optimizer.step()
-        grad_stats = grad_logger(encoder.named_parameters())
-        optimizer.zero_grad()
+        # Step 2. Reward target from the auxiliary loss of the same pass
+        g = reward_signal(auxiliary_loss_fn(z.detach().float(), h), h)
+        with precision.autocast():
+            return loss_fn(z, r, h.detach(), g)
 
+    compute_loss = two_pass_loss if reward_signal is None else single_pass_loss
 
-        # Step 5. momentum update of target encoder
-        with torch.no_grad():
-            m = next(momentum_scheduler)
-            for param_q, param_k in zip(encoder.parameters(), target_encoder.parameters()):
-                param_k.detach().data.mul_(m).add_((1.-m) * param_q.detach().data)
-                #param_k.data.mul_(m).add_((1.-m) * param_q.detach().data)
 
-        return (float(loss), _new_lr, _new_wd, grad_stats)
+    def train_step(step_inputs):
+        inputs, itr, num_images = step_inputs
 
+        # the loss functions enter autocast themselves, see two_pass_loss
+        loss = compute_loss(inputs)
 
-    def acumulate_train_step(inputs):
+        # Step 4. Backward, accumulated over the micro-batches of a global batch
+        # do not update the gradient for target encoder
+        # update is done via EMA
+        # target_encoder.zero_grad()
+        accumulator.backward(loss, itr, precision, num_samples=num_images)
+        if not accumulator.is_step(itr):
+            return float(loss), None
+
+        # Step 5. Step once per global batch
         _new_lr = scheduler.step()
         _new_wd = wd_scheduler.step()
-        # --
-
-        # Step 1. Auxiliary Forward
-        h = forward_target(inputs[2], target_encoder)
-        with torch.no_grad():
-            z, r = forward_context(inputs[0], inputs[1], inputs[3],
-                                   encoder, predictor, camera_brand, True)
-        auxiliary_loss = auxiliary_loss_fn(z, h)
-
-        # Step 2. Auxiliary Backward
-        auxiliary_loss.backward()
-        grads = []
-        for param in target_encoder.parameters():
-            if param.grad != None:
-                grads.append(param.grad.view(-1))
-        grads = torch.cat(grads)
-        #g = grads.abs().sum()
-        g = grads.abs().mean()
-        target_encoder.zero_grad()
-
-        # Step 3. Forward
-        with torch.no_grad():
-            h = forward_target(inputs[2], target_encoder)
-        z, r = forward_context(inputs[0], inputs[1], inputs[3],
-                               encoder, predictor, camera_brand, True)
-        loss = loss_fn(z, r, h, g)
-
-        # Step 4. Backward & step
-        loss.backward()
-        #optimizer.step()
+        precision.step(optimizer)
         grad_stats = grad_logger(encoder.named_parameters())
-        #optimizer.zero_grad()
-
+        optimizer.zero_grad()
 
-        # Step 5. momentum update of target encoder
-        with torch.no_grad():
-            m = next(momentum_scheduler)
-            for param_q, param_k in zip(encoder.parameters(), target_encoder.parameters()):
-                param_k.detach().data.mul_(m).add_((1.-m) * param_q.detach().data)
-                #param_k.data.mul_(m).add_((1.-m) * param_q.detach().data)
+        # Step 6. momentum update of target encoder
+        m = next(momentum_scheduler)
+        target_ema.update(m)
 
-        return (float(loss), _new_lr, _new_wd, grad_stats)
+        return float(loss), (_new_lr, _new_wd, grad_stats)
 
 
 
@@ -846,19 +880,20 @@ def world_model(args, resume_preempt=False):
 
 
     # -- Logging
-    def log_stats(itr, epoch, loss, lr, wd, etime):
+    def log_stats(itr, epoch, loss, lr, wd, etime, samples_per_sec):
         csv_logger.log(epoch + 1, itr, loss, lr, wd, etime)
         if (itr % log_freq == 0) or np.isnan(loss) or np.isinf(loss):
             logger.info('[%d, %5d] loss: %.3f '
                         '[wd: %.2e] [lr: %.2e] '
                         '[mem: %.2e] '
-                        '(%.1f ms)'
+                        '(%.1f ms) [%.1f img/s]'
                         % (epoch + 1, itr,
                            loss_meter.avg,
                            _new_wd,
                            _new_lr,
                            torch.cuda.max_memory_allocated() / 1024.**2,
-                           time_meter.avg))
+                           time_meter.avg,
+                           samples_per_sec))
 
             if grad_stats is not None:
                 logger.info('[%d, %5d] grad_stats: [%.2e %.2e] (%.2e, %.2e)'
@@ -868,6 +903,15 @@ def world_model(args, resume_preempt=False):
                                grad_stats.min,
                                grad_stats.max))
 
+            if reward_signal is not None and reward_signal.error_meter.count > 0:
+                logger.info('[%d, %5d] reward signal (%s): rel. error vs exact %.2e '
+                            '(max %.2e) [scale: %.2e]'
+                            % (epoch + 1, itr,
+                               reward_signal.mode,
+                               reward_signal.error_meter.avg,
+                               reward_signal.error_meter.max,
+                               reward_signal.scale))
+
     # -- TRAINING LOOP
     change_ownership(os.path.join(folder, model_name))
     loss_values = []
@@ -879,28 +923,38 @@ def world_model(args, resume_preempt=False):
 
         loss_meter = AverageMeter()
         time_meter = AverageMeter()
+        step_loss_meter = AverageMeter()
+        step_time = 0.
+        accumulator.start_epoch()
 
         for itr, (imgs, poss) in enumerate(dataloader):
             # poss = get_position_from_label(labls)
             imgs = imgs.to(device, non_blocking=True)
             poss = poss.to(device, non_blocking=True)
+            if batch_transform is not None:
+                imgs = batch_transform(imgs)
             
-            context_imgs, context_poss, target_imgs, target_poss = arrange_inputs(imgs, poss, device)
-
-            if itr%int(global_batch_size/batch_size)==0:
-                (loss, _new_lr, _new_wd, grad_stats), etime = gpu_timer(train_step, arguments=[context_imgs, context_poss, target_imgs, target_poss])
-            else:
-                #loss, etime = gpu_timer(acumulate_train_step, arguments=[context_imgs, context_poss, target_imgs, target_poss])
-                (loss, _new_lr, _new_wd, grad_stats), etime = gpu_timer(acumulate_train_step, arguments=[context_imgs, context_poss, target_imgs, target_poss])
+            inputs = arrange_step_inputs(imgs, poss, device, encode_once)
 
+            (loss, step_stats), etime = gpu_timer(train_step, arguments=[inputs, itr, imgs.shape[0]])
             loss_meter.update(loss)
-            time_meter.update(etime)
-            log_stats(itr, epoch, loss, _new_lr, _new_wd, etime)
+            step_loss_meter.update(loss)
+            step_time += etime
 
             assert not np.isnan(loss), 'loss is nan'
 
+            # -- log once per global batch
+            if step_stats is not None:
+                _new_lr, _new_wd, grad_stats = step_stats
+                samples_per_sec = accumulator.step_done()
+                time_meter.update(step_time)
+                log_stats(accumulator.step_index(itr), epoch, step_loss_meter.avg, _new_lr, _new_wd, step_time,
+                          samples_per_sec)
+                step_loss_meter.reset()
+                step_time = 0.
+
         # -- Save Checkpoint after every epoch
-        logger.info('avg. loss %.3f' % loss_meter.avg)
+        logger.info('avg. loss %.3f [%.1f img/s per global batch]' % (loss_meter.avg, accumulator.throughput.avg))
         loss_values.append(loss_meter.avg)
         save_checkpoint(epoch+1)
         change_ownership(ownership_folder)
@@ -942,6 +996,8 @@ def dreamer(args, resume_preempt=False):
     pred_emb_dim = args['meta']['pred_emb_dim']
     camera_brand = args['meta']['camera_brand']
     distributed = args['meta']['distributed']
+    fused_attention = args['meta'].get('fused_attention', False)
+    activation_checkpointing = args['meta'].get('activation_checkpointing', None)
     if not torch.cuda.is_available():
         device = torch.device('cpu')
     else:
@@ -961,6 +1017,10 @@ def dreamer(args, resume_preempt=False):
     image_folder = args['data']['image_folder']
     crop_size = args['data']['crop_size']
     crop_scale = args['data']['crop_scale']
+    persistent_workers = args['data'].get('persistent_workers', True)
+    image_shard_dir = args['data'].get('image_shard_dir', None)
+    image_shard_decoded = args['data'].get('image_shard_decoded', True)
+    augmentation_placement = args['data'].get('augmentation_placement', 'dataloader')
     # --
 
     # -- MASK
@@ -992,6 +1052,10 @@ def dreamer(args, resume_preempt=False):
     # -- DREAMER
     number_of_dreams = args['dreamer']['number_of_dreams']
     dream_length = args['dreamer']['dream_length']
+    dream_shard_size = args['dreamer'].get('shard_size', 1024)
+    frame_cache_dir = args['dreamer'].get('frame_cache_dir', None)
+    frame_cache_ram_gb = args['dreamer'].get('frame_cache_ram_gb', 2)
+    frame_cache_disk_gb = args['dreamer'].get('frame_cache_disk_gb', 20)
 
     # -- LOGGING
     folder = args['logging']['folder']
@@ -1000,52 +1064,7 @@ def dreamer(args, resume_preempt=False):
     tag = args['logging']['write_tag']
 
     # -- ACTIONS
-    action_noop = args['action']['noop']
-    action_short_left = args['action']['short']['left']
-    action_short_right = args['action']['short']['right']
-    action_short_left_up = args['action']['short']['left_up']
-    action_short_right_up = args['action']['short']['right_up']
-    action_short_left_down = args['action']['short']['left_down']
-    action_short_right_down = args['action']['short']['right_down']
-    action_short_up = args['action']['short']['up']
-    action_short_down = args['action']['short']['down']
-    action_short_zoom_in = args['action']['short']['zoom_in']
-    action_short_zoom_out = args['action']['short']['zoom_out']
-
-    action_long_left = args['action']['long']['left']
-    action_long_right = args['action']['long']['right']
-    action_long_up = args['action']['long']['up']
-    action_long_down = args['action']['long']['down']
-    action_long_zoom_in = args['action']['long']['zoom_in']
-    action_long_zoom_out = args['action']['long']['zoom_out']
-
-    action_jump_left = args['action']['jump']['left']
-    action_jump_right = args['action']['jump']['right']
-    action_jump_up = args['action']['jump']['up']
-    action_jump_down = args['action']['jump']['down']
-
-    actions={}
-    actions[0]=action_noop
-    actions[1]=action_short_left
-    actions[2]=action_short_right
-    actions[3]=action_short_left_up
-    actions[4]=action_short_right_up
-    actions[5]=action_short_left_down
-    actions[6]=action_short_right_down
-    actions[7]=action_short_up
-    actions[8]=action_short_down
-    actions[9]=action_short_zoom_in
-    actions[10]=action_short_zoom_out
-    actions[11]=action_long_left
-    actions[12]=action_long_right
-    actions[13]=action_long_up
-    actions[14]=action_long_down
-    actions[15]=action_long_zoom_in
-    actions[16]=action_long_zoom_out
-    actions[17]=action_jump_left
-    actions[18]=action_jump_right
-    actions[19]=action_jump_up
-    actions[20]=action_jump_down
+    action_table = build_action_table(args['action'], camera_brand, device)
 
     # -- MEMORY
     memory_dreams = args['memory']['dreams']
@@ -1142,7 +1161,6 @@ def dreamer(args, resume_preempt=False):
     log_file = os.path.join(folder, model_name, f'{tag}.csv')
     save_path = os.path.join(folder, model_name, f'{tag}' + '-ep{epoch}.pt')
     latest_path = os.path.join(folder, model_name, f'{tag}-latest.pt')
-    dream_save_path = os.path.join(dream_folder, f'{tag}' + '-dream{dream}.pt')
     load_path = None
     if load_model:
         load_path = os.path.join(folder, r_file) if r_file is not None else latest_path
@@ -1170,7 +1188,9 @@ def dreamer(args, resume_preempt=False):
         crop_size=crop_size,
         pred_depth=pred_depth,
         pred_emb_dim=pred_emb_dim,
-        model_arch=model_arch)
+        model_arch=model_arch,
+        fused_attention=fused_attention,
+        activation_checkpointing=activation_checkpointing)
 
 
 
@@ -1181,14 +1201,28 @@ def dreamer(args, resume_preempt=False):
         gaussian_blur=use_gaussian_blur,
         horizontal_flip=use_horizontal_flip,
         color_distortion=use_color_distortion,
-        color_jitter=color_jitter)
+        color_jitter=color_jitter,
+        placement=augmentation_placement)
+    batch_transform = getattr(transform, 'batch_transform', None)
+
 
 
 
+    # -- transformed frames are cached across dreamer runs (skips decode and resize)
+    frame_cache = None
+    if frame_cache_dir is not None:
+        frame_cache = FrameCache(
+            frame_cache_dir,
+            transform_fingerprint(transform),
+            max_ram_bytes=int(frame_cache_ram_gb * 1024**3),
+            max_disk_bytes=int(frame_cache_disk_gb * 1024**3))
 
     # -- init data-loader
-    data = PTZImageDataset(coll_dir, transform=transform)
-    dataloader = DataLoader(data, batch_size=batch_size, shuffle=True)
+    data = make_ptz_dataset(coll_dir, transform=transform,
+                            shard_dir=image_shard_dir if frame_cache is None else None,
+                            size=crop_size, decoded=image_shard_decoded, frame_cache=frame_cache)
+    dataloader = make_ptz_dataloader(data, batch_size=batch_size, shuffle=True, num_workers=num_workers,
+                                     pin_mem=pin_mem, persistent_workers=persistent_workers)
     ipe = len(dataloader)
 
 
@@ -1214,125 +1248,31 @@ def dreamer(args, resume_preempt=False):
 
 
 
-    def save_dreams(dream_id, dream_dict):
-        torch.save(dream_dict, dream_save_path.format(dream=f'{dream_id}'))
+    dream_store = DreamStore.open_or_create(dream_folder, shard_size=dream_shard_size)
+
+    def save_dreams(dream_ids, dreams):
+        # -- dreams are [T, B, ...], the store keeps one dream per row
+        dreams = {key: value.transpose(0, 1).cpu().numpy() for key, value in dreams.items()}
+        dream_store.write(dream_ids, dreams)
+
 
+    dream_engine = DreamEngine(encoder, predictor, action_table)
 
     def dream_step(inputs):
         images = inputs[0]
         positions = inputs[1]
         number_of_dreams = inputs[2]
+        dreams = dream_engine.rollout(images, positions, dream_length)
 
-        state_sequences = []
-        position_sequences = []
-        reward_sequences = []
-        delta_reward_sequences = []
-        action_sequences = []
-        # Step 1. Forward image through encoder
-        internal_state = get_internal_representation(images)
-        # Step 2. Iterate forwarding internal representations through the predictor
-        reward_memory = 0.0
-        for step in range(dream_length):
-            state_sequences.append(internal_state.unsqueeze(0))
-            position_sequences.append(positions.unsqueeze(0))
-
-            next_positions, next_actions = get_next_random_positions(positions, actions)
-            next_internal_state, next_reward = forward_internal_representation(internal_state, positions, next_positions)
-
-            internal_state = next_internal_state
-            positions = next_positions
-            reward = next_reward.squeeze(-1)
-            reward = reward.mean(-1)
-            delta_reward = reward - reward_memory
-            reward_memory = reward
-            reward_sequences.append(reward.unsqueeze(0))
-            delta_reward_sequences.append(delta_reward.unsqueeze(0))
-            action_sequences.append(next_actions.unsqueeze(0))
-
-        state_sequences.append(internal_state.unsqueeze(0))
-        position_sequences.append(positions.unsqueeze(0))
-
-        B, D1, D2 = internal_state.shape
-        aux = torch.Tensor(len(state_sequences), B, D1, D2).to(device)
-        torch.cat(state_sequences, out=aux)
-        state_sequences=aux
-
-        B, D1 = positions.shape
-        aux = torch.Tensor(len(position_sequences), B, D1).to(device)
-        torch.cat(position_sequences, out=aux)
-        position_sequences=aux
-
-        B = reward.shape[0]
-        aux = torch.Tensor(len(reward_sequences), B).to(device)
-        torch.cat(reward_sequences, out=aux)
-        reward_sequences=aux
-
-        B = delta_reward.shape[0]
-        aux = torch.Tensor(len(delta_reward_sequences), B).to(device)
-        torch.cat(delta_reward_sequences, out=aux)
-        delta_reward_sequences=aux
-
-        B = next_actions.shape[0]
-        aux = torch.Tensor(len(action_sequences), B).to(device)
-        torch.cat(action_sequences, out=aux)
-        action_sequences=aux
-
-        # num_past_dreams = len(os.listdir(dream_dir))
-        for idx in range(B):
-            dream_dict = {
-                'state_sequence': state_sequences[:,idx],
-                'position_sequence': position_sequences[:,idx],
-                'reward_sequence': reward_sequences[:,idx],
-                'delta_reward_sequence': delta_reward_sequences[:,idx],
-                'action_sequence': action_sequences[:,idx]
-            }
-            # to introduce randomness into dreams when overwriting old dreams
-            # with new ones
-            save_dreams(np.random.randint(number_of_dreams), dream_dict)
-            # save_dreams(num_past_dreams + idx, dream_dict)
+        # to introduce randomness into dreams when overwriting old dreams
+        # with new ones
+        save_dreams(np.random.randint(number_of_dreams, size=images.shape[0]), dreams)
 
         change_ownership(dream_folder)
 
         return 0
 
 
-    def get_internal_representation(images):
-        z = encoder(images)
-        return z
-
-    def forward_internal_representation(internal_state, position1, position2):
-        z, r = predictor(internal_state, position1, position2) 
-        return z, r
-
-    def choose_random_action(actions):
-        action=np.random.randint(len(actions.keys()))
-        return actions[action], action
-
-    def get_next_random_positions(positions, actions_set):
-        next_positions = torch.zeros_like(positions)
-        next_actions = []
-        for i, position in enumerate(positions):
-            ptz_command, action = choose_random_action(actions_set)
-            ptz_command = torch.tensor(ptz_command).to(device)
-            next_actions.append(action)
-
-            pan_modulation = 2
-            tilt_modulation = 2
-            if camera_brand==0:
-                zoom_modulation = 1
-            elif camera_brand==1:
-                zoom_modulation = 100
-
-            ptz_command[0]=ptz_command[0]*pan_modulation
-            ptz_command[1]=ptz_command[1]*tilt_modulation
-            ptz_command[2]=ptz_command[2]*zoom_modulation
-
-            next_positions[i] = position + ptz_command
-
-        next_actions=torch.tensor(next_actions).to(device)
-        return next_positions, next_actions
-
-
     def auxiliary_loss_fn(z, h):
         loss = F.smooth_l1_loss(z, h)
         return loss
@@ -1355,10 +1295,15 @@ def dreamer(args, resume_preempt=False):
         #change_allocentric_position(poss)
         imgs = imgs.to(device, non_blocking=True)
         poss = poss.to(device, non_blocking=True)
+        if batch_transform is not None:
+            imgs = batch_transform(imgs)
         
         (dump), etime = gpu_timer(dream_step, arguments=[imgs, poss, number_of_dreams])
         if itr > number_of_dreams:
             break
+    if frame_cache is not None:
+        # -- counts of this process, DataLoader workers keep their own
+        logger.info('frame cache: %s', frame_cache.summary())
 
     update_progress(model_name)
 
@@ -9,6 +9,7 @@ import yaml
 import pprint
 from source.track_progress import cleanup_and_respawn, initialize_model_info, read_file_lastline, save_model_info, update_progress
 import torch
+import torch.nn.functional as F
 #import torch.nn.SmoothL1Loss as S1L
 
 from torch.utils.data import DataLoader
@@ -28,12 +29,14 @@ from source.helper import (
     init_agent_model,
     init_opt)
 
-from source.rl_helper import ReplayMemory, Transition
+from source.rl_helper import EpisodeReplayMemory, ReplayIngestion
+from source.utils.ema import ModelEMA
+from source.utils.precision import PrecisionPolicy
 
 from source.transforms import make_transforms
 
 #from source.datasets.ptz_dataset import PTZImageDataset
-from source.datasets.dreams_dataset import DreamDataset
+from source.datasets.dreams_dataset import make_dream_dataset
 
 # --
 #log_timings = True
@@ -56,11 +59,14 @@ def agent_model(args, resume_preempt=False):
     copy_data = args['meta']['copy_data']
     pred_depth = args['meta']['pred_depth']
     pred_emb_dim = args['meta']['pred_emb_dim']
+    fused_attention = args['meta'].get('fused_attention', False)
+    activation_checkpointing = args['meta'].get('activation_checkpointing', None)
     if not torch.cuda.is_available():
         device = torch.device('cpu')
     else:
         device = torch.device('cuda:0')
         torch.cuda.set_device(device)
+    precision = PrecisionPolicy.from_config(args['meta'], device)
 
     # -- DATA
     use_gaussian_blur = args['data']['use_gaussian_blur']
@@ -115,6 +121,15 @@ def agent_model(args, resume_preempt=False):
 
     # -- DREAMER
     dream_length = args['dreamer']['dream_length']
+
+    # -- REPLAY
+    replay_args = args.get('replay', {})
+    replay_on_device = replay_args.get('on_device', True)
+    replay_pin_memory = replay_args.get('pin_memory', pin_mem)
+    replay_prioritized = replay_args.get('prioritized', False)
+    replay_alpha = replay_args.get('alpha', 0.6)
+    replay_beta = replay_args.get('beta', 0.4)
+    replay_max_memory_gb = replay_args.get('max_memory_gb', 16)
     loyal = False # whether to loyal to one world model
     #loyal = True # whether to loyal to one world model
 
@@ -272,30 +287,20 @@ def agent_model(args, resume_preempt=False):
 
 
 
-    def prepare_data(dataloader, size):
-        memory = ReplayMemory(size)
-        for itr, episodes in enumerate(dataloader):
-            print('episodes keys ', episodes.keys())
-            for state_sequence, position_sequence, reward_sequence, action_sequence in zip(episodes['state_sequence'], episodes['position_sequence'], episodes['delta_reward_sequence'], episodes['action_sequence']):
-                for step, (state, position) in enumerate(zip(state_sequence, position_sequence)):
-                    if step < action_sequence.shape[0]:
-                        # pick next action
-                        action=action_sequence[step]
- 
-                        # next state and position
-                        next_state=state_sequence[step+1]
-                        next_position=position_sequence[step+1]
-
-                        # reward
-                        reward=reward_sequence[step]
-
-                        # Store the transition in memory
-                        memory.push(state, position, action, next_state, next_position, reward)
-
-                        #if len(memory) > 0.9*size:
-                            #return memory
-
-        return memory
+    def prepare_data(dataloader, num_episodes):
+        # -- episodes stream into the memory in the background while training starts
+        memory = EpisodeReplayMemory(
+            num_episodes,
+            dream_length,
+            max_bytes=replay_max_memory_gb * 1024.**3,
+            device=device,
+            storage_device=device if replay_on_device else 'cpu',
+            pin_memory=replay_pin_memory,
+            prioritized=replay_prioritized,
+            alpha=replay_alpha,
+            beta=replay_beta)
+        ingestion = ReplayIngestion(memory, dataloader).start()
+        return memory, ingestion
 
 
 
@@ -308,7 +313,9 @@ def agent_model(args, resume_preempt=False):
         pred_depth=pred_depth,
         pred_emb_dim=pred_emb_dim,
         model_arch=model_arch,
-        num_actions=num_actions)
+        num_actions=num_actions,
+        fused_attention=fused_attention,
+        activation_checkpointing=activation_checkpointing)
     target_predictor = copy.deepcopy(policy_predictor)
 
 
@@ -322,14 +329,17 @@ def agent_model(args, resume_preempt=False):
         ]
     )
     dream_folder = parent_model_dir / f"dream_{dream_iter:0>2}"
-    data = DreamDataset(dream_folder)
+    data = make_dream_dataset(dream_folder)
     num_dreams = len(data)
     dataloader = DataLoader(data, batch_size=batch_size, shuffle=True)
 
     ipe = len(dataloader)*dream_length
 
     logger.info('PREPARING DATA...')
-    memory = prepare_data(dataloader, len(dataloader)*batch_size*dream_length)
+    memory, ingestion = prepare_data(dataloader, num_dreams)
+    if not ingestion.wait(batch_size):
+        logger.warning('Not enough data for the RL agent')
+        return False
     logger.info('DONE!')
 
 
@@ -348,7 +358,7 @@ def agent_model(args, resume_preempt=False):
         warmup=warmup,
         num_epochs=num_epochs,
         ipe_scale=ipe_scale,
-        use_bfloat16=use_bfloat16)
+        precision=precision)
 
 
 
@@ -386,6 +396,8 @@ def agent_model(args, resume_preempt=False):
             wd_scheduler.step()
             next(momentum_scheduler)
 
+    target_ema = ModelEMA(policy_predictor, target_predictor)
+
 
 
     def save_checkpoint(epoch):
@@ -414,51 +426,47 @@ def agent_model(args, resume_preempt=False):
 
 
 
-    def tuple_of_tensors_to_tensor(tuple_of_tensors):
-        return  torch.stack(list(tuple_of_tensors), dim=0)
-
-    def optimize_model(transitions):
+    def optimize_model(inputs):
         GAMMA = 0.99
         _new_lr = scheduler.step()
         _new_wd = wd_scheduler.step()
         # --
 
-        # Transpose the batch (see https://stackoverflow.com/a/19343/3343043 for
-        # detailed explanation). This converts batch-array of Transitions
-        # to Transition of batch-arrays.
-        batch = Transition(*zip(*transitions))
-
-        state_batch = tuple_of_tensors_to_tensor(batch.state)
-        position_batch = tuple_of_tensors_to_tensor(batch.position)
-        action_batch = tuple_of_tensors_to_tensor(batch.action)
-        next_state_batch = tuple_of_tensors_to_tensor(batch.next_state)
-        next_position_batch = tuple_of_tensors_to_tensor(batch.next_position)
-        reward_batch = tuple_of_tensors_to_tensor(batch.reward)
+        batch, indices, weights = inputs
+        state_batch = batch.state
+        position_batch = batch.position
+        next_state_batch = batch.next_state
+        next_position_batch = batch.next_position
+        reward_batch = batch.reward
 
         # Compute Q(s_t, a) - the model computes Q(s_t), then we select the
         # columns of actions taken. These are the actions which would've been taken
         # for each batch state according to policy_net
-        action_batch=action_batch.round().to(torch.int64).view(-1, 1)
-        state_action_values = torch.gather(policy_predictor(state_batch, position_batch), 1, action_batch)
+        action_batch = batch.action.view(-1, 1)
+        with precision.autocast():
+            state_action_values = torch.gather(policy_predictor(state_batch, position_batch), 1, action_batch)
+        state_action_values = state_action_values.float()
 
         # Compute V(s_{t+1}) for all next states.
         # Expected values of actions for non_final_next_states are computed based
         # on the "older" target_net; selecting their best reward with max(1).values
         # This is merged based on the mask, such that we'll have either the expected
         # state value or 0 in case the state was final.
-        with torch.no_grad():
-            next_state_values = target_predictor(next_state_batch, next_position_batch).max(1).values
+        with torch.no_grad(), precision.autocast():
+            next_state_values = target_predictor(next_state_batch, next_position_batch).max(1).values.float()
 
         # Compute the expected Q values
         expected_state_action_values = (next_state_values * GAMMA) + reward_batch
 
-        loss = loss_fn(state_action_values, expected_state_action_values)
+        loss = loss_fn(state_action_values, expected_state_action_values, weights)
+        memory.update_priorities(indices, state_action_values.detach().squeeze(1) - expected_state_action_values)
 
         # Backward & step
-        loss.backward()
+        precision.backward(loss)
         ## Gradient Value Clipping
+        precision.unscale_(optimizer)
         torch.nn.utils.clip_grad_norm_(policy_predictor.parameters(), max_norm=1.0)
-        optimizer.step()
+        precision.step(optimizer)
         grad_stats = grad_logger(policy_predictor.named_parameters())
         optimizer.zero_grad()
 
@@ -468,9 +476,14 @@ def agent_model(args, resume_preempt=False):
 
 
     # Compute Huber loss
-    def loss_fn(state_action_values, expected_state_action_values):
-        criterion = torch.nn.SmoothL1Loss()
-        loss = criterion(state_action_values, expected_state_action_values.unsqueeze(1))
+    def loss_fn(state_action_values, expected_state_action_values, weights=None):
+        if weights is None:
+            criterion = torch.nn.SmoothL1Loss()
+            return criterion(state_action_values, expected_state_action_values.unsqueeze(1))
+
+        # -- importance-sampling weighted loss of the prioritized replay
+        loss = F.smooth_l1_loss(state_action_values, expected_state_action_values.unsqueeze(1), reduction='none')
+        loss = (loss.squeeze(1) * weights).mean()
 
         return loss
 
@@ -527,15 +540,15 @@ def agent_model(args, resume_preempt=False):
             #print('batch_size: ', batch_size)
             #print('len(memory): ', len(memory))
             try:
-                transitions = memory.sample(batch_size)
-            except Exception as e:
+                inputs = ingestion.sample(batch_size)
+            except ValueError as e:
                 logger.exception('Error when sampling transitions: %s', e)
-                transitions = None
+                inputs = None
                 # raise RuntimeError('Not enough data for the RL agent, increase number of movements or iterations')
                 logger.warning('Not enough data for the RL agent')
                 return False
 
-            (loss, _new_lr, _new_wd, grad_stats), etime = gpu_timer(optimize_model, arguments=transitions)
+            (loss, _new_lr, _new_wd, grad_stats), etime = gpu_timer(optimize_model, arguments=inputs)
             loss_meter.update(loss)
             time_meter.update(etime)
             log_stats(itr, epoch, loss, _new_lr, _new_wd, etime)
@@ -545,14 +558,8 @@ def agent_model(args, resume_preempt=False):
 
             # Soft update of the target network's weights
             # θ′ ← τ θ + (1 −τ )θ′
-            target_predictor_state_dict = target_predictor.state_dict()
-            policy_predictor_state_dict = policy_predictor.state_dict()
-            with torch.no_grad():
-                m = next(momentum_scheduler)
-                for key in policy_predictor_state_dict:
-                    target_predictor_state_dict[key] = policy_predictor_state_dict[key]*m + target_predictor_state_dict[key]*(1-m)
-                    #target_predictor_state_dict[key] = policy_predictor_state_dict[key]*TAU + target_predictor_state_dict[key]*(1-TAU)
-            target_predictor.load_state_dict(target_predictor_state_dict)
+            m = next(momentum_scheduler)
+            target_ema.update(1. - m)
 
         # -- Save Checkpoint after every epoch
         logger.info('avg. loss %.3f' % loss_meter.avg)
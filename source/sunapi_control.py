@@ -7,10 +7,11 @@ import argparse
 import ast
 import time
 import numpy as np
-import requests
-from requests.auth import HTTPDigestAuth
 from bs4 import BeautifulSoup
 
+from source.camera_http import CameraSession
+from source.ptz_state import PTZStateCache, MoveWaiter
+
 logging.basicConfig(filename='sunapi.log', filemode='w', level=logging.DEBUG)
 logger = logging.getLogger("HANWHA_camera")
 logger.info('Started')
@@ -20,16 +21,22 @@ class CameraControl:
     Module for the control of HANWHA cameras using Sunapi
     """
 
-    def __init__(self, ip, user, password):
+    def __init__(self, ip, user, password, state_staleness=1.0):
         self.__cam_ip = ip
         self.__cam_user = user
         self.__cam_password = password
+        self.__session = CameraSession(user, password)
+        # control commands are not idempotent, they are never re-sent
+        self.__control_session = CameraSession(user, password, retries=0)
+        self.state = PTZStateCache(self._query_status, staleness=state_staleness)
+        self.waiter = MoveWaiter()
 
-    def _camera_command(self, value_cgi, payload: dict):
+    def _camera_command(self, value_cgi, payload: dict, target=None):
         """
         Function used to send commands to the camera
         Args:
             payload: argument dictionary for camera control
+            target: expected final (pan, tilt, zoom) of a move command, if known
 
         Returns:
             Returns the response from the device to the command sent
@@ -40,8 +47,13 @@ class CameraControl:
 
         url = 'http://' + self.__cam_ip + '/stw-cgi/' + value_cgi
 
-        resp = requests.get(url, auth=HTTPDigestAuth(self.__cam_user, self.__cam_password),
-                            params=payload)
+        session = self.__session
+        if payload.get('action') == 'control':
+            # the camera may move, the cached position no longer holds
+            self.state.commanded(target)
+            session = self.__control_session
+
+        resp = session.get(url, params=payload)
 
         if (resp.status_code != 200) and (resp.status_code != 204):
             soup = BeautifulSoup(resp.text, features="lxml")
@@ -51,21 +63,37 @@ class CameraControl:
 
         return resp
 
-    def operation_finished(self):
+    def _query_status(self):
         """
-        Operation to request PTZ status.
+        Requests the PTZ status from the camera.
 
         Returns:
-            Returns status and notifies when the operation is finished
+            Returns a tuple (pan, tilt, zoom, zoom_pulse) as reported by the camera
 
         """
         resp = self._camera_command('ptzcontrol.cgi',
                                     {'msubmenu': 'query', 'action': 'view', 'Query': 'Pan,Tilt,Zoom'})
 
-        current_pan = float(resp.text.split()[0].split('=')[1])
-        current_tilt = float(resp.text.split()[1].split('=')[1])
-        current_zoom = float(resp.text.split()[2].split('=')[1])
-        current_zoom_pulse = float(resp.text.split()[3].split('=')[1])
+        pan = float(resp.text.split()[0].split('=')[1])
+        tilt = float(resp.text.split()[1].split('=')[1])
+        zoom = float(resp.text.split()[2].split('=')[1])
+        zoom_pulse = float(resp.text.split()[3].split('=')[1])
+
+        return pan, tilt, zoom, zoom_pulse
+
+    def operation_finished(self, cached: bool = False):
+        """
+        Operation to request PTZ status.
+
+        Args:
+            cached: use the cached state if it is not stale instead of querying the camera.
+
+        Returns:
+            Returns status and notifies when the operation is finished
+
+        """
+        status = self.state.get() if cached else self.state.refresh()
+        current_pan, current_tilt, current_zoom, current_zoom_pulse = status
 
         if abs(360 - current_pan) < 0.02 or current_pan < 0.02:
             # This if statement is necessary for when absolute pan is zero. When the camera position
@@ -109,12 +137,15 @@ class CameraControl:
 
         """
 
-        init_pos, initial_zoom_pulse = self.operation_finished()  # takes current (pan, tilt, zoom) values as an array
-                                                                  # and initial_zoom_pulse
+        init_pos, initial_zoom_pulse = self.operation_finished(cached=True)  # takes current (pan, tilt, zoom) values as an array
+                                                                             # and initial_zoom_pulse
+
+        target = tuple(init if value is None else value for value, init in zip((pan, tilt, zoom), init_pos))
 
         resp = self._camera_command('ptzcontrol.cgi', {'msubmenu': 'absolute', 'action': 'control',
                                                        'Pan': pan, 'Tilt': tilt, 'Zoom': zoom,
-                                                       'ZoomPulse': zoom_pulse, 'Channel': channel})
+                                                       'ZoomPulse': zoom_pulse, 'Channel': channel},
+                                    target=target)
 
         logger.info(resp.url + "\n" + str(resp.status_code) + "\n" + resp.text)
 
@@ -157,22 +188,9 @@ class CameraControl:
 
         if zoom_pulse is None:
 
-            while abs(current_position - finished_position) > error_margin:
-
-                final_position = current_position  # final_position = last position recorded
-
-                init_pos, initial_zoom_pulse = self.operation_finished()  # update current position array and zoom_pulse
-
-                current_position = np.sum(init_pos)  # update current position
-
-                if final_position == current_position:  # if the final position and current position are the same
-                    i = i + 1  # add one to counter
-
-                if i == 5:  # if the current_position and final_position have been the same for five times in a row
-                    logger.error('end of command error')
-                    break  # break the loop
-
-            time.sleep(1)
+            # poll until the camera settles at the finished position
+            self.waiter.wait(lambda: self.operation_finished()[0], start=init_pos,
+                             reached=lambda pos: abs(np.sum(pos) - finished_position) <= error_margin)
 
         else:  # if zoom pulse is True, pass in zoom_pulse as final zoom_pulse
             finished_zoom_pulse = zoom_pulse  # finished value given for zoom_pulse
@@ -196,6 +214,8 @@ class CameraControl:
 
             time.sleep(0.5)
 
+        self.state.settled()
+
         logger.info('Finished')
 
         end_time = time.time()
@@ -220,7 +240,7 @@ class CameraControl:
 
         """
 
-        init_pos, initial_zoom_pulse = self.operation_finished()  # takes current position values as an array
+        init_pos, initial_zoom_pulse = self.operation_finished(cached=True)  # takes current position values as an array
 
         current_position = np.sum(init_pos)  # sums elements in the initial position array
 
@@ -274,6 +294,8 @@ class CameraControl:
             elif (current_zoom + zoom) < 1:
                 zoom = 1 - current_zoom
 
+        target = ((current_pan + (pan or 0)) % 360, current_tilt + (tilt or 0), current_zoom + (zoom or 0))
+
         """
         If current_pan is zero, then do absolute move from the zero position. Sometimes zero is read as 359.9... and
         thus relative move will not go beyond zero and will stall there.
@@ -282,12 +304,14 @@ class CameraControl:
         if current_pan != 0:
             resp = self._camera_command('ptzcontrol.cgi', {'msubmenu': 'relative', 'action': 'control',
                                                            'Pan': pan, 'Tilt': tilt, 'Zoom': zoom,
-                                                           'ZoomPulse': zoom_pulse, 'Channel': channel})
+                                                           'ZoomPulse': zoom_pulse, 'Channel': channel},
+                                        target=target)
 
         elif current_pan == 0:
             resp = self._camera_command('ptzcontrol.cgi', {'msubmenu': 'absolute', 'action': 'control',
                                                            'Pan': pan, 'Tilt': tilt, 'Zoom': zoom,
-                                                           'ZoomPulse': zoom_pulse, 'Channel': channel})
+                                                           'ZoomPulse': zoom_pulse, 'Channel': channel},
+                                        target=target)
 
         logger.info(resp.url + "\n" + str(resp.status_code) + "\n" + resp.text)
 
@@ -317,19 +341,9 @@ class CameraControl:
 
         if zoom_pulse is None:
 
-            while abs(current_position - finished_position) > 0.5:
-
-                final_position = current_position  # final_position = last position recorded
-
-                init_pos, initial_zoom_pulse = self.operation_finished()  # update current position array and zoom_pulse
-
-                current_position = np.sum(init_pos)  # update current position
-
-                if final_position == current_position:  # if the final position and current position are the same
-                    i = i + 1  # add one to counter
-
-                if i == 5:  # if the current_position and final_position have been the same for five times in a row
-                    break  # break the loop
+            # poll until the camera settles at the finished position
+            self.waiter.wait(lambda: self.operation_finished()[0], start=init_pos,
+                             reached=lambda pos: abs(np.sum(pos) - finished_position) <= 0.5)
 
         else:  # if zoom pulse is True, pass in zoom_pulse as final_zoom_pulse
 
@@ -348,7 +362,9 @@ class CameraControl:
                 if final_zoom_pulse == current_zoom_pulse:  # if the final_zoom_pulse and current_zoom_pulse are the same
                     i = i + 1  # add one to counter
 
-        time.sleep(1)
+            time.sleep(1)
+
+        self.state.settled()
 
         logger.info('Finished')
 
@@ -439,6 +455,8 @@ class CameraControl:
             if final_zoom_pulse == current_zoom_pulse:  # if the final_zoom_pulse and current_zoom_pulse are the same
                 i = i + 1  # add one to counter
 
+        self.state.settled()
+
         logger.info('Finished')
 
         end_time = time.time()
@@ -485,15 +503,10 @@ class CameraControl:
             Returns a tuple with the position of the camera (P, T, Z)
 
         """
-        resp = self._camera_command('ptzcontrol.cgi',
-                                    {'msubmenu': 'query', 'action': 'view', 'Query': 'Pan,Tilt,Zoom'})
-        pan = float(resp.text.split()[0].split('=')[1])
-        tilt = float(resp.text.split()[1].split('=')[1])
-        zoom = float(resp.text.split()[2].split('=')[1])
+        pan, tilt, zoom, _ = self.state.get()
         ptz_list = (pan, tilt, zoom)
 
         if show:
-            logger.info(resp.text)
             logger.info(ptz_list)
 
         return ptz_list
@@ -541,6 +554,8 @@ class CameraControl:
 
         time.sleep(0.5)
 
+        self.state.settled()
+
         logger.info('Finished')
 
         end_time = time.time()
@@ -675,6 +690,21 @@ class CameraControl:
 
         return resp
 
+    def snap_shot_bytes(self):
+        """
+            Sends camera command snapshot without writing it to disk
+            Returns:
+                 Returns the JPEG bytes of the snapshot, None if the request failed
+
+        """
+
+        resp = self._camera_command('video.cgi', {'msubmenu': 'snapshot', 'action': 'view'})
+
+        if resp.status_code == 200:
+            return resp.content
+
+        return None
+
     def snap_shot(self, directory: str = None):
         """
             Sends camera command snapshot
@@ -10,7 +10,7 @@ import yaml
 
 import numpy as np
 
-from source.datasets.ptz_dataset import get_position_datetime_from_labels
+from source.datasets.ptz_dataset import get_labels_from_directory
 from source.prepare_dataset import get_dirs
 
 
@@ -101,9 +101,8 @@ def save_model_info(
     logger.info("Saving %s to %s", model_name, info_fpath)
     image_info_dict = {}
     if model_type == "wm":
-        labels = [fp.stem for fp in coll_dir.glob("*.jpg")]
+        labels, _, datetimes = get_labels_from_directory(coll_dir)
         num = len(labels)
-        _, datetimes = get_position_datetime_from_labels(labels)
         image_info_dict = {
             "start_end": [
                 np.min(datetimes).strftime(timefmt),
@@ -5,12 +5,15 @@
 # LICENSE file in the root directory of this source tree.
 #
 
+import math
 from logging import getLogger
 
 from PIL import ImageFilter
 
 import torch
+import torch.nn.functional as F
 import torchvision.transforms as transforms
+import torchvision.transforms.functional as TF
 
 _GLOBAL_SEED = 0
 logger = getLogger("data_transforms")
@@ -24,9 +27,28 @@ def make_transforms(
     color_distortion=False,
     gaussian_blur=False,
     normalization=((0.485, 0.456, 0.406),
-                   (0.229, 0.224, 0.225))
+                   (0.229, 0.224, 0.225)),
+    placement='dataloader'
 ):
+    """
+    :param placement: 'dataloader' runs the whole transform per image in the
+        DataLoader workers. 'device' only turns images into uint8 tensors
+        there; crop, flip, color distortion, blur and normalization run on
+        whole batches on the accelerator through the `batch_transform`
+        attribute of the returned transform (see BatchAugmentation).
+    """
     logger.info('making ptz image data transforms')
+    if placement == 'device':
+        return DeviceAugmentation(BatchAugmentation(
+            crop_size=crop_size,
+            crop_scale=crop_scale,
+            color_jitter=color_jitter,
+            horizontal_flip=horizontal_flip,
+            color_distortion=color_distortion,
+            gaussian_blur=gaussian_blur,
+            normalization=normalization))
+    if placement != 'dataloader':
+        raise ValueError(f'Unknown augmentation placement {placement}')
 
     def get_color_distortion(s=1.0):
         # s is the strength of color distortion.
@@ -60,8 +82,181 @@ class GaussianBlur(object):
         self.radius_max = radius_max
 
     def __call__(self, img):
-        if torch.bernoulli(torch.tensor(self.prob)) == 0:
+        if torch.rand(1).item() >= self.prob:
             return img
 
         radius = self.radius_min + torch.rand(1) * (self.radius_max - self.radius_min)
         return img.filter(ImageFilter.GaussianBlur(radius=radius))
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}(p={self.prob}, radius_min={self.radius_min}, radius_max={self.radius_max})'
+
+
+class DeviceAugmentation(object):
+    """ Per-image part of a 'device' transform: the image as a uint8 [C, H, W] tensor """
+
+    def __init__(self, batch_transform):
+        self.batch_transform = batch_transform
+
+    def __call__(self, img):
+        if isinstance(img, torch.Tensor):
+            return img
+        return TF.pil_to_tensor(img.convert('RGB'))
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}({self.batch_transform!r})'
+
+
+class BatchAugmentation(object):
+    """
+    make_transforms() augmentations applied to a uint8 [B, C, H, W] batch on
+    its device, with random parameters drawn per sample.
+
+    Random resized crop and horizontal flip are one affine grid_sample per
+    batch, color jitter is per-sample brightness, contrast, saturation and
+    hue (a rotation of the chroma plane in YIQ space) factors followed by
+    random grayscale, and the Gaussian blur is a separable depthwise
+    convolution with a kernel per sample. Unlike torchvision, jitter is
+    applied in a fixed order.
+    """
+
+    def __init__(
+        self,
+        crop_size=224,
+        crop_scale=(0.95, 1.0),
+        crop_ratio=(3. / 4., 4. / 3.),
+        color_jitter=1.0,
+        horizontal_flip=False,
+        color_distortion=False,
+        gaussian_blur=False,
+        blur_prob=0.5,
+        blur_radius=(0.1, 2.),
+        normalization=((0.485, 0.456, 0.406),
+                       (0.229, 0.224, 0.225))
+    ):
+        self.crop_size = crop_size
+        self.crop_scale = crop_scale
+        self.log_ratio = (math.log(crop_ratio[0]), math.log(crop_ratio[1]))
+        self.crop_ratio = crop_ratio
+        self.horizontal_flip = horizontal_flip
+        self.color_distortion = color_distortion
+        s = color_jitter
+        self.brightness, self.contrast, self.saturation, self.hue = 0.8*s, 0.8*s, 0.8*s, 0.2*s
+        self.gaussian_blur = gaussian_blur
+        self.blur_prob = blur_prob
+        self.blur_radius = blur_radius
+        self.mean = torch.tensor(normalization[0]).view(1, 3, 1, 1)
+        self.std = torch.tensor(normalization[1]).view(1, 3, 1, 1)
+
+    def __repr__(self):
+        params = dict(crop_size=self.crop_size, crop_scale=tuple(self.crop_scale), crop_ratio=tuple(self.crop_ratio),
+                      horizontal_flip=self.horizontal_flip, color_distortion=self.color_distortion,
+                      brightness=self.brightness, contrast=self.contrast, saturation=self.saturation, hue=self.hue,
+                      gaussian_blur=self.gaussian_blur, blur_prob=self.blur_prob, blur_radius=tuple(self.blur_radius),
+                      mean=self.mean.flatten().tolist(), std=self.std.flatten().tolist())
+        return '%s(%s)' % (self.__class__.__name__, ', '.join(f'{k}={v!r}' for k, v in params.items()))
+
+    def _crop_boxes(self, B, H, W, device, attempts=10):
+        """ :returns: [B] crop centers (cx, cy) and sizes (w, h) in pixels, like RandomResizedCrop """
+        area = H * W
+        scale = torch.empty(B, attempts, device=device).uniform_(*self.crop_scale)
+        ratio = torch.exp(torch.empty(B, attempts, device=device).uniform_(*self.log_ratio))
+        w = torch.sqrt(area * scale * ratio).round()
+        h = torch.sqrt(area * scale / ratio).round()
+        valid = (w > 0) & (h > 0) & (w <= W) & (h <= H)
+        # -- first valid attempt per sample, else the center crop fallback of torchvision
+        first = torch.where(valid.any(1), valid.float().argmax(1), torch.full((B,), -1, dtype=torch.long, device=device))
+        in_ratio = W / H
+        if in_ratio < self.crop_ratio[0]:
+            fw, fh = W, round(W / self.crop_ratio[0])
+        elif in_ratio > self.crop_ratio[1]:
+            fw, fh = round(H * self.crop_ratio[1]), H
+        else:
+            fw, fh = W, H
+        idx = first.clamp(min=0).unsqueeze(1)
+        ok = first >= 0
+        w = torch.where(ok, w.gather(1, idx).squeeze(1), torch.full((B,), float(fw), device=device))
+        h = torch.where(ok, h.gather(1, idx).squeeze(1), torch.full((B,), float(fh), device=device))
+        x0 = torch.where(ok, (torch.rand(B, device=device) * (W - w + 1)).floor(), ((W - w) / 2).round())
+        y0 = torch.where(ok, (torch.rand(B, device=device) * (H - h + 1)).floor(), ((H - h) / 2).round())
+        return x0 + w / 2, y0 + h / 2, w, h
+
+    def _resized_crop(self, x):
+        B, _, H, W = x.shape
+        cx, cy, w, h = self._crop_boxes(B, H, W, x.device)
+        sx = w / W
+        if self.horizontal_flip:
+            flip = torch.rand(B, device=x.device) < 0.5
+            sx = torch.where(flip, -sx, sx)
+        theta = torch.zeros(B, 2, 3, device=x.device, dtype=x.dtype)
+        theta[:, 0, 0] = sx
+        theta[:, 0, 2] = 2 * cx / W - 1
+        theta[:, 1, 1] = h / H
+        theta[:, 1, 2] = 2 * cy / H - 1
+        size = (B, x.shape[1], self.crop_size, self.crop_size)
+        grid = F.affine_grid(theta, size, align_corners=False)
+        return F.grid_sample(x, grid, mode='bilinear', padding_mode='border', align_corners=False)
+
+    @staticmethod
+    def _factor(B, strength, device, apply):
+        factor = torch.empty(B, 1, 1, 1, device=device).uniform_(max(0., 1. - strength), 1. + strength)
+        return torch.where(apply, factor, torch.ones_like(factor))
+
+    @staticmethod
+    def _gray(x):
+        return (0.299 * x[:, 0:1] + 0.587 * x[:, 1:2] + 0.114 * x[:, 2:3])
+
+    def _color_distortion(self, x):
+        B, device = x.shape[0], x.device
+        apply = (torch.rand(B, 1, 1, 1, device=device) < 0.8)
+        x = (x * self._factor(B, self.brightness, device, apply)).clamp_(0, 1)
+        mean = self._gray(x).mean(dim=(1, 2, 3), keepdim=True)
+        x = ((x - mean) * self._factor(B, self.contrast, device, apply) + mean).clamp_(0, 1)
+        gray = self._gray(x)
+        x = ((x - gray) * self._factor(B, self.saturation, device, apply) + gray).clamp_(0, 1)
+        if self.hue > 0:
+            angle = torch.empty(B, device=device).uniform_(-self.hue, self.hue) * 2 * math.pi
+            angle = torch.where(apply.view(B), angle, torch.zeros_like(angle))
+            cos, sin = torch.cos(angle).view(B, 1, 1), torch.sin(angle).view(B, 1, 1)
+            yiq = torch.einsum('ij,bjhw->bihw', _RGB_TO_YIQ.to(device, x.dtype), x)
+            i, q = yiq[:, 1], yiq[:, 2]
+            yiq = torch.stack([yiq[:, 0], cos * i - sin * q, sin * i + cos * q], dim=1)
+            x = torch.einsum('ij,bjhw->bihw', _YIQ_TO_RGB.to(device, x.dtype), yiq).clamp_(0, 1)
+        grayscale = torch.rand(B, 1, 1, 1, device=device) < 0.2
+        return torch.where(grayscale, self._gray(x).expand_as(x), x)
+
+    def _blur(self, x):
+        B, C, H, W = x.shape
+        sigma = torch.empty(B, device=x.device).uniform_(*self.blur_radius)
+        radius = math.ceil(3 * self.blur_radius[1])
+        offsets = torch.arange(-radius, radius + 1, device=x.device, dtype=x.dtype)
+        kernel = torch.exp(-0.5 * (offsets.view(1, -1) / sigma.view(-1, 1)) ** 2)
+        kernel = kernel / kernel.sum(1, keepdim=True)
+        # -- samples that are not blurred get an identity kernel
+        identity = torch.zeros_like(kernel)
+        identity[:, radius] = 1.
+        apply = torch.rand(B, 1, device=x.device) < self.blur_prob
+        kernel = torch.where(apply, kernel, identity).repeat_interleave(C, dim=0)
+        x = x.reshape(1, B * C, H, W)
+        x = F.conv2d(F.pad(x, (radius, radius, 0, 0), mode='reflect'), kernel.view(B * C, 1, 1, -1), groups=B * C)
+        x = F.conv2d(F.pad(x, (0, 0, radius, radius), mode='reflect'), kernel.view(B * C, 1, -1, 1), groups=B * C)
+        return x.view(B, C, H, W)
+
+    @torch.no_grad()
+    def __call__(self, imgs):
+        """ :param imgs: uint8 [B, C, H, W] (or float in [0, 1]) batch, on the target device """
+        x = imgs.float()
+        if imgs.dtype == torch.uint8:
+            x = x.div_(255.)
+        x = self._resized_crop(x)
+        if self.color_distortion:
+            x = self._color_distortion(x)
+        if self.gaussian_blur:
+            x = self._blur(x)
+        return (x - self.mean.to(x.device)) / self.std.to(x.device)
+
+
+_RGB_TO_YIQ = torch.tensor([[0.299, 0.587, 0.114],
+                            [0.596, -0.274, -0.322],
+                            [0.211, -0.523, 0.312]])
+_YIQ_TO_RGB = torch.linalg.inv(_RGB_TO_YIQ)
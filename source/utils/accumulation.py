@@ -0,0 +1,57 @@
+import math
+import time
+
+from source.utils.logging import AverageMeter
+
+
+class GradientAccumulator(object):
+    """
+    Gradient accumulation of micro-batches into global batches.
+
+    Micro-batch i of an epoch belongs to global batch i // accumulation_steps.
+    Its loss is divided by the number of micro-batches of that global batch
+    (the last one of an epoch may be short) and accumulated into .grad;
+    is_step() is True on the last micro-batch of a global batch, which is
+    when the caller steps the optimizer, the schedulers and the EMA and
+    reads gradient stats.
+    """
+
+    def __init__(self, accumulation_steps, num_micro_batches):
+        self.accumulation_steps = max(int(accumulation_steps), 1)
+        self.num_micro_batches = num_micro_batches
+        self.throughput = AverageMeter()
+        self.start_epoch()
+
+    @property
+    def steps_per_epoch(self):
+        """ Optimizer steps per epoch, the iterations of the schedulers """
+        return math.ceil(self.num_micro_batches / self.accumulation_steps)
+
+    def start_epoch(self):
+        self.throughput.reset()
+        self._last_step = time.perf_counter()
+        self._samples = 0
+
+    def is_step(self, itr):
+        return (itr + 1) % self.accumulation_steps == 0 or itr + 1 == self.num_micro_batches
+
+    def step_index(self, itr):
+        return itr // self.accumulation_steps
+
+    def group_size(self, itr):
+        start = itr - itr % self.accumulation_steps
+        return min(self.accumulation_steps, self.num_micro_batches - start)
+
+    def backward(self, loss, itr, precision, num_samples):
+        """ Accumulates the gradients of micro-batch `itr` with loss `loss` """
+        self._samples += num_samples
+        precision.backward(loss / self.group_size(itr))
+
+    def step_done(self):
+        """ :returns: samples/s of the global batch that just stepped """
+        now = time.perf_counter()
+        samples_per_sec = self._samples / max(now - self._last_step, 1e-9)
+        self.throughput.update(samples_per_sec)
+        self._last_step = now
+        self._samples = 0
+        return samples_per_sec
@@ -0,0 +1,60 @@
+import torch
+
+
+_HAS_FOREACH_LERP = hasattr(torch, '_foreach_lerp_')
+
+
+class ModelEMA(object):
+    """
+    Exponential moving average of a source model into a target model.
+
+    The parameter lists are collected once, and every update is a single
+    in-place multi-tensor (torch._foreach_*) call over all parameters
+    instead of a Python loop with two kernels per parameter.
+    Parameters are matched by position, so both models need the same
+    architecture (e.g. a target made with copy.deepcopy of the source).
+    Floating point buffers are averaged like the parameters (as the
+    state_dict blend did), other buffers (e.g. counters) are copied.
+    """
+
+    def __init__(self, source, target):
+        source_params = list(source.parameters())
+        target_params = list(target.parameters())
+        if len(source_params) != len(target_params):
+            raise ValueError('Source and target models have different parameters')
+        for p_s, p_t in zip(source_params, target_params):
+            if p_s.shape != p_t.shape:
+                raise ValueError(f'Parameter shape mismatch {p_s.shape} != {p_t.shape}')
+            if p_t.dtype != torch.float32:
+                # -- the average accumulates (1 - m) sized steps, lower precision loses them
+                raise ValueError(f'EMA target parameters must be float32 master weights, got {p_t.dtype}')
+        self.source_params = [p.detach() for p in source_params]
+        self.target_params = [p.detach() for p in target_params]
+
+        source_buffers = list(source.buffers())
+        target_buffers = list(target.buffers())
+        if len(source_buffers) != len(target_buffers):
+            raise ValueError('Source and target models have different buffers')
+        self.source_buffers, self.target_buffers = [], []
+        self.copied_buffers = []
+        for b_s, b_t in zip(source_buffers, target_buffers):
+            if b_s.shape != b_t.shape:
+                raise ValueError(f'Buffer shape mismatch {b_s.shape} != {b_t.shape}')
+            if b_t.is_floating_point():
+                self.source_buffers.append(b_s)
+                self.target_buffers.append(b_t)
+            else:
+                self.copied_buffers.append((b_s, b_t))
+
+    @torch.no_grad()
+    def update(self, m):
+        """ target <- m * target + (1 - m) * source """
+        targets = self.target_params + self.target_buffers
+        sources = self.source_params + self.source_buffers
+        if _HAS_FOREACH_LERP:
+            torch._foreach_lerp_(targets, sources, 1. - m)
+        else:
+            torch._foreach_mul_(targets, m)
+            torch._foreach_add_(targets, sources, alpha=1. - m)
+        for b_s, b_t in self.copied_buffers:
+            b_t.copy_(b_s)
@@ -0,0 +1,81 @@
+import logging
+from contextlib import nullcontext
+
+import torch
+
+
+logger = logging.getLogger(__name__)
+
+
+PRECISIONS = {
+    'fp32': torch.float32,
+    'bf16': torch.bfloat16,
+    'fp16': torch.float16,
+}
+
+
+class PrecisionPolicy(object):
+    """
+    Mixed precision of a training loop.
+
+    fp32: no autocast
+    bf16: torch.autocast to bfloat16, on CUDA and on CPU, without loss
+          scaling (bfloat16 has the exponent range of float32); GPUs
+          without bfloat16 fall back to fp16
+    fp16: torch.autocast to float16 with a GradScaler on CUDA, CPU runs
+          fall back to bf16
+
+    Only the forward computations are lowered: parameters, gradients,
+    optimizer state and the EMA target stay float32 master weights.
+    """
+
+    def __init__(self, precision, device):
+        if precision not in PRECISIONS:
+            raise ValueError(f'Unknown precision {precision}, expected one of {list(PRECISIONS)}')
+        device = torch.device(device)
+        if precision == 'bf16' and device.type == 'cuda' and not torch.cuda.is_bf16_supported():
+            logger.warning('bfloat16 is not supported on %s, using fp16 with loss scaling', device)
+            precision = 'fp16'
+        if precision == 'fp16' and device.type != 'cuda':
+            logger.warning('fp16 autocast needs CUDA, using bf16 on %s', device)
+            precision = 'bf16'
+        self.precision = precision
+        self.device_type = device.type
+        self.dtype = PRECISIONS[precision]
+        self.scaler = torch.cuda.amp.GradScaler() if precision == 'fp16' else None
+
+    @classmethod
+    def from_config(cls, meta, device):
+        """ meta.precision if set, bf16 if meta.use_bfloat16, fp32 otherwise """
+        precision = meta.get('precision', 'bf16' if meta.get('use_bfloat16', False) else 'fp32')
+        policy = cls(precision, device)
+        logger.info('Training precision: %s', policy.precision)
+        return policy
+
+    @property
+    def enabled(self):
+        return self.precision != 'fp32'
+
+    def autocast(self):
+        """ :returns: context manager for the forward passes (and losses) """
+        if not self.enabled:
+            return nullcontext()
+        return torch.autocast(device_type=self.device_type, dtype=self.dtype)
+
+    def backward(self, loss):
+        if self.scaler is not None:
+            loss = self.scaler.scale(loss)
+        loss.backward()
+
+    def unscale_(self, optimizer):
+        """ Unscales the gradients in place, before clipping or inspecting them """
+        if self.scaler is not None:
+            self.scaler.unscale_(optimizer)
+
+    def step(self, optimizer):
+        """ Optimizer step, skipped by the scaler if the gradients overflowed """
+        if self.scaler is None:
+            optimizer.step()
+            return
+        self.scaler.step(optimizer)
+        self.scaler.update()
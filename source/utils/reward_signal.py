@@ -0,0 +1,95 @@
+import torch
+
+from source.utils.logging import AverageMeter
+
+
+REWARD_SIGNAL_MODES = ('two_pass', 'exact', 'subset', 'proxy')
+
+
+class GradientRewardSignal(object):
+    """
+    Reward target of the world model: g = mean(|dL_aux/dtheta|) over the
+    target encoder parameters, computed from the auxiliary loss of the same
+    forward pass that produces the training loss.
+
+    Modes:
+        exact:  autograd.grad over every target encoder parameter
+        subset: autograd.grad over the last `subset_blocks` blocks (+ norm)
+        proxy:  mean(|dL_aux/dh|) w.r.t. the target embeddings only
+
+    The subset and proxy estimates are rescaled by a running ratio to the
+    exact value, refreshed every `calibration_freq` calls. The relative
+    error of the estimate at those calls is tracked in `error_meter`.
+    'two_pass' is handled by the caller and only accepted here for
+    config validation.
+    """
+
+    def __init__(
+        self,
+        target_encoder,
+        mode='exact',
+        subset_blocks=2,
+        calibration_freq=100,
+        scale_momentum=0.9
+    ):
+        if mode not in REWARD_SIGNAL_MODES or mode == 'two_pass':
+            raise ValueError(f'Unexpected reward signal mode {mode}')
+        self.mode = mode
+        self.params = [p for p in target_encoder.parameters() if p.requires_grad]
+        if mode == 'subset':
+            modules = list(target_encoder.blocks[-subset_blocks:])
+            if target_encoder.norm is not None:
+                modules.append(target_encoder.norm)
+            self.estimate_params = [p for m in modules for p in m.parameters() if p.requires_grad]
+        else:
+            self.estimate_params = None
+        self.calibration_freq = max(1, int(calibration_freq))
+        self.scale_momentum = scale_momentum
+        self.scale = None
+        self.error_meter = AverageMeter()
+        self._calls = 0
+
+    def needs_target_graph(self):
+        """ Whether the next call needs the autograd graph of the target encoder """
+        return self.mode != 'proxy' or self._is_calibration_call()
+
+    def _is_calibration_call(self):
+        return self.mode != 'exact' and self._calls % self.calibration_freq == 0
+
+    @staticmethod
+    def _mean_abs(grads):
+        grads = [g.reshape(-1) for g in grads if g is not None]
+        return torch.cat(grads).abs().mean()
+
+    def _exact(self, auxiliary_loss):
+        grads = torch.autograd.grad(auxiliary_loss, self.params, allow_unused=True)
+        return self._mean_abs(grads)
+
+    def _estimate(self, auxiliary_loss, h, retain_graph):
+        if self.mode == 'subset':
+            grads = torch.autograd.grad(auxiliary_loss, self.estimate_params,
+                                        retain_graph=retain_graph, allow_unused=True)
+        else:
+            grads = torch.autograd.grad(auxiliary_loss, h, retain_graph=retain_graph)
+        return self._mean_abs(grads)
+
+    def __call__(self, auxiliary_loss, h):
+        """
+        :param auxiliary_loss: loss between the detached context prediction and h
+        :param h: target embeddings (requires grad)
+        :returns: detached scalar tensor with the reward target g
+        """
+        calibrate = self._is_calibration_call()
+        self._calls += 1
+        if self.mode == 'exact':
+            return self._exact(auxiliary_loss).detach()
+
+        estimate = self._estimate(auxiliary_loss, h, retain_graph=calibrate).detach()
+        if calibrate:
+            exact = float(self._exact(auxiliary_loss))
+            ratio = exact / max(float(estimate), 1e-12)
+            if self.scale is not None:
+                self.error_meter.update(abs(self.scale * float(estimate) - exact) / max(exact, 1e-12))
+                ratio = self.scale_momentum * self.scale + (1. - self.scale_momentum) * ratio
+            self.scale = ratio
+        return estimate * self.scale
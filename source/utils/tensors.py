@@ -64,6 +64,17 @@ def apply_masks(x, masks):
     return torch.cat(all_x, dim=0)
 
 
+def all_pairs_index(batch_size, device=None):
+    """
+    :param batch_size: number of unique samples B in the batch
+    :param device: device on which to build the indices
+    :returns: (context_idx, target_idx), two LongTensors of length B*B such that
+        row i*B + j pairs context sample i with target sample j
+    """
+    idx = torch.arange(batch_size, device=device)
+    return idx.repeat_interleave(batch_size), idx.repeat(batch_size)
+
+
 def repeat_interleave_batch(x, B, repeat):
     N = len(x) // B
     x = torch.cat([
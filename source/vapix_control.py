@@ -4,12 +4,13 @@ Library for control AXIS PTZ cameras using Vapix
 import time
 import logging
 import sys
-import os
-import requests
 import cv2
-from requests.auth import HTTPDigestAuth
+import numpy as np
 from bs4 import BeautifulSoup
 
+from source.camera_http import CameraSession
+from source.ptz_state import PTZStateCache, MoveWaiter
+
 logging.basicConfig(filename='vapix.log',
                     filemode='w',
                     level=logging.DEBUG)
@@ -29,7 +30,8 @@ class CameraControl:
     Module for control cameras AXIS using Vapix
     """
 
-    def __init__(self, ip, user, password, pan_margin=0.1, tilt_margin=0.1, zoom_margin=1):
+    def __init__(self, ip, user, password, pan_margin=0.1, tilt_margin=0.1, zoom_margin=1,
+                 state_staleness=1.0):
         self.__cam_ip = ip
         self.__cam_user = user
         self.__cam_password = password
@@ -38,6 +40,12 @@ class CameraControl:
         self.__tilt_margin = tilt_margin
         self.__zoom_margin = zoom_margin
 
+        self.__session = CameraSession(user, password)
+        # control commands are not idempotent, they are never re-sent
+        self.__control_session = CameraSession(user, password, retries=0)
+        self.state = PTZStateCache(self._query_ptz, staleness=state_staleness)
+        self.waiter = MoveWaiter(timeout=TIME_TOLERANCE)
+
     @staticmethod
     def __merge_dicts(*dict_args) -> dict:
         """
@@ -55,11 +63,12 @@ class CameraControl:
             result.update(dictionary)
         return result
 
-    def _camera_command(self, payload: dict):
+    def _camera_command(self, payload: dict, target=None):
         """
         Function used to send commands to the camera
         Args:
             payload: argument dictionary for camera control
+            target: expected final (pan, tilt, zoom) of a move command, if known
 
         Returns:
             Returns the response from the device to the command sent
@@ -77,8 +86,13 @@ class CameraControl:
 
         url = 'http://' + self.__cam_ip + '/axis-cgi/com/ptz.cgi'
 
-        resp = requests.get(url, auth=HTTPDigestAuth(self.__cam_user, self.__cam_password),
-                            params=payload2)
+        session = self.__session
+        if 'query' not in payload and 'info' not in payload:
+            # the camera may move, the cached position no longer holds
+            self.state.commanded(target)
+            session = self.__control_session
+
+        resp = session.get(url, params=payload2)
 
         if (resp.status_code != 200) and (resp.status_code != 204):
             soup = BeautifulSoup(resp.text, features="lxml")
@@ -88,6 +102,22 @@ class CameraControl:
 
         return resp
 
+    def _wait_move(self, pan=None, tilt=None, zoom=None):
+        """
+        Polls the PTZ status until the camera settles, at the target if given.
+
+        Args:
+            pan, tilt, zoom: expected final position, None for any value.
+
+        """
+        margins = (self.__pan_margin, self.__tilt_margin, self.__zoom_margin)
+
+        def reached(position):
+            return all(target is None or abs(current - target) <= margin
+                       for current, target, margin in zip(position, (pan, tilt, zoom), margins))
+
+        return self.waiter.wait(self.state.refresh, reached=reached, start=self.state.start_state)
+
     def absolute_move(self, pan: float = None, tilt: float = None, zoom: int = None,
                       speed: int = None):
         """
@@ -105,15 +135,12 @@ class CameraControl:
         """
         resp = None
         start_time = time.time()
-        resp = self._camera_command({'pan': pan, 'tilt': tilt, 'zoom': zoom, 'speed': speed})
+        resp = self._camera_command({'pan': pan, 'tilt': tilt, 'zoom': zoom, 'speed': speed},
+                                    target=(pan, tilt, zoom))
 
-        current_pan, current_tilt, current_zoom = self.get_ptz()
-        while abs(current_pan - pan) > self.__pan_margin and abs(current_tilt - tilt) > self.__tilt_margin and abs(current_zoom - zoom) > self.__zoom_margin:
-            current_pan, current_tilt, current_zoom = self.get_ptz()
-            time.sleep(1)
-            if time.time() - start_time > TIME_TOLERANCE:
-                        break
+        self._wait_move(pan, tilt, zoom)
 
+        self.state.settled()
 
         logger.info('Finished')
 
@@ -163,13 +190,11 @@ class CameraControl:
         pan = current_pan + rpan
         tilt = current_tilt + rtilt
         zoom = current_zoom + rzoom
-        resp = self._camera_command({'rpan': rpan, 'rtilt': rtilt, 'rzoom': rzoom, 'speed': speed})
-        while abs(current_pan - pan) > self.__pan_margin and abs(current_tilt - tilt) > self.__tilt_margin and abs(current_zoom - zoom) > self.__zoom_margin:
-            current_pan, current_tilt, current_zoom = self.get_ptz()
-            time.sleep(1)
-            if time.time() - start_time > TIME_TOLERANCE:
-                        break
+        resp = self._camera_command({'rpan': rpan, 'rtilt': rtilt, 'rzoom': rzoom, 'speed': speed},
+                                    target=(pan, tilt, zoom))
+        self._wait_move(pan, tilt, zoom)
 
+        self.state.settled()
 
         logger.info('Finished')
 
@@ -259,7 +284,17 @@ class CameraControl:
 
     def get_ptz(self):
         """
-        Operation to request PTZ status.
+        Operation to request PTZ status, served from the state cache while it is not stale.
+
+        Returns:
+            Returns a tuple with the position of the camera (P, T, Z)
+
+        """
+        return self.state.get()
+
+    def _query_ptz(self):
+        """
+        Requests the PTZ status from the camera.
 
         Returns:
             Returns a tuple with the position of the camera (P, T, Z)
@@ -380,46 +415,53 @@ class CameraControl:
         resp = self._camera_command({'info': '1'})
         return resp.text
 
-    def snap_shot(self, filename: str = None):
+    def snap_shot_bytes(self):
         """
-        Captures and image from the PTZ camera.
-        Success Image is saved as the filename.
+        Captures and image from the PTZ camera without writing it to disk.
+        Retries with a growing interval until the image is in focus or
+        TIME_TOLERANCE is reached.
 
-        Args:
-            filename: name of the file to save the image.
+        Returns:
+            Returns the JPEG bytes of the last capture, None if no capture succeeded
 
         """
         start_time = time.time()
         lap = 0.0
+        content = None
+        # focus polling interval, grows up to 1 second
+        interval = 0.1
 
         # URL to capture image
         url = f"http://{self.__cam_ip}/axis-cgi/jpg/image.cgi"
         while lap < FOCUS_THRESHOLD:
-            # Sometimes it need '@', sometimes don't
-            # need to check the path
-            # os.system("wget " + url + ' -O ' + directory.replace(' ', '_'))
-            filename = filename.replace(' ', '_')
-            # check this out for 401 error reason
-            # https://stackoverflow.com/questions/2384230/what-is-digest-authentication
-            res = requests.get(url,
-                               auth=HTTPDigestAuth(self.__cam_user,
-                                                   self.__cam_password),
-                               timeout=5)
+            res = self.__session.get(url, timeout=5)
             if res.status_code == 200:
-                with open(filename, 'wb') as f:
-                    f.write(res.content)
+                content = res.content
+                # compute the Laplacian of the decoded image, the focus
+                # measure is the variance of the Laplacian
+                image = cv2.imdecode(np.frombuffer(content, dtype=np.uint8), cv2.IMREAD_COLOR)
+                lap = cv2.Laplacian(image, cv2.CV_64F).var() if image is not None else 0.0
+                logger.info('lap is %s', lap)
             else:
-                logger.error('Failed to capture image, will try again in 1 second')
+                logger.error('Failed to capture image, will try again')
                 logger.error('Status code: %s', res.status_code)
-            time.sleep(1)
-
-            # Load the image
-            image = cv2.imread(filename)
-            # compute the Laplacian of the image and then return the focus
-            # measure, which is simply the variance of the Laplacian
-            lap = cv2.Laplacian(image, cv2.CV_64F).var()
-            logger.info('lap is %s', lap)
-            if time.time() - start_time > TIME_TOLERANCE:
+            if lap >= FOCUS_THRESHOLD or time.time() - start_time > TIME_TOLERANCE:
                 break
+            time.sleep(interval)
+            interval = min(2 * interval, 1.)
 
+        return content
 
+    def snap_shot(self, filename: str = None):
+        """
+        Captures and image from the PTZ camera.
+        Success Image is saved as the filename.
+
+        Args:
+            filename: name of the file to save the image.
+
+        """
+        content = self.snap_shot_bytes()
+        if content is not None:
+            with open(filename.replace(' ', '_'), 'wb') as f:
+                f.write(content)